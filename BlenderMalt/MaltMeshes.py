@@ -93,7 +93,17 @@ def load_mesh(object, name):
         'uvs': uvs_list,
         'tangents': tangents_buffer,
         'colors': colors_list,
+        'optimize': False,
     }
+    optimize = object.original.data.malt_parameters.bools.get('optimize_mesh')
+    if optimize:
+        mesh_data['optimize'] = optimize.boolean
+    compact = object.original.data.malt_parameters.bools.get('compact_vertex_format')
+    if compact:
+        mesh_data['compact'] = compact.boolean
+    arena = object.original.data.malt_parameters.bools.get('vertex_arena')
+    if arena:
+        mesh_data['arena'] = arena.boolean
 
     from . import MaltPipeline
     MaltPipeline.get_bridge().load_mesh(name, mesh_data)
@@ -158,6 +158,7 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                 malt_light = obj.data.malt
 
                 light = Scene.Light()
+                light.name = obj.name_full
                 light.color = tuple(obj.data.color * malt_light.strength)
                 light.position = tuple(obj.matrix_world.translation)
                 light.direction = tuple(obj.matrix_world.to_quaternion() @ Vector((0.0,0.0,-1.0)))
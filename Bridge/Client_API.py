@@ -249,6 +249,11 @@ class Bridge():
     @bridge_method
     def free_viewport_id(self, viewport_id):
         self.viewport_ids.remove(viewport_id)
+        self.render_buffers.pop(viewport_id, None)
+        self.connections['MAIN'].send({
+            'msg_type': 'FREE VIEWPORT',
+            'viewport_id': viewport_id,
+        })
 
     @bridge_method
     def render(self, viewport_id, resolution, scene, scene_update, renderdoc_capture=False, AOVs={}):
@@ -0,0 +1,82 @@
+import threading, queue
+
+import glfw
+
+from Malt.GL.GL import *
+from Malt.Utils import LOG
+
+import Bridge.Mesh, Bridge.Texture
+
+class ResourceLoader():
+    #Uploads meshes and textures from a background thread with its own GL context, shared with the render context.
+    #Loaded resources are published from the render thread (see publish) once their fence is signaled,
+    #until then the render loop keeps using the previous version (or skips it).
+
+    def __init__(self, shared_window):
+        glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+        self.window = glfw.create_window(1, 1, 'Malt Loader', None, shared_window)
+        glfw.window_hint(glfw.VISIBLE, glfw.TRUE)
+        if not self.window:
+            raise Exception('Failed to create the loader context')
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.loaded = []
+        self.pending_count = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def load(self, msg):
+        with self.lock:
+            self.pending_count += 1
+        self.queue.put(msg)
+    
+    def run(self):
+        glfw.make_context_current(self.window)
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                break
+            resource = None
+            try:
+                if msg['msg_type'] == 'MESH':
+                    resource = Bridge.Mesh.upload_mesh(msg)
+                if msg['msg_type'] == 'TEXTURE':
+                    resource = Bridge.Texture.upload_texture(msg)
+            except:
+                import traceback
+                LOG.error(traceback.format_exc())
+            fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            #Make sure the commands reach the GPU, otherwise the fence may never be signaled
+            glFlush()
+            with self.lock:
+                self.loaded.append((msg, resource, fence))
+        glfw.make_context_current(None)
+    
+    def publish(self):
+        #Returns True if any resource has been published
+        with self.lock:
+            loaded = [*self.loaded]
+        published = 0
+        for msg, resource, fence in loaded:
+            status = glClientWaitSync(fence, 0, 0)
+            if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                #Fences from the same context are signaled in order
+                break
+            glDeleteSync(fence)
+            published += 1
+            if resource is None:
+                continue
+            if msg['msg_type'] == 'MESH':
+                Bridge.Mesh.setup_mesh(msg['name'], resource)
+            if msg['msg_type'] == 'TEXTURE':
+                Bridge.Texture.TEXTURES[msg['name']] = resource
+        with self.lock:
+            del self.loaded[:published]
+            self.pending_count -= published
+        return published > 0
+    
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        glfw.destroy_window(self.window)
+
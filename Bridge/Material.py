@@ -4,17 +4,33 @@ MATERIAL_SHADERS = {}
 
 class Material():
 
-    def __init__(self, path, pipeline, search_paths=[], custom_passes={}):
+    def __init__(self, path, pipeline, search_paths=[], custom_passes={}, deferred=False):
         self.path = path
         self.parameters = {}
         self.compiler_error = ''
         
-        compiled_material = pipeline.compile_material(path, search_paths)#, custom_passes)
+        self.compiled_material = pipeline.compile_material(path, search_paths, deferred)#, custom_passes)
+
+        if deferred == False:
+            self.finish_compilation()
+    
+    def is_ready(self):
+        if isinstance(self.compiled_material, dict):
+            for shader in self.compiled_material.values():
+                if shader.is_ready() == False:
+                    return False
+        return True
+    
+    def finish_compilation(self):
+        compiled_material = self.compiled_material
+        #Shaders can't be sent to the client
+        self.compiled_material = None
         
         if isinstance(compiled_material, str):
             self.compiler_error = compiled_material
         else:
             for pass_name, shader in compiled_material.items():
+                shader.finish_compilation()
                 for uniform_name, uniform in shader.uniforms.items():
                     self.parameters[uniform_name] = Parameter.from_uniform(uniform)
                 if shader.error:
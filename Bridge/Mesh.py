@@ -1,41 +1,417 @@
+import itertools
+
 from Malt.Utils import LOG
 from Malt.GL import Mesh
 from Malt.GL.GL import *
 
 MESHES = {}
 
+#Every (re)loaded mesh gets a new load_version, so caches can tell mesh edits apart (see SceneLighting shadow caching)
+_LOAD_VERSIONS = itertools.count(1)
+
+#Store vertex attributes in compact formats (see compact_vertex_arrays):
+#snorm16 normals and tangents (sign in w), half float UVs, unorm8 colors and 16 bit indices when possible.
+#Used for meshes that don't set the compact_vertex_format mesh parameter.
+USE_COMPACT_VERTEX_FORMAT = False
+#Sub-allocate interleaved meshes from shared buffers and VAOs (see Malt.GL.VertexArena)
+#Used for meshes that don't set the vertex_arena mesh parameter.
+USE_VERTEX_ARENA = True
+#Without the native mesh_optimizer library, tipsify falls back to a (much slower) Python loop,
+#and leaves meshes with more triangles than this in their original order.
+TIPSIFY_PYTHON_MAX_TRIANGLES = 100000
+
 def load_mesh(msg):
-    name = msg['name']
+    setup_mesh(msg['name'], upload_mesh(msg))
+
+def mesh_arrays(data):
+    #Returns the mesh data as numpy arrays (without copies)
+    import numpy as np
+    def as_array(buffer, element_size):
+        if buffer is None:
+            return None
+        return np.ctypeslib.as_array(buffer.buffer()).reshape(-1, element_size)
+    
+    return {
+        'positions' : as_array(data['positions'], 3),
+        'normals' : as_array(data['normals'], 3),
+        'tangents' : as_array(data['tangents'], 4),
+        'uvs' : [as_array(uv, 2) for uv in data['uvs']],
+        'colors' : [as_array(color, 4) for color in data['colors']],
+        #Index buffers are allocated for the whole mesh, only keep the used range
+        'indices' : [as_array(indices, 1)[:length].ravel() for indices, length in zip(data['indices'], data['indices_lengths'])],
+    }
+
+def vertex_format(array, element_size):
+    #Returns the attribute format for an array as (element_size, gl_type, gl_normalize, stride)
+    import numpy as np
+    formats = {
+        np.dtype(np.float32) : (GL_FLOAT, GL_FALSE),
+        np.dtype(np.float16) : (GL_HALF_FLOAT, GL_FALSE),
+        np.dtype(np.int16) : (GL_SHORT, GL_TRUE),
+        np.dtype(np.uint8) : (GL_UNSIGNED_BYTE, GL_TRUE),
+    }
+    gl_type, gl_normalize = formats[array.dtype]
+    stride = 0
+    if array.shape[1] != element_size:
+        stride = array.shape[1] * array.dtype.itemsize
+    return (element_size, gl_type, gl_normalize, stride)
+
+def compact_vertex_arrays(arrays):
+    import numpy as np
+    def to_snorm16(array):
+        return np.round(np.clip(array, -1.0, 1.0) * 32767.0).astype(np.int16)
+    
+    result = dict(arrays)
+
+    normals = arrays['normals']
+    if normals.dtype == np.float32:
+        #Pad to 8 bytes to keep attributes 4 byte aligned
+        result['normals'] = np.zeros((len(normals), 4), np.int16)
+        result['normals'][:,:3] = to_snorm16(normals)
+    
+    tangents = arrays['tangents']
+    if tangents is not None:
+        result['tangents'] = to_snorm16(tangents)
+        #Bitangent sign
+        result['tangents'][:,3] = np.where(tangents[:,3] < 0, -32767, 32767)
+    
+    result['uvs'] = [uv.astype(np.float16) for uv in arrays['uvs']]
+    
+    result['colors'] = []
+    for color in arrays['colors']:
+        #Keep HDR colors as floats
+        if color is not None and color.dtype == np.float32 and len(color) and color.min() >= 0.0 and color.max() <= 1.0:
+            color = np.round(color * 255.0).astype(np.uint8)
+        result['colors'].append(color)
+    
+    if len(arrays['positions']) <= 65536:
+        result['indices'] = [indices.astype(np.uint16) for indices in arrays['indices']]
+    
+    return result
+
+def weld_vertices(arrays):
+    #Merge vertices (loops) with identical attributes
+    import numpy as np
+    attributes = [arrays['positions'], arrays['normals'], arrays['tangents'], *arrays['uvs'], *arrays['colors']]
+    attributes = [a for a in attributes if a is not None]
+    rows = np.hstack([np.ascontiguousarray(a).view(np.uint8).reshape(len(a), -1) for a in attributes])
+    rows = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.shape[1]))).ravel()
+    unique, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    
+    def select(array):
+        return None if array is None else array[first]
+    
+    result = dict(arrays)
+    for key in ('positions', 'normals', 'tangents'):
+        result[key] = select(arrays[key])
+    result['uvs'] = [select(uv) for uv in arrays['uvs']]
+    result['colors'] = [select(color) for color in arrays['colors']]
+    result['indices'] = [inverse[indices].astype(np.uint32) for indices in arrays['indices']]
+    return result
+
+def tipsify(indices, vertex_count, cache_size=16):
+    #Reorder triangles for post-transform vertex cache locality.
+    #Sander, Nehab and Barczak, Fast Triangle Reordering for Vertex Locality and Reduced Overdraw (2007)
+    import numpy as np
+    triangles = indices.reshape(-1, 3)
+    if len(triangles) == 0:
+        return indices
+    flat = np.ascontiguousarray(triangles.ravel(), np.uint32)
+    #The triangles of each vertex, from offsets[v] to offsets[v+1]
+    counts = np.bincount(flat, minlength=vertex_count)
+    offsets = np.zeros(vertex_count + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    adjacency = (np.argsort(flat, kind='stable') // 3).astype(np.uint32)
+
+    optimizer = get_mesh_optimizer()
+    if optimizer:
+        order = np.empty(len(triangles), np.uint32)
+        if optimizer.tipsify(flat.ctypes.data, len(triangles), offsets.ctypes.data, adjacency.ctypes.data,
+            vertex_count, cache_size, order.ctypes.data) == 0:
+            return triangles[order].ravel()
+        return indices
+    if len(triangles) > TIPSIFY_PYTHON_MAX_TRIANGLES:
+        return indices
+    return triangles[tipsify_python(flat.tolist(), adjacency.tolist(), offsets.tolist(), counts.tolist(), vertex_count, cache_size)].ravel()
+
+def tipsify_python(flat, adjacency, offsets, live, vertex_count, cache_size):
+    #Same as mesh_optimizer.c tipsify. Returns the new triangle order
+    cache_time = [0] * vertex_count
+    emitted = bytearray(len(flat) // 3)
+    output = []
+    dead_end = []
+    time = cache_size + 1
+    cursor = 0
+    fan = flat[0]
+
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan+1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = 1
+            output.append(t)
+            for v in flat[t*3:t*3+3]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+        
+        #Prefer the candidates that will still be in cache after emitting all their triangles
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = time - cache_time[v]
+                if priority > best:
+                    best = priority
+                    fan = v
+        
+        if fan == -1:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan = v
+                    break
+        if fan == -1:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                    break
+                cursor += 1
+    
+    return output
+
+__MESH_OPTIMIZER = None
+
+def get_mesh_optimizer():
+    #Returns the native mesh_optimizer library, or False if it hasn't been built
+    global __MESH_OPTIMIZER
+    if __MESH_OPTIMIZER is None:
+        try:
+            from Bridge import mesh_optimizer
+            __MESH_OPTIMIZER = mesh_optimizer
+        except Exception:
+            LOG.warning('Bridge.mesh_optimizer is not available. Falling back to Python vertex cache optimization.')
+            __MESH_OPTIMIZER = False
+    return __MESH_OPTIMIZER
+
+def optimize_vertex_cache(arrays):
+    #Reorder each submesh triangles and then the vertices in order of first use, for vertex fetch locality
+    import numpy as np
+    vertex_count = len(arrays['positions'])
+    indices = [tipsify(i, vertex_count) for i in arrays['indices']]
+    
+    stream = np.concatenate(indices) if indices else np.zeros(0, np.uint32)
+    #Unused vertices go last, in their original order
+    first_use = np.full(vertex_count, len(stream), np.int64)
+    np.minimum.at(first_use, stream, np.arange(len(stream)))
+    order = np.argsort(first_use, kind='stable')
+    remap = np.empty(vertex_count, np.uint32)
+    remap[order] = np.arange(vertex_count, dtype=np.uint32)
+
+    def select(array):
+        return None if array is None else array[order]
+    
+    result = dict(arrays)
+    for key in ('positions', 'normals', 'tangents'):
+        result[key] = select(arrays[key])
+    result['uvs'] = [select(uv) for uv in arrays['uvs']]
+    result['colors'] = [select(color) for color in arrays['colors']]
+    result['indices'] = [remap[i] for i in indices]
+    return result
+
+def optimize_mesh_arrays(arrays):
+    return optimize_vertex_cache(weld_vertices(arrays))
+
+def average_cache_miss_ratio(indices, cache_size=32):
+    #Transformed vertices per triangle with a FIFO cache (ACMR)
+    from collections import deque
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in indices.tolist():
+        if v not in cached:
+            misses += 1
+            cache.append(v)
+            cached.add(v)
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+    return misses / max(1, len(indices) // 3)
+
+def mesh_bounds(arrays):
+    #Object space (min, max) bounds of each submesh, used for culling (see Malt.Render.Culling)
+    bounds = []
+    for indices in arrays['indices']:
+        if len(indices) == 0:
+            bounds.append(None)
+            continue
+        positions = arrays['positions'][indices]
+        bounds.append((tuple(positions.min(axis=0).tolist()), tuple(positions.max(axis=0).tolist())))
+    return bounds
+
+def upload_mesh(msg):
+    #Only creates buffers, so it can run from the loader context (see Bridge.Loader)
     data = msg['data']
-    MESHES[name] = []
+    arrays = mesh_arrays(data)
+    
+    if data.get('optimize'):
+        arrays = optimize_mesh_arrays(arrays)
+    bounds = mesh_bounds(arrays)
+    if data.get('compact', USE_COMPACT_VERTEX_FORMAT):
+        arrays = compact_vertex_arrays(arrays)
+    if data.get('arena', USE_VERTEX_ARENA):
+        result = stage_mesh(arrays)
+        result['bounds'] = bounds
+        return result
 
-    def load_VBO(data):
+    def load_VBO(array, target=GL_ARRAY_BUFFER):
+        import numpy as np
+        array = np.ascontiguousarray(array)
         VBO = gl_buffer(GL_INT, 1)
         glGenBuffers(1, VBO)
-        glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
-        glBufferData(GL_ARRAY_BUFFER, data.size_in_bytes(), data.buffer(), GL_STATIC_DRAW)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(target, VBO[0])
+        glBufferData(target, array.nbytes, array.ctypes.data_as(ctypes.c_void_p), GL_STATIC_DRAW)
+        glBindBuffer(target, 0)
         return VBO
+    
+    index_types = {
+        2 : GL_UNSIGNED_SHORT,
+        4 : GL_UNSIGNED_INT,
+    }
+    tangents = arrays['tangents']
+    
+    return {
+        'positions' : load_VBO(arrays['positions']),
+        'normals' : load_VBO(arrays['normals']),
+        'tangents' : load_VBO(tangents) if tangents is not None else None,
+        'uvs' : [load_VBO(uv) for uv in arrays['uvs']],
+        'colors' : [load_VBO(color) if color is not None else None for color in arrays['colors']],
+        'EBOs' : [load_VBO(indices, GL_ELEMENT_ARRAY_BUFFER) for indices in arrays['indices']],
+        'index_counts' : [len(indices) for indices in arrays['indices']],
+        'index_type' : index_types[arrays['indices'][0].dtype.itemsize] if arrays['indices'] else GL_UNSIGNED_INT,
+        'bounds' : bounds,
+        'formats' : {
+            'normal' : vertex_format(arrays['normals'], 3),
+            'tangent' : vertex_format(tangents, 4) if tangents is not None else None,
+            'uvs' : [vertex_format(uv, 2) for uv in arrays['uvs']],
+            'colors' : [vertex_format(color, 4) if color is not None else None for color in arrays['colors']],
+        },
+    }
+
+def stage_mesh(arrays):
+    #Interleave the vertices into a staging buffer, setup_arena_mesh copies them into the arena
+    import numpy as np
+    max_uv = 4
+    max_vertex_colors = 4
+    uv0_index = 3
+    color0_index = uv0_index + max_uv
+    attributes = [(0, 3, arrays['positions']), (1, 3, arrays['normals'])]
+    if arrays['tangents'] is not None:
+        attributes.append((2, 4, arrays['tangents']))
+    for i, uv in enumerate(arrays['uvs'][:max_uv]):
+        attributes.append((uv0_index + i, 2, uv))
+    for i, color in enumerate(arrays['colors'][:max_vertex_colors]):
+        if color is not None:
+            attributes.append((color0_index + i, 4, color))
+    
+    vertex_count = len(arrays['positions'])
+    layout = []
+    columns = []
+    stride = 0
+    for location, element_size, array in attributes:
+        column = np.ascontiguousarray(array).view(np.uint8).reshape(vertex_count, -1)
+        element_size, gl_type, gl_normalize, _ = vertex_format(array, element_size)
+        layout.append((location, element_size, gl_type, gl_normalize, stride))
+        columns.append((stride, column))
+        #Keep attributes 4 byte aligned
+        stride += (column.shape[1] + 3) // 4 * 4
+    
+    vertices = np.zeros((vertex_count, stride), np.uint8)
+    for offset, column in columns:
+        vertices[:, offset:offset+column.shape[1]] = column
+    
+    index_types = {
+        2 : GL_UNSIGNED_SHORT,
+        4 : GL_UNSIGNED_INT,
+    }
+    submeshes = []
+    index_chunks = []
+    index_offset = 0
+    for indices in arrays['indices']:
+        submeshes.append((index_offset, len(indices), index_types[indices.dtype.itemsize]))
+        chunk = np.zeros((indices.nbytes + 3) // 4 * 4, np.uint8)
+        chunk[:indices.nbytes] = np.ascontiguousarray(indices).view(np.uint8)
+        index_chunks.append(chunk)
+        index_offset += len(chunk)
+    indices = np.concatenate(index_chunks) if index_chunks else np.zeros(4, np.uint8)
+    
+    def load_staging_buffer(array):
+        buffer = gl_buffer(GL_INT, 1)
+        glGenBuffers(1, buffer)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, buffer[0])
+        glBufferData(GL_COPY_WRITE_BUFFER, array.nbytes, array.ctypes.data_as(ctypes.c_void_p), GL_STREAM_COPY)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        return buffer
+    
+    return {
+        'staging_vertices' : load_staging_buffer(vertices),
+        'staging_indices' : load_staging_buffer(indices),
+        'layout' : (stride, tuple(layout)),
+        'vertex_count' : vertex_count,
+        'submeshes' : submeshes,
+    }
+
+def setup_arena_mesh(name, buffers):
+    from Malt.GL.VertexArena import get_arena
+    arena = get_arena(buffers['layout'])
+    meshes = arena.load(buffers['staging_vertices'][0], buffers['staging_indices'][0],
+        buffers['vertex_count'], buffers['submeshes'])
+    load_version = next(_LOAD_VERSIONS)
+    for mesh, bounds in zip(meshes, buffers['bounds']):
+        mesh.bounds = bounds
+        mesh.load_version = load_version
+    glDeleteBuffers(1, buffers['staging_vertices'])
+    glDeleteBuffers(1, buffers['staging_indices'])
+    previous = MESHES.get(name)
+    MESHES[name] = meshes
+    if previous:
+        #Free the replaced mesh before checking fragmentation
+        previous = None
+        arena.compact()
 
-    positions = load_VBO(data['positions'])
-    normals = load_VBO(data['normals'])
-    tangents = load_VBO(data['tangents']) if data['tangents'] else None
-    uvs = [load_VBO(e) for e in data['uvs']]
-    colors = [load_VBO(e) if e else None for e in data['colors']]
+def setup_mesh(name, buffers):
+    #VAOs can't be shared between contexts, so this must run from the render context
+    if 'staging_vertices' in buffers:
+        return setup_arena_mesh(name, buffers)
+    formats = buffers['formats']
+    positions = buffers['positions']
+    normals = buffers['normals']
+    tangents = buffers['tangents']
+    uvs = buffers['uvs']
+    colors = buffers['colors']
+    load_version = next(_LOAD_VERSIONS)
+    meshes = []
 
-    for i, indices in enumerate(data['indices']):
+    for i, EBO in enumerate(buffers['EBOs']):
         result = Mesh.MeshCustomLoad()
         
         result.VAO = gl_buffer(GL_INT, 1)
         glGenVertexArrays(1, result.VAO)
         glBindVertexArray(result.VAO[0])
         
-        result.EBO = gl_buffer(GL_INT, 1)
-        glGenBuffers(1, result.EBO)
+        result.EBO = EBO
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, result.EBO[0])
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.size_in_bytes(), indices.buffer(), GL_STATIC_DRAW)
         
-        result.index_count = data['indices_lengths'][i]
+        result.index_count = buffers['index_counts'][i]
+        result.index_type = buffers['index_type']
+        result.bounds = buffers['bounds'][i]
+        result.load_version = load_version
 
         result.position = positions
         result.normal = normals
@@ -43,19 +419,17 @@ def load_mesh(msg):
         result.uvs = uvs
         result.colors = colors
 
-        def bind_VBO(VBO, index, element_size, gl_type=GL_FLOAT, gl_normalize=GL_FALSE):
+        def bind_VBO(VBO, index, format):
+            element_size, gl_type, gl_normalize, stride = format
             glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
             glEnableVertexAttribArray(index)
-            glVertexAttribPointer(index, element_size, gl_type, gl_normalize, 0, None)
+            glVertexAttribPointer(index, element_size, gl_type, gl_normalize, stride, None)
         
-        bind_VBO(result.position, 0, 3)
-        if data['positions'].size_in_bytes() == data['normals'].size_in_bytes():
-            bind_VBO(result.normal, 1, 3)
-        else:
-            bind_VBO(result.normal, 1, 3, GL_SHORT, GL_TRUE)
+        bind_VBO(result.position, 0, (3, GL_FLOAT, GL_FALSE, 0))
+        bind_VBO(result.normal, 1, formats['normal'])
         
         if tangents:
-            bind_VBO(tangents, 2, 4)
+            bind_VBO(tangents, 2, formats['tangent'])
         
         max_uv = 4
         max_vertex_colors = 4
@@ -65,19 +439,18 @@ def load_mesh(msg):
             if i >= max_uv:
                 LOG.warning('{} : UV count exceeds max supported UVs ({})'.format(name, max_uv))
                 break
-            bind_VBO(uv, uv0_index + i, 2)
+            bind_VBO(uv, uv0_index + i, formats['uvs'][i])
         for i, color in enumerate(result.colors):
             if i >= max_vertex_colors:
                 LOG.warning('{} : Vertex Color Layer count exceeds max supported layers ({})'.format(name, max_uv))
                 break
             if color:
-                if data['colors'][i]._ctype == ctypes.c_uint8:
-                    bind_VBO(color, color0_index + i, 4, GL_UNSIGNED_BYTE, GL_TRUE)
-                if data['colors'][i]._ctype == ctypes.c_float:
-                    bind_VBO(color, color0_index + i, 4, GL_FLOAT)
+                bind_VBO(color, color0_index + i, formats['colors'][i])
 
         glBindVertexArray(0)
         
-        MESHES[name].append(result)
+        meshes.append(result)
+    
+    MESHES[name] = meshes
 
 
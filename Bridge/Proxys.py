@@ -12,8 +12,13 @@ class MeshProxy(Mesh):
     
     def resolve(self):
         import Bridge.Mesh
-        self.mesh = Bridge.Mesh.MESHES[self.name][self.submesh_index]
-        self.__dict__.update(self.mesh.__dict__)
+        #The mesh may be still loading (see Bridge.Loader)
+        if self.name in Bridge.Mesh.MESHES:
+            self.mesh = Bridge.Mesh.MESHES[self.name][self.submesh_index]
+            self.__dict__.update(self.mesh.__dict__)
+    
+    def __bool__(self):
+        return self.mesh is not None
     
     def __del__(self):
         pass
@@ -26,8 +31,13 @@ class TextureProxy(Texture):
     
     def resolve(self):
         import Bridge.Texture
-        self.texture = Bridge.Texture.TEXTURES[self.name]
-        self.__dict__.update(self.texture.__dict__)
+        #The texture may be still loading (see Bridge.Loader)
+        if self.name in Bridge.Texture.TEXTURES:
+            self.texture = Bridge.Texture.TEXTURES[self.name]
+            self.__dict__.update(self.texture.__dict__)
+    
+    def __bool__(self):
+        return self.texture is not None
     
     def __del__(self):
         pass
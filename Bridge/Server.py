@@ -127,6 +127,7 @@ class Viewport():
         self.resolution = None
         self.read_resolution = None
         self.scene = None
+        self.scene_objects = []
         self.bit_depth = bit_depth
         self.final_texture = None
         self.final_target = None
@@ -141,6 +142,11 @@ class Viewport():
         self.stat_cpu_frame_time = 0
         self.stat_time_start = 0
         self.stat_render_time = 0
+        self.stat_gl_calls_saved = 0
+        self.stat_culling = {}
+        self.stat_shadow_casters = {}
+        self.stat_shadow_cache = {}
+        self.stat_render_layers = {}
     
     def get_print_stats(self):
         return '\n'.join((
@@ -150,6 +156,12 @@ class Viewport():
             'Total Time : {:.3f} s'.format(self.stat_render_time),
             'Latency : {} frames'.format(len(self.pbos_active)),
             'Max Latency : {} frames'.format(self.stat_max_frame_latency),
+            'GL Calls Saved : {} per sample'.format(self.stat_gl_calls_saved),
+            'Culled Instances : {} / {} per sample'.format(self.stat_culling.get('Culled', 0), self.stat_culling.get('Instances', 0)),
+            'Shadow Maps Cached : {} / {} lights per sample'.format(self.stat_shadow_cache.get('Cached', 0),
+                self.stat_shadow_cache.get('Cached', 0) + self.stat_shadow_cache.get('Rendered', 0)),
+            *('Shadow Casters ({}) : {}'.format(light, count) for light, count in self.stat_shadow_casters.items()),
+            'Render Layers : {} / {} per sample'.format(self.stat_render_layers.get('Rendered', 0), self.stat_render_layers.get('Max', 0)),
         ))
     
     def setup(self, new_buffers, resolution, scene, scene_update, renderdoc_capture):
@@ -182,26 +194,57 @@ class Viewport():
         self.stat_time_start = time.perf_counter()
         
         if scene_update or self.scene is None:
-            for key, proxy in scene.proxys.items():
-                proxy.resolve()
-            
             for obj in scene.objects:
                 obj.matrix = (ctypes.c_float * 16)(*obj.matrix)
             
-            scene.batches = self.pipeline.build_scene_batches(scene.objects)
+            self.scene_objects = scene.objects
             self.scene = scene
+            self.resolve_scene()
         else:
             self.scene.camera = scene.camera
             self.scene.time = scene.time
             self.scene.frame = scene.frame
     
+    def resolve_scene(self):
+        for key, proxy in self.scene.proxys.items():
+            proxy.resolve()
+        #Skip objects whose mesh is still loading
+        self.scene.objects = [obj for obj in self.scene_objects if obj.mesh.mesh]
+        self.scene.batches = self.pipeline.build_scene_batches(self.scene.objects)
+    
+    def refresh_resources(self):
+        #Called when the loader publishes new meshes or textures
+        if self.scene is None:
+            return
+        self.resolve_scene()
+        self.sample_index = 0
+        self.is_new_frame = True
+        self.needs_more_samples = True
+    
     def render(self):
         from . import renderdoc
         if self.renderdoc_capture:
             renderdoc.capture_start()
 
         if self.needs_more_samples:
+            from Malt.GL.Shader import BIND_STATS
+            from Malt.Render.Culling import CULLING_STATS, SHADOW_CASTERS_STATS
+            BIND_STATS['GL Calls Saved'] = 0
+            for key in CULLING_STATS.keys():
+                CULLING_STATS[key] = 0
+            SHADOW_CASTERS_STATS.clear()
+            from Malt.Render.Lighting import SHADOW_CACHE_STATS
+            for key in SHADOW_CACHE_STATS.keys():
+                SHADOW_CACHE_STATS[key] = 0
+            from Malt.Pipeline import RENDER_LAYERS_STATS
+            for key in RENDER_LAYERS_STATS.keys():
+                RENDER_LAYERS_STATS[key] = 0
             result = self.pipeline.render(self.resolution, self.scene, self.is_final_render, self.is_new_frame)
+            self.stat_gl_calls_saved = BIND_STATS['GL Calls Saved']
+            self.stat_culling = dict(CULLING_STATS)
+            self.stat_shadow_casters = dict(SHADOW_CASTERS_STATS)
+            self.stat_shadow_cache = dict(SHADOW_CACHE_STATS)
+            self.stat_render_layers = dict(RENDER_LAYERS_STATS)
             if self.final_texture:
                 self.pipeline.copy_textures(self.final_target, [result['COLOR']])
                 result = { 'COLOR' : self.final_texture }
@@ -249,6 +292,8 @@ class Viewport():
 
 
 PROFILE = False
+#Load meshes and textures from a background thread (see Bridge.Loader)
+USE_LOADER_THREAD = True
 
 def main(pipeline_path, viewport_bit_depth, connection_addresses,
     shared_dic, lock, log_path, debug_mode, plugins_paths, docs_path):
@@ -279,6 +324,16 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
     glfw.swap_interval(0)
 
     log_system_info()
+
+    loader = None
+    if USE_LOADER_THREAD:
+        try:
+            from .Loader import ResourceLoader
+            loader = ResourceLoader(window)
+        except:
+            import traceback
+            LOG.warning('Loading resources from the main thread')
+            LOG.warning(traceback.format_exc())
     
     LOG.info('INIT PIPELINE: ' + pipeline_path)
 
@@ -315,6 +370,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
     })
 
     viewports = {}
+    pending_materials = []
     last_exception = ''
     repeated_exception = 0
 
@@ -362,7 +418,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     for type in graph_types:
                         pipeline.graphs[type].setup_reflection()
                     for viewport in viewports.values():
-                        viewport.pipeline.graphs = pipeline.graphs
+                        viewport.pipeline.graphs = dict(pipeline.graphs)
                     graphs = pipeline.get_graphs()
                     connections['REFLECTION'].send(graphs)
 
@@ -374,21 +430,24 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     path = msg['path']
                     search_paths = msg['search_paths']
                     custom_passes = msg['custom_passes']
-                    material = Bridge.Material.Material(path, pipeline, search_paths, custom_passes)
-                    connections['MAIN'].send({
-                        'msg_type': 'MATERIAL',
-                        'material' : material
-                    })
+                    material = Bridge.Material.Material(path, pipeline, search_paths, custom_passes, deferred=True)
+                    pending_materials.append(material)
                 
                 if msg['msg_type'] == 'MESH':
                     msg_log = copy.copy(msg)
                     msg_log['data'] = None
                     LOG.debug('LOAD MESH : {}'.format(msg_log))
-                    Bridge.Mesh.load_mesh(msg)
+                    if loader:
+                        loader.load(msg)
+                    else:
+                        Bridge.Mesh.load_mesh(msg)
                 
                 if msg['msg_type'] == 'TEXTURE':
                     LOG.debug('LOAD TEXTURE : {}'.format(msg))
-                    Bridge.Texture.load_texture(msg)
+                    if loader:
+                        loader.load(msg)
+                    else:
+                        Bridge.Texture.load_texture(msg)
                 
                 if msg['msg_type'] == 'GRADIENT':
                     msg_log = copy.copy(msg)
@@ -399,6 +458,13 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     nearest = msg['nearest']
                     Bridge.Texture.load_gradient(name, pixels, nearest)
                 
+                if msg['msg_type'] == 'FREE VIEWPORT':
+                    LOG.debug('FREE VIEWPORT : {}'.format(msg))
+                    #Release the viewport pipeline instance and its render targets
+                    viewports.pop(msg['viewport_id'], None)
+                    for key in ('SETUP', 'FINISHED', 'READ_RESOLUTION'):
+                        shared_dic.pop((msg['viewport_id'], key), None)
+                
                 if msg['msg_type'] == 'RENDER':
                     LOG.debug('SETUP RENDER : {}'.format(msg))
                     viewport_id = msg['viewport_id']
@@ -410,15 +476,33 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
 
                     if viewport_id not in viewports:
                         bit_depth = viewport_bit_depth if viewport_id != 0 else 32
-                        viewports[viewport_id] = Viewport(pipeline_class(plugins), viewport_id == 0, bit_depth)
+                        viewports[viewport_id] = Viewport(pipeline.create_shared_instance(), viewport_id == 0, bit_depth)
 
                     viewports[viewport_id].setup(new_buffers, resolution, scene, scene_update, renderdoc_capture)
                     shared_dic[(viewport_id, 'FINISHED')] = False
                     shared_dic[(viewport_id, 'SETUP')] = True
             
+            if loader and loader.publish():
+                for viewport in viewports.values():
+                    viewport.refresh_resources()
+            
+            #Stream back materials as soon as their shaders finish compiling
+            for material in [*pending_materials]:
+                if material.is_ready():
+                    pending_materials.remove(material)
+                    material.finish_compilation()
+                    connections['MAIN'].send({
+                        'msg_type': 'MATERIAL',
+                        'material' : material
+                    })
+
             active_viewports = {}
             render_finished = True
             for v_id, v in viewports.items():
+                if v.is_final_render and loader and loader.pending_count > 0:
+                    #Final renders wait until every resource is loaded
+                    render_finished = False
+                    continue
                 if v.needs_more_samples:
                     active_viewports[v_id] = v
                 has_finished = v.render()
@@ -438,6 +522,10 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                 stats = ''
                 for v_id, v in active_viewports.items():
                     stats += "Viewport ({}):\n{}\n\n".format(v_id, v.get_print_stats())
+                from Malt.GL.Shader import CACHE_STATS
+                stats += "Shader Cache:\n{}\n\n".format('\n'.join('{} : {}'.format(key, value) for key, value in CACHE_STATS.items()))
+                if loader:
+                    stats += "Loader:\nPending Resources : {}\n\n".format(loader.pending_count)
                 shared_dic['STATS'] = stats
                 LOG.debug('STATS: {} '.format(stats))
             
@@ -464,5 +552,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     LOG.error('(Repeated {}+ times)'.format(repeated_exception))
                 repeated_exception += 1
 
+    if loader:
+        loader.stop()
     glfw.terminate()
 
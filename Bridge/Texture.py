@@ -1,10 +1,17 @@
+import itertools
+
 from Malt.GL import Texture
 from Malt.GL.GL import *
 
 TEXTURES = {}
 
+#Every (re)loaded texture gets a new load_version, since edited images keep their name (see SceneLighting shadow caching)
+_LOAD_VERSIONS = itertools.count(1)
+
 def load_texture(msg):
-    name = msg['name']
+    TEXTURES[msg['name']] = upload_texture(msg)
+
+def upload_texture(msg):
     data = msg['buffer'].buffer()
     resolution = msg['resolution']
     channels = msg['channels']
@@ -32,12 +39,16 @@ def load_texture(msg):
             internal_format = GL_SRGB
 
     #Nearest + Anisotropy seems to yield the best results with temporal super sampling
-    TEXTURES[name] = Texture.Texture(resolution, internal_format, GL_FLOAT, data, pixel_format=pixel_format, 
+    texture = Texture.Texture(resolution, internal_format, GL_FLOAT, data, pixel_format=pixel_format, 
         wrap=GL_REPEAT, min_filter=GL_NEAREST_MIPMAP_NEAREST, build_mipmaps=True, anisotropy=True)
+    texture.load_version = next(_LOAD_VERSIONS)
+    return texture
 
 GRADIENTS = {}
 
 def load_gradient(name, pixels, nearest):
-    GRADIENTS[name] = Texture.Gradient(pixels, len(pixels)/4, nearest_interpolation=nearest)
+    gradient = Texture.Gradient(pixels, len(pixels)/4, nearest_interpolation=nearest)
+    gradient.load_version = next(_LOAD_VERSIONS)
+    GRADIENTS[name] = gradient
 
 
@@ -1,7 +1,7 @@
 def reload():
     import importlib
-    from . import Client_API, Server, Material, Mesh, Texture
-    for module in [ Client_API, Server, Material, Mesh, Texture ]:
+    from . import Client_API, Server, Loader, Material, Mesh, Texture
+    for module in [ Client_API, Server, Loader, Material, Mesh, Texture ]:
         importlib.reload(module)
 
 def start_server(pipeline_path, viewport_bit_depth, connection_addresses, 
@@ -0,0 +1,18 @@
+import os, ctypes, platform
+
+src_dir = os.path.abspath(os.path.dirname(__file__))
+
+library = 'libMeshOptimizer.so'
+if platform.system() == 'Windows': library = 'MeshOptimizer.dll'
+if platform.system() == 'Darwin': library = 'libMeshOptimizer.dylib'
+
+MeshOptimizer = ctypes.CDLL(os.path.join(src_dir, library))
+
+tipsify = MeshOptimizer['tipsify']
+tipsify.argtypes = [
+    ctypes.c_void_p, ctypes.c_int64,
+    ctypes.c_void_p, ctypes.c_void_p,
+    ctypes.c_int64, ctypes.c_int64,
+    ctypes.c_void_p,
+]
+tipsify.restype = ctypes.c_int
@@ -0,0 +1,99 @@
+#include <stdint.h>
+#include <stdlib.h>
+
+#ifdef _WIN32
+#define EXPORT __declspec( dllexport )
+#else
+#define EXPORT __attribute__ ((visibility ("default")))
+#endif
+
+/*
+Reorder triangles for post-transform vertex cache locality.
+Sander, Nehab and Barczak, Fast Triangle Reordering for Vertex Locality and Reduced Overdraw (2007)
+adjacency lists the triangles of each vertex, from adjacency_offsets[v] to adjacency_offsets[v+1].
+Writes the new triangle order to out_order. Returns 0 on success, or -1 if it runs out of memory.
+*/
+EXPORT int tipsify(const uint32_t* triangles, int64_t triangle_count, const int64_t* adjacency_offsets, const uint32_t* adjacency,
+    int64_t vertex_count, int64_t cache_size, uint32_t* out_order)
+{
+    int64_t* live = (int64_t*)malloc(sizeof(int64_t) * vertex_count);
+    int64_t* cache_time = (int64_t*)calloc(vertex_count, sizeof(int64_t));
+    uint8_t* emitted = (uint8_t*)calloc(triangle_count, 1);
+    int64_t* dead_end = (int64_t*)malloc(sizeof(int64_t) * triangle_count * 3);
+    int64_t* candidates = (int64_t*)malloc(sizeof(int64_t) * triangle_count * 3);
+    if (!live || !cache_time || !emitted || !dead_end || !candidates)
+    {
+        free(live); free(cache_time); free(emitted); free(dead_end); free(candidates);
+        return -1;
+    }
+
+    for (int64_t v = 0; v < vertex_count; v++)
+    {
+        live[v] = adjacency_offsets[v+1] - adjacency_offsets[v];
+    }
+
+    int64_t output_count = 0;
+    int64_t dead_end_count = 0;
+    int64_t time = cache_size + 1;
+    int64_t cursor = 0;
+    int64_t fan = triangle_count > 0 ? triangles[0] : -1;
+
+    while (fan >= 0)
+    {
+        int64_t candidate_count = 0;
+        for (int64_t i = adjacency_offsets[fan]; i < adjacency_offsets[fan+1]; i++)
+        {
+            uint32_t t = adjacency[i];
+            if (emitted[t]) continue;
+            emitted[t] = 1;
+            out_order[output_count++] = t;
+            for (int c = 0; c < 3; c++)
+            {
+                int64_t v = triangles[t*3+c];
+                dead_end[dead_end_count++] = v;
+                candidates[candidate_count++] = v;
+                live[v]--;
+                if (time - cache_time[v] > cache_size)
+                {
+                    cache_time[v] = time;
+                    time++;
+                }
+            }
+        }
+
+        /* Prefer the candidates that will still be in cache after emitting all their triangles */
+        fan = -1;
+        int64_t best = -1;
+        for (int64_t i = 0; i < candidate_count; i++)
+        {
+            int64_t v = candidates[i];
+            if (live[v] > 0)
+            {
+                int64_t priority = 0;
+                if (time - cache_time[v] + 2 * live[v] <= cache_size)
+                {
+                    priority = time - cache_time[v];
+                }
+                if (priority > best)
+                {
+                    best = priority;
+                    fan = v;
+                }
+            }
+        }
+
+        while (fan == -1 && dead_end_count > 0)
+        {
+            int64_t v = dead_end[--dead_end_count];
+            if (live[v] > 0) fan = v;
+        }
+        while (fan == -1 && cursor < vertex_count)
+        {
+            if (live[cursor] > 0) fan = cursor;
+            else cursor++;
+        }
+    }
+
+    free(live); free(cache_time); free(emitted); free(dead_end); free(candidates);
+    return 0;
+}
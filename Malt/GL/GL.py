@@ -18,6 +18,10 @@ NULL = None
 GL_ENUMS = {}
 GL_NAMES = {}
 
+#(texture target, texture id) bound to each texture unit by Shader.bind.
+#Code that binds or deletes textures outside of Shader.bind must clear it.
+TEXTURE_UNIT_BINDINGS = {}
+
 if True: #create new scope to import OpenGL
     from OpenGL import GL
     for e in dir(GL):
@@ -47,6 +51,20 @@ class DrawQuery():
     def end_conditional_draw(self):
         glEndConditionalRender()
     
+    def get_result(self):
+        #Waits until the query result is available
+        result = gl_buffer(GL_UNSIGNED_INT, 1)
+        glGetQueryObjectuiv(self.query[0], GL_QUERY_RESULT, result)
+        return result[0]
+    
+    def get_result_no_wait(self):
+        #Returns None if the query result is not available yet
+        available = gl_buffer(GL_UNSIGNED_INT, 1)
+        glGetQueryObjectuiv(self.query[0], GL_QUERY_RESULT_AVAILABLE, available)
+        if available[0] == GL_FALSE:
+            return None
+        return self.get_result()
+    
 
 def gl_buffer(type, size, data=None):
     types = {
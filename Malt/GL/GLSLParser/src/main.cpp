@@ -1,6 +1,12 @@
 #include <string>
 #include <map>
 #include <iostream>
+#include <cstring>
+
+#ifdef _WIN32
+#include <io.h>
+#include <fcntl.h>
+#endif
 
 #include <tao/pegtl.hpp>
 #include <tao/pegtl/contrib/analyze.hpp>
@@ -170,17 +176,13 @@ std::string remove_extra_whitespace(const std::string& str)
     return result;
 }
 
-int main(int argc, char* argv[])
+template<typename Input>
+bool reflect(Input& input, std::string& output)
 {
-    if(argc < 2) return 1;
-    const char* path = argv[1];
-
-    file_input input(path);
-    
     #ifdef _DEBUG
     {
         const std::size_t issues = analyze<GLSL_GRAMMAR>();
-        if(issues) return issues;
+        if(issues) return false;
     }
     #endif
 
@@ -189,7 +191,7 @@ int main(int argc, char* argv[])
     
     auto root = parse_tree::parse<GLSL_GRAMMAR, selector>(input);
     input.restart();
-    if(!root) return 1;
+    if(!root) return false;
 
     //print_nodes(*root);
     //parse_tree::print_dot(std::cout, *root);
@@ -350,7 +352,74 @@ int main(int argc, char* argv[])
     PrettyWriter<StringBuffer> writer(result);
     json.Accept(writer);
 
-    std::cout << result.GetString();
+    output = result.GetString();
+
+    return true;
+}
+
+/*
+Server mode (--server)
+Reads sources from stdin and writes their reflection to stdout, until stdin is closed.
+Each message is prefixed by its size in bytes, followed by a new line.
+A size of 0 is returned when parsing fails.
+*/
+int run_server()
+{
+    #ifdef _WIN32
+    {
+        _setmode(_fileno(stdin), _O_BINARY);
+        _setmode(_fileno(stdout), _O_BINARY);
+    }
+    #endif
+
+    std::ios::sync_with_stdio(false);
+
+    std::string header;
+    std::string source;
+    while(std::getline(std::cin, header))
+    {
+        if(header.empty()) continue;
+        std::size_t size = std::stoull(header);
+        source.resize(size);
+        if(size > 0 && !std::cin.read(&source[0], size)) return 1;
+
+        std::string output;
+        bool success = false;
+        try
+        {
+            memory_input<> input(source.data(), source.size(), "src");
+            success = reflect(input, output);
+        }
+        catch(...)
+        {
+            success = false;
+        }
+        if(!success) output = "";
+
+        std::cout << output.size() << "\n" << output;
+        std::cout.flush();
+    }
+
+    return 0;
+}
+
+int main(int argc, char* argv[])
+{
+    if(argc < 2) return 1;
+
+    if(std::strcmp(argv[1], "--server") == 0)
+    {
+        return run_server();
+    }
+
+    const char* path = argv[1];
+
+    file_input input(path);
+    
+    std::string output;
+    if(!reflect(input, output)) return 1;
+
+    std::cout << output;
 
     return 0;
 }
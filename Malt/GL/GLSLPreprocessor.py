@@ -0,0 +1,666 @@
+import os, re
+
+# In-process C preprocessor for GLSL sources.
+# Supports the subset of mcpp features Malt relies on:
+# #include resolution, object and function-like macros (including # and ##), conditional compilation,
+# comment preservation and #line directives, so the output can be used interchangeably with shader_preprocessor.
+
+class GLSLPreprocessorError(Exception):
+    pass
+
+
+_TOKEN_RE = re.compile(r'''
+    (?P<comment>/\*.*?(?:\*/|$)|//.*)|
+    (?P<space>\s+)|
+    (?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|
+    (?P<number>\.?[0-9](?:[eEpP][+-]|[0-9A-Za-z_.])*)|
+    (?P<identifier>[A-Za-z_][A-Za-z_0-9]*)|
+    (?P<punctuator>\#\#|<<=|>>=|\.\.\.|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^]=|.)
+''', re.VERBOSE | re.DOTALL)
+
+_IDENTIFIER_RE = re.compile(r'\b[A-Za-z_][A-Za-z_0-9]*')
+_DIRECTIVE_RE = re.compile(r'\s*#\s*([A-Za-z_]*)(.*)', re.DOTALL)
+
+_EMPTY_HIDESET = frozenset()
+_BUILTIN_MACROS = ('__LINE__', '__FILE__')
+
+# Maximum number of blank lines emitted to keep line numbers in sync before falling back to a #line directive
+_MAX_BLANK_LINES = 8
+_MAX_INCLUDE_DEPTH = 200
+
+
+class Token():
+    __slots__ = ('text', 'kind', 'hideset')
+
+    def __init__(self, text, kind, hideset=_EMPTY_HIDESET):
+        self.text = text
+        self.kind = kind
+        self.hideset = hideset
+
+    def copy(self, hideset):
+        return Token(self.text, self.kind, hideset)
+
+
+_SPACE = Token(' ', 'space')
+
+
+def tokenize(text):
+    return [Token(match.group(), match.lastgroup) for match in _TOKEN_RE.finditer(text)]
+
+
+def split_comments(line, in_comment):
+    #Returns a list of (is_comment, text) segments and the comment state at the end of the line
+    segments = []
+    start = 0
+    if in_comment:
+        end = line.find('*/')
+        if end == -1:
+            return [(True, line)], True
+        segments.append((True, line[:end+2]))
+        start = end + 2
+    i = start
+    while True:
+        i = line.find('/', i)
+        if i == -1 or i + 1 >= len(line):
+            break
+        next_char = line[i+1]
+        if next_char == '/':
+            if i > start: segments.append((False, line[start:i]))
+            segments.append((True, line[i:]))
+            return segments, False
+        if next_char == '*':
+            if i > start: segments.append((False, line[start:i]))
+            end = line.find('*/', i+2)
+            if end == -1:
+                segments.append((True, line[i:]))
+                return segments, True
+            segments.append((True, line[i:end+2]))
+            start = i = end + 2
+            continue
+        i += 1
+    if start < len(line):
+        segments.append((False, line[start:]))
+    return segments, False
+
+
+_DIRECTIVE = 0
+_TEXT = 1
+
+_PARSED_SOURCES = {}
+
+def parse_source(source):
+    #Splits the source into directive and text lines, taking line splicing and multi-line comments into account.
+    #The result only depends on the source text, so it's cached across preprocessor runs.
+    #Returns the parsed lines and the include guard macro of the source (if any).
+    if source in _PARSED_SOURCES:
+        return _PARSED_SOURCES[source]
+    
+    lines = source.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    line_count = len(lines)
+    result = []
+    in_comment = False
+    #Track conditional nesting to detect include guards
+    depth = 0
+    guard = None
+    guard_closed = False
+
+    i = 0
+    while i < line_count:
+        line_number = i + 1
+        line = lines[i]
+        i += 1
+        while line.endswith('\\') and i < line_count:
+            line = line[:-1] + lines[i]
+            i += 1
+
+        if in_comment == False and line.lstrip().startswith('#'):
+            segments, in_comment = split_comments(line, False)
+            while in_comment and i < line_count:
+                line += '\n' + lines[i]
+                i += 1
+                segments, in_comment = split_comments(line, False)
+            code = ' '.join(text for is_comment, text in segments if not is_comment)
+            comments = ''.join(text for is_comment, text in segments if is_comment)
+            name, arguments = _DIRECTIVE_RE.match(code).groups()
+            arguments = arguments.strip()
+            result.append((_DIRECTIVE, line_number, name, arguments, comments, code))
+
+            if guard_closed or (guard is None and len(result) > 1):
+                guard = False
+            if name in ('if', 'ifdef', 'ifndef'):
+                if guard is None:
+                    guard = arguments if name == 'ifndef' else False
+                depth += 1
+            elif name == 'endif':
+                depth -= 1
+                if depth == 0: guard_closed = True
+            elif depth == 0:
+                guard = False
+        else:
+            segments, in_comment = split_comments(line, in_comment)
+            segments = tuple(segments)
+            identifiers = []
+            has_code = False
+            for is_comment, text in segments:
+                if not is_comment:
+                    identifiers.extend(_IDENTIFIER_RE.findall(text))
+                    has_code = has_code or bool(text.strip())
+            if has_code:
+                if guard is None or guard_closed:
+                    guard = False
+                result.append((_TEXT, line_number, line, segments, frozenset(identifiers)))
+            elif segments:
+                result.append((_TEXT, line_number, line, segments, _EMPTY_HIDESET))
+
+    if guard_closed == False:
+        guard = False
+    
+    if len(_PARSED_SOURCES) > 1024:
+        _PARSED_SOURCES.clear()
+    _PARSED_SOURCES[source] = (result, guard or None)
+    return _PARSED_SOURCES[source]
+
+
+class _IncompleteMacroCall(Exception):
+    pass
+
+
+class Macro():
+
+    def __init__(self, name, parameters, body):
+        self.name = name
+        self.parameters = parameters #None for object-like macros
+        self.body = body
+
+    @classmethod
+    def from_definition(cls, definition):
+        match = re.match(r'\s*([A-Za-z_][A-Za-z_0-9]*)(\(([^)]*)\))?(.*)', definition, re.DOTALL)
+        if match is None:
+            raise GLSLPreprocessorError('Invalid macro definition : ' + definition)
+        name, has_parameters, parameters, body = match.groups()
+        if has_parameters is not None:
+            parameters = [p.strip() for p in parameters.split(',')]
+            if parameters == ['']:
+                parameters = []
+        else:
+            parameters = None
+        body = [t for t in tokenize(body.strip()) if t.kind != 'comment']
+        #Collapse whitespace inside the body
+        collapsed = []
+        for token in body:
+            if token.kind == 'space':
+                if collapsed and collapsed[-1].kind != 'space':
+                    collapsed.append(_SPACE)
+            else:
+                collapsed.append(token)
+        return Macro(name, parameters, collapsed)
+
+
+#Macros are never modified after definition, so they can be shared across preprocessor runs
+_MACRO_DEFINITIONS = {}
+
+
+class Preprocessor():
+
+    def __init__(self, include_directories=[], definitions=[]):
+        self.include_directories = include_directories
+        self.macros = {}
+        self.include_guards = {}
+        self.files = {}
+        #Include candidates that didn't exist. Creating any of them changes the result.
+        self.missing = set()
+        self.output = []
+        self.file = None
+        self.line = 0
+        for definition in definitions:
+            name, _, value = definition.partition('=')
+            self.define(name + ' ' + (value if _ else '1'))
+
+    def define(self, definition):
+        macro = _MACRO_DEFINITIONS.get(definition)
+        if macro is None:
+            macro = Macro.from_definition(definition)
+            if len(_MACRO_DEFINITIONS) > 8192:
+                _MACRO_DEFINITIONS.clear()
+            _MACRO_DEFINITIONS[definition] = macro
+        self.macros[macro.name] = macro
+
+    def error(self, message):
+        raise GLSLPreprocessorError('{}:{}: error: {}'.format(self.file, self.line, message))
+
+    def read_file(self, path):
+        if path not in self.files:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.files[path] = f.read()
+        return self.files[path]
+
+    def find_include(self, name, current_dir, quoted):
+        if os.path.isabs(name):
+            return name if os.path.isfile(name) else None
+        directories = self.include_directories
+        if quoted and current_dir is not None:
+            directories = [current_dir, *directories]
+        for directory in directories:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+            self.missing.add(os.path.normpath(path).replace('\\','/'))
+        return None
+
+    def process(self, source, path='src', current_dir=None, depth=0):
+        if depth > _MAX_INCLUDE_DEPTH:
+            self.error('#include nested too deeply')
+
+        parent_file, parent_line = self.file, self.line
+        self.file = path
+        output = self.output
+        macros = self.macros
+
+        lines, guard = parse_source(source)
+        line_count = len(lines)
+        #The source line that the next output line maps to
+        out_line = None
+        #Each entry is [parent_active, branch_taken, active]
+        conditionals = []
+        active = True
+
+        def sync(line):
+            if out_line is not None and 0 <= line - out_line <= _MAX_BLANK_LINES:
+                output.append('\n' * (line - out_line))
+            else:
+                output.append('#line {} "{}"\n'.format(line, path))
+
+        def emit_comments(comments):
+            nonlocal out_line
+            if comments:
+                sync(self.line)
+                output.append(comments + '\n')
+                out_line = self.line + comments.count('\n') + 1
+
+        i = 0
+        while i < line_count:
+            entry = lines[i]
+            i += 1
+            self.line = entry[1]
+
+            if entry[0] == _DIRECTIVE:
+                kind, line_number, name, arguments, comments, code = entry
+
+                if name in ('if', 'ifdef', 'ifndef'):
+                    if active:
+                        emit_comments(comments)
+                        if name == 'if':
+                            result = self.evaluate(arguments)
+                        else:
+                            result = arguments.split(' ')[0] in macros
+                            if name == 'ifndef': result = not result
+                        conditionals.append([active, result, result])
+                    else:
+                        conditionals.append([False, True, False])
+                    active = conditionals[-1][2]
+                    continue
+                if name in ('elif', 'else', 'endif'):
+                    if len(conditionals) == 0: self.error('#{} without #if'.format(name))
+                    conditional = conditionals[-1]
+                    if active:
+                        emit_comments(comments)
+                    if name == 'elif':
+                        if conditional[0] and not conditional[1]:
+                            conditional[2] = conditional[1] = self.evaluate(arguments)
+                        else:
+                            conditional[2] = False
+                    elif name == 'else':
+                        conditional[2] = conditional[0] and not conditional[1]
+                        conditional[1] = True
+                    else:
+                        conditionals.pop()
+                    active = conditionals[-1][2] if conditionals else True
+                    continue
+                if active == False:
+                    continue
+
+                emit_comments(comments)
+                if name == 'define':
+                    self.define(arguments)
+                elif name == 'undef':
+                    macros.pop(arguments, None)
+                elif name == 'include':
+                    if self.include(arguments, current_dir, depth):
+                        out_line = None
+                elif name == 'error':
+                    self.error('#error ' + arguments)
+                elif name in ('', 'warning'):
+                    pass
+                else:
+                    #Pass-through GLSL directives (#version, #extension, #pragma, #line ...)
+                    sync(line_number)
+                    output.append(code.strip() + '\n')
+                    out_line = line_number + 1
+                continue
+
+            if active == False:
+                continue
+
+            kind, line_number, line, segments, identifiers = entry
+
+            needs_expansion = False
+            for identifier in identifiers:
+                if identifier in macros or identifier in _BUILTIN_MACROS:
+                    needs_expansion = True
+                    break
+
+            if needs_expansion == False:
+                if out_line != line_number:
+                    sync(line_number)
+                output.append(line + '\n')
+                out_line = line_number + 1
+                continue
+
+            can_continue = True
+            while True:
+                tokens = []
+                for is_comment, text in segments:
+                    if is_comment:
+                        tokens.append(Token(text, 'comment'))
+                    else:
+                        tokens.extend(tokenize(text))
+                try:
+                    line = ''.join(t.text for t in self.expand(tokens, can_continue))
+                    break
+                except _IncompleteMacroCall:
+                    #Function-like macro call arguments may span multiple lines
+                    if i >= line_count or lines[i][0] == _DIRECTIVE:
+                        can_continue = False
+                        continue
+                    segments = segments + ((False, ' '),) + lines[i][3]
+                    i += 1
+
+            sync(line_number)
+            output.append(line + '\n')
+            #Spliced lines are synced on the next sync call
+            out_line = line_number + line.count('\n') + 1
+
+        if conditionals:
+            self.error('Unterminated conditional directive')
+
+        if guard:
+            self.include_guards[path] = guard
+
+        self.file, self.line = parent_file, parent_line
+
+    def include(self, arguments, current_dir, depth):
+        if not arguments.startswith(('"','<')):
+            arguments = ''.join(t.text for t in self.expand(tokenize(arguments))).strip()
+        if len(arguments) < 2 or arguments[0] not in '"<' or arguments[-1] != {'"':'"', '<':'>'}[arguments[0]]:
+            self.error('Invalid #include directive : ' + arguments)
+        name = arguments[1:-1]
+        include_path = self.find_include(name, current_dir, arguments[0] == '"')
+        if include_path is None:
+            self.error('Can\'t open include file "{}"'.format(name))
+        include_path = os.path.normpath(include_path).replace('\\','/')
+        guard = self.include_guards.get(include_path)
+        if guard is not None and guard in self.macros:
+            return False
+        source = self.read_file(include_path)
+        self.process(source, include_path, os.path.dirname(include_path), depth + 1)
+        return True
+
+    def expand(self, tokens, can_continue=False):
+        macros = self.macros
+        result = []
+        stack = tokens[::-1]
+        while stack:
+            token = stack.pop()
+            if token.kind != 'identifier':
+                result.append(token)
+                continue
+            name = token.text
+            if name not in macros or name in token.hideset:
+                if name == '__LINE__':
+                    token = Token(str(self.line), 'number')
+                elif name == '__FILE__':
+                    token = Token('"{}"'.format(self.file), 'string')
+                result.append(token)
+                continue
+            macro = macros[name]
+            if macro.parameters is None:
+                hideset = token.hideset | {name}
+                replacement = self.substitute(macro, None, hideset)
+            else:
+                j = len(stack) - 1
+                while j >= 0 and stack[j].kind in ('space', 'comment'):
+                    j -= 1
+                if j < 0 or stack[j].text != '(':
+                    if j < 0 and can_continue:
+                        #The call parenthesis may be on the next line
+                        raise _IncompleteMacroCall()
+                    result.append(token)
+                    continue
+                arguments = [[]]
+                nesting = 0
+                k = j - 1
+                while True:
+                    if k < 0:
+                        if can_continue:
+                            raise _IncompleteMacroCall()
+                        self.error('Unterminated argument list invoking macro "{}"'.format(name))
+                    t = stack[k]
+                    if t.text == '(':
+                        nesting += 1
+                    elif t.text == ')':
+                        if nesting == 0:
+                            break
+                        nesting -= 1
+                    elif t.text == ',' and nesting == 0:
+                        arguments.append([])
+                        k -= 1
+                        continue
+                    arguments[-1].append(t)
+                    k -= 1
+                hideset = (token.hideset & stack[k].hideset) | {name}
+                del stack[k:]
+                arguments = [strip_spaces(a) for a in arguments]
+                parameters = macro.parameters
+                if len(parameters) == 0 and arguments == [[]]:
+                    arguments = []
+                if parameters and parameters[-1] == '...':
+                    variadic = len(parameters) - 1
+                    if len(arguments) > variadic:
+                        va_args = []
+                        for argument in arguments[variadic:]:
+                            if va_args: va_args.append(Token(',', 'punctuator'))
+                            va_args.extend(argument)
+                        arguments = arguments[:variadic] + [va_args]
+                    parameters = parameters[:-1] + ['__VA_ARGS__']
+                if len(arguments) != len(parameters):
+                    self.error('Macro "{}" expects {} arguments, but {} were given'.format(name, len(parameters), len(arguments)))
+                replacement = self.substitute(macro, dict(zip(parameters, arguments)), hideset)
+            stack.append(_SPACE)
+            stack.extend(replacement[::-1])
+            stack.append(_SPACE)
+        return result
+
+    def substitute(self, macro, arguments, hideset):
+        body = macro.body
+        if arguments is None:
+            return [t.copy(t.hideset | hideset) for t in body]
+        result = []
+        expanded = {}
+        i = 0
+        length = len(body)
+        while i < length:
+            token = body[i]
+            if token.text == '#' and i + 1 < length and body[i+1].text in arguments:
+                argument = arguments[body[i+1].text]
+                string = ''.join(t.text for t in argument).replace('\\','\\\\').replace('"','\\"')
+                result.append(Token('"{}"'.format(string), 'string'))
+                i += 2
+                continue
+            if token.kind == 'identifier' and token.text in arguments:
+                pasted = (i + 1 < length and next_significant(body, i, 1).text == '##') or \
+                    (i > 0 and next_significant(body, i, -1).text == '##')
+                if pasted:
+                    result.extend(arguments[token.text])
+                else:
+                    if token.text not in expanded:
+                        expanded[token.text] = self.expand(list(arguments[token.text]))
+                    result.extend(expanded[token.text])
+                i += 1
+                continue
+            result.append(token)
+            i += 1
+        #Token pasting
+        if any(t.text == '##' for t in result):
+            pasted = []
+            i = 0
+            while i < len(result):
+                token = result[i]
+                if token.text == '##' and pasted:
+                    while pasted and pasted[-1].kind == 'space': pasted.pop()
+                    i += 1
+                    while i < len(result) and result[i].kind == 'space': i += 1
+                    right = result[i].text if i < len(result) else ''
+                    left = pasted.pop().text if pasted else ''
+                    pasted.extend(tokenize(left + right))
+                else:
+                    pasted.append(token)
+                i += 1
+            result = pasted
+        return [t.copy(t.hideset | hideset) for t in result]
+
+    def evaluate(self, expression):
+        tokens = [t for t in tokenize(expression) if t.kind not in ('space', 'comment')]
+        #Resolve defined() before macro expansion
+        resolved = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.text == 'defined':
+                if i + 1 < len(tokens) and tokens[i+1].text == '(':
+                    name = tokens[i+2].text if i + 2 < len(tokens) else ''
+                    i += 4
+                else:
+                    name = tokens[i+1].text if i + 1 < len(tokens) else ''
+                    i += 2
+                resolved.append(Token('1' if name in self.macros else '0', 'number'))
+                continue
+            resolved.append(token)
+            i += 1
+        tokens = [t for t in self.expand(resolved) if t.kind not in ('space', 'comment')]
+        try:
+            value, position = _ExpressionParser(tokens).parse()
+        except (IndexError, ValueError, ZeroDivisionError) as e:
+            self.error('Invalid #if expression : {} ({})'.format(expression, e))
+        return value != 0
+
+
+def strip_spaces(tokens):
+    start, end = 0, len(tokens)
+    while start < end and tokens[start].kind in ('space', 'comment'): start += 1
+    while end > start and tokens[end-1].kind in ('space', 'comment'): end -= 1
+    return tokens[start:end]
+
+
+def next_significant(tokens, index, direction):
+    index += direction
+    while 0 <= index < len(tokens) and tokens[index].kind == 'space':
+        index += direction
+    if 0 <= index < len(tokens):
+        return tokens[index]
+    return _SPACE
+
+
+_BINARY_OPERATORS = {
+    '||' : (1, lambda a, b: int(bool(a) or bool(b))),
+    '&&' : (2, lambda a, b: int(bool(a) and bool(b))),
+    '|' : (3, lambda a, b: a | b),
+    '^' : (4, lambda a, b: a ^ b),
+    '&' : (5, lambda a, b: a & b),
+    '==' : (6, lambda a, b: int(a == b)),
+    '!=' : (6, lambda a, b: int(a != b)),
+    '<' : (7, lambda a, b: int(a < b)),
+    '>' : (7, lambda a, b: int(a > b)),
+    '<=' : (7, lambda a, b: int(a <= b)),
+    '>=' : (7, lambda a, b: int(a >= b)),
+    '<<' : (8, lambda a, b: a << b),
+    '>>' : (8, lambda a, b: a >> b),
+    '+' : (9, lambda a, b: a + b),
+    '-' : (9, lambda a, b: a - b),
+    '*' : (10, lambda a, b: a * b),
+    '/' : (10, lambda a, b: int(a / b)),
+    '%' : (10, lambda a, b: a - int(a / b) * b),
+}
+
+
+class _ExpressionParser():
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    def parse(self):
+        value = self.conditional()
+        if self.i != len(self.tokens):
+            raise ValueError('Unexpected token "{}"'.format(self.tokens[self.i].text))
+        return value, self.i
+
+    def peek(self):
+        return self.tokens[self.i].text if self.i < len(self.tokens) else None
+
+    def conditional(self):
+        condition = self.binary(1)
+        if self.peek() == '?':
+            self.i += 1
+            a = self.conditional()
+            if self.peek() != ':':
+                raise ValueError('Expected ":"')
+            self.i += 1
+            b = self.conditional()
+            return a if condition else b
+        return condition
+
+    def binary(self, min_precedence):
+        left = self.unary()
+        while True:
+            operator = _BINARY_OPERATORS.get(self.peek())
+            if operator is None or operator[0] < min_precedence:
+                return left
+            self.i += 1
+            right = self.binary(operator[0] + 1)
+            left = operator[1](left, right)
+
+    def unary(self):
+        token = self.tokens[self.i]
+        self.i += 1
+        if token.text == '(':
+            value = self.conditional()
+            if self.peek() != ')':
+                raise ValueError('Expected ")"')
+            self.i += 1
+            return value
+        if token.text == '!': return int(not self.unary())
+        if token.text == '-': return -self.unary()
+        if token.text == '+': return self.unary()
+        if token.text == '~': return ~self.unary()
+        if token.kind == 'number':
+            text = token.text.rstrip('uUlL')
+            if len(text) > 1 and text[0] == '0' and text.isdigit():
+                return int(text, 8)
+            return int(text, 0)
+        if token.kind == 'identifier':
+            #Undefined identifiers evaluate to 0
+            return 0
+        raise ValueError('Unexpected token "{}"'.format(token.text))
+
+
+def preprocess(source, include_directories=[], definitions=[], dependencies=None, missing=None):
+    #If a dependencies dictionary is passed, it's filled with the path and content of every included file
+    #If a missing set is passed, it's filled with the include candidate paths that didn't exist
+    preprocessor = Preprocessor(include_directories, definitions)
+    preprocessor.process(source)
+    if dependencies is not None:
+        dependencies.update(preprocessor.files)
+    if missing is not None:
+        missing.update(preprocessor.missing)
+    return ''.join(preprocessor.output)
+
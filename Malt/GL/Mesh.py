@@ -12,16 +12,27 @@ class Mesh():
         self.colors = []
 
         self.index_count = len(index)
+        self.index_type = GL_UNSIGNED_INT
+        #Sub-allocated meshes only (see Malt.GL.VertexArena)
+        self.vertex_allocation = None
+        self.index_allocation = None
+        #Object space (min, max) bounds, used for culling
+        self.bounds = None
 
         self.VAO = None
         self.EBO = gl_buffer(GL_INT, 1)
         index_buffer = index
+        if len(position) // 3 <= 65536:
+            #16 bit indices are enough
+            self.index_type = GL_UNSIGNED_SHORT
+            if isinstance(index_buffer, ctypes.Array) == False or index_buffer._type_ != ctypes.c_uint16:
+                index_buffer = gl_buffer(GL_UNSIGNED_SHORT, len(index), index)
         #make sure it's an uint32 c array
-        if isinstance(index_buffer, ctypes.Array) == False or index_buffer._type_ != ctypes.c_uint32:
+        elif isinstance(index_buffer, ctypes.Array) == False or index_buffer._type_ != ctypes.c_uint32:
             index_buffer = gl_buffer(GL_UNSIGNED_INT, len(index), index)
         glGenBuffers(1, self.EBO)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.EBO[0])
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, len(index_buffer) * 4, index_buffer, GL_STATIC_DRAW)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, ctypes.sizeof(index_buffer), index_buffer, GL_STATIC_DRAW)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
         
         def load_VBO(data):
@@ -81,10 +92,17 @@ class Mesh():
             self.__load_VAO()
         glBindVertexArray(self.VAO[0])
     
+    def base_vertex(self):
+        return self.vertex_allocation.offset if self.vertex_allocation else 0
+    
+    def index_offset(self):
+        return self.index_allocation.offset if self.index_allocation else 0
+    
     def draw(self, bind=True):
         if bind:
             self.bind()
-        glDrawElements(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, NULL)
+        glDrawElementsBaseVertex(GL_TRIANGLES, self.index_count, self.index_type, 
+            ctypes.c_void_p(self.index_offset()), self.base_vertex())
         if bind:
             glBindVertexArray(0)
     
@@ -118,6 +136,11 @@ class MeshCustomLoad(Mesh):
         self.colors = []
 
         self.index_count = 0
+        self.index_type = GL_UNSIGNED_INT
+        self.vertex_allocation = None
+        self.index_allocation = None
+        #Object space (min, max) bounds, used for culling
+        self.bounds = None
 
         self.VAO = None
         self.EBO = None
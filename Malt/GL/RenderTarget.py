@@ -53,6 +53,10 @@ class RenderTarget():
     
     def clear(self, colors=[], depth=None, stencil=None):
         self.bind()
+        self.clear_buffers(colors, depth, stencil)
+    
+    def clear_buffers(self, colors=[], depth=None, stencil=None):
+        #Clears the currently bound buffers
         flags = 0
         for i, color in enumerate(colors):
             function_map = {
@@ -82,6 +86,42 @@ class RenderTarget():
         glDeleteFramebuffers(1, self.FBO)
 
 
+class RenderTargetRegion():
+    #A rectangle inside a RenderTarget (ie. a shadow atlas region).
+    #Rendering and clears are restricted to the region with the viewport and the scissor test.
+
+    def __init__(self, render_target, offset, resolution):
+        self.render_target = render_target
+        self.targets = render_target.targets
+        self.offset = offset
+        self.resolution = resolution
+    
+    def bind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.render_target.FBO[0])
+        glViewport(self.offset[0], self.offset[1], self.resolution[0], self.resolution[1])
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(self.offset[0], self.offset[1], self.resolution[0], self.resolution[1])
+    
+    def clear(self, colors=[], depth=None, stencil=None):
+        self.bind()
+        self.render_target.clear_buffers(colors, depth, stencil)
+
+
+class RenderTargetLayers():
+    #A range of layers of a layered RenderTarget (see LayeredTarget), selected from the shaders with gl_Layer.
+    #The layers can't be cleared separately, use per layer targets for that.
+
+    def __init__(self, render_target, layer_offset, layers_count):
+        self.render_target = render_target
+        self.targets = render_target.targets
+        self.resolution = render_target.resolution
+        self.layer_offset = layer_offset
+        self.layers_count = layers_count
+    
+    def bind(self):
+        self.render_target.bind()
+
+
 class TargetBase():
     def attach(self, attachment):
         pass
@@ -99,3 +139,15 @@ class ArrayLayerTarget(TargetBase):
     def attach(self, attachment):
         glFramebufferTextureLayer(GL_FRAMEBUFFER, attachment, self.texture_array, 0, self.layer)
 
+
+class LayeredTarget(TargetBase):
+    #Attaches all the layers of a texture array (or cubemap array faces)
+    def __init__(self, texture_array):
+        self.texture_array = texture_array.texture[0]
+        self.resolution = texture_array.resolution
+        self.internal_format = texture_array.internal_format
+        self.format = texture_array.format
+        self.data_format = texture_array.data_format
+    
+    def attach(self, attachment):
+        glFramebufferTexture(GL_FRAMEBUFFER, attachment, self.texture_array, 0)
@@ -6,24 +6,52 @@ from Malt.Utils import LOG
 
 class Shader():
 
-    def __init__(self, vertex_source, pixel_source):
+    def __init__(self, vertex_source, pixel_source, deferred=False, uniform_defaults={}, geometry_source=None):
+        #Deferred shaders are not usable until finish_compilation is called (see is_ready)
+        #uniform_defaults are the initialization expressions of uniforms inside MATERIAL_UNIFORM_BLOCK (see pack_material_uniforms)
+        #geometry_source is optional (ie. for layered rendering, see Common.glsl LAYERED_PASS)
+        self.compilation = None
+        self.program_key = None
+        self.uniform_defaults = uniform_defaults
+        self.material_block = None
+        self.geometry_source = geometry_source
+        #True if the material can move vertices outside the mesh bounds (see GLSLPipelineGraph.vertex_displacement_marker)
+        self.displaces_vertices = False
+        #The source of the shader _LAYERED variant, shared by all its copies (see GLSLPipelineGraph.get_layered_shader)
+        self.layered_variant = None
         if vertex_source and pixel_source:
             self.vertex_source = vertex_source
             self.pixel_source = pixel_source
-            self.program, self.error = compile_gl_program(vertex_source, pixel_source)
-            self.validator = glslang_validator(vertex_source,'vert')
-            self.validator += glslang_validator(pixel_source,'frag')
-            if self.validator == '':
-                self.validator = None
+            self.compilation = GLProgramCompilation(vertex_source, pixel_source, geometry_source)
+            self.program = self.compilation.program
+            self.error = None
         else:
             self.vertex_source = vertex_source
             self.pixel_source = pixel_source
             self.program = None
             self.error = 'NO SOURCE'
-            self.validator = None
+        self.validator = None
         self.uniforms = {}
         self.textures = {}
         self.uniform_blocks = {}
+        if deferred == False:
+            self.finish_compilation()
+    
+    def is_ready(self):
+        return self.compilation is None or self.compilation.is_ready()
+    
+    def finish_compilation(self):
+        if self.compilation is None:
+            return
+        self.program, self.error = self.compilation.finish()
+        self.program_key = self.compilation.cache_key
+        self.compilation = None
+        self.validator = glslang_validator(self.vertex_source,'vert')
+        self.validator += glslang_validator(self.pixel_source,'frag')
+        if self.geometry_source:
+            self.validator += glslang_validator(self.geometry_source,'geom')
+        if self.validator == '':
+            self.validator = None
         if self.error == '':
             self.error = None
             self.uniforms = reflect_program_uniforms(self.program)
@@ -35,43 +63,118 @@ class Shader():
                     self.textures[name] = None
 
             self.uniform_blocks = reflect_program_uniform_blocks(self.program)
+            
+            if MATERIAL_UNIFORM_BLOCK in self.uniform_blocks:
+                block_uniforms = reflect_program_block_uniforms(self.program, MATERIAL_UNIFORM_BLOCK)
+                from Malt.GL.GLSLEval import glsl_eval
+                for name, uniform in block_uniforms.items():
+                    if name in self.uniform_defaults:
+                        try:
+                            uniform.set_value(glsl_eval(self.uniform_defaults[name]))
+                        except:
+                            pass
+                self.uniforms.update(block_uniforms)
+                self.material_block = MaterialUniformBlock(self.uniform_blocks[MATERIAL_UNIFORM_BLOCK], block_uniforms)
         
     def bind(self):
-        glUseProgram(self.program)
+        #Only upload uniforms and bind textures that changed since the last bind
+        global _BOUND_PROGRAM
+        saved_calls = 0
+        if _BOUND_PROGRAM != self.program:
+            glUseProgram(self.program)
+            _BOUND_PROGRAM = self.program
+        else:
+            saved_calls += 1
+        
+        if self.program not in _PROGRAM_UNIFORM_STATE:
+            _PROGRAM_UNIFORM_STATE[self.program] = {}
+        uniform_state = _PROGRAM_UNIFORM_STATE[self.program]
         for uniform in self.uniforms.values():
+            if uniform.block_offset is not None:
+                continue
+            state = uniform_state.get(uniform.index)
+            if state:
+                if state[0] is uniform and state[1] == uniform.version:
+                    saved_calls += 1
+                    continue
+                #Shader copies share the same program, compare the actual values
+                data = bytes(uniform.value)
+                if state[2] == data:
+                    uniform_state[uniform.index] = (uniform, uniform.version, data)
+                    saved_calls += 1
+                    continue
             uniform.bind()
+            uniform_state[uniform.index] = (uniform, uniform.version, bytes(uniform.value))
+        
         for name, texture in self.textures.items():
             if name not in self.uniforms:
                 LOG.debug("Texture Uniform {} not found".format(name))
                 continue
             uniform = self.uniforms[name]
-            glActiveTexture(GL_TEXTURE0 + uniform.value[0])
+            unit = uniform.value[0]
+            texture_type = uniform.texture_type()
             if texture:
                 if hasattr(texture, 'bind'):
-                    texture.bind()
+                    binding = (texture_type, texture.texture[0])
                 else: #Then it's just a externally generated bind code
-                    glBindTexture(uniform.texture_type(), texture)
+                    binding = (texture_type, texture)
             else:
-                glBindTexture(uniform.texture_type(), 0)
+                binding = (texture_type, 0)
+            if TEXTURE_UNIT_BINDINGS.get(unit) == binding:
+                saved_calls += 2
+                continue
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(*binding)
+            TEXTURE_UNIT_BINDINGS[unit] = binding
+        
+        if self.material_block:
+            self.material_block.bind()
+        
+        BIND_STATS['GL Calls Saved'] += saved_calls
     
     def copy(self):
         new = Shader(None, None)
         new.vertex_source = self.vertex_source
         new.pixel_source = self.pixel_source
+        new.geometry_source = self.geometry_source
         new.program = self.program
+        new.program_key = self.program_key
+        if new.program_key:
+            acquire_program(new.program_key)
         new.error = self.error
+        new.displaces_vertices = self.displaces_vertices
+        new.layered_variant = self.layered_variant
         for name, uniform in self.uniforms.items():
             new.uniforms[name] = uniform.copy()
         for name, texture in self.textures.items():
             new.textures[name] = texture
         for name, block in self.uniform_blocks.items():
             new.uniform_blocks[name] = block
+        if self.material_block:
+            #Each copy gets its own buffer
+            new.material_block = MaterialUniformBlock(self.material_block.uniform_block,
+                { name : new.uniforms[name] for name in self.material_block.uniforms.keys() })
         
         return new
     
     def __del__(self):
-        #TODO: Programs are shared between Shaders. Should refcount them
-        pass
+        try:
+            if self.compilation:
+                self.compilation.discard()
+            if self.program_key:
+                release_program(self.program_key)
+        except:
+            #The GL context may be already gone at exit
+            pass
+
+
+# Uniform values last uploaded to each program, as {location : (uniform, version, data)}
+_PROGRAM_UNIFORM_STATE = {}
+_BOUND_PROGRAM = None
+
+BIND_STATS = {
+    'GL Calls Saved' : 0,
+}
 
 
 class GLUniform():
@@ -82,6 +185,11 @@ class GLUniform():
         self.array_length = array_length
         self.set_function = uniform_type_set_function(self.type)
         self.value = None
+        #Incremented on every change, so Shader.bind can skip unchanged uniforms
+        self.version = 0
+        #Layout inside its uniform block, if any (see MaterialUniformBlock)
+        self.block_offset = None
+        self.matrix_stride = 0
         self.set_value(value)
     
     def is_sampler(self):
@@ -98,6 +206,7 @@ class GLUniform():
             '_3D': GL_TEXTURE_3D,
             'CUBE_MAP_ARRAY': GL_TEXTURE_CUBE_MAP_ARRAY,
             '_CUBE_MAP': GL_TEXTURE_CUBE_MAP,
+            '_BUFFER': GL_TEXTURE_BUFFER,
         }
         name = GL_ENUMS[self.type]
         for key, value in table.items():
@@ -109,21 +218,79 @@ class GLUniform():
             try: value = max(0, value)
             except: value = [max(0, v) for v in value]
         self.value = gl_buffer(self.base_type, self.base_size * self.array_length, value)
+        self.version += 1
     
     def set_buffer(self, buffer):
         self.value = buffer
+        self.version += 1
     
     def bind(self, buffer=None):
         if buffer is None:
             buffer = self.value
+        else:
+            #The uploaded value no longer matches self.value, so the next Shader.bind must upload it again.
+            #(Comparing values isn't enough, since self.value didn't change)
+            uniform_state = _PROGRAM_UNIFORM_STATE.get(_BOUND_PROGRAM)
+            if uniform_state:
+                uniform_state.pop(self.index, None)
         self.set_function(self.index, self.array_length, buffer)
     
     def copy(self):
-        return GLUniform(
+        new = GLUniform(
             self.index,
             self.type, 
             self.value, 
             self.array_length)
+        new.block_offset = self.block_offset
+        new.matrix_stride = self.matrix_stride
+        return new
+
+
+MATERIAL_UNIFORM_BLOCK = 'MATERIAL_UNIFORMS'
+
+class MaterialUniformBlock():
+    #Packs a material uniforms into a std140 buffer, so they can be uploaded and bound with a single call.
+    #The layout (offsets and strides) comes from the program reflection.
+
+    def __init__(self, uniform_block, uniforms):
+        self.uniform_block = uniform_block
+        self.uniforms = uniforms
+        self.data = (ctypes.c_ubyte * uniform_block['size'])()
+        self.versions = None
+        self.UBO = UBO()
+    
+    def update(self):
+        versions = [uniform.version for uniform in self.uniforms.values()]
+        if versions == self.versions:
+            return False
+        self.versions = versions
+        import struct
+        formats = {
+            GL_FLOAT : 'f',
+            GL_DOUBLE : 'd',
+            GL_INT : 'i',
+            GL_UNSIGNED_INT : 'I',
+            GL_BOOL : 'i',
+        }
+        for uniform in self.uniforms.values():
+            format = formats[uniform.base_type]
+            values = list(uniform.value)
+            if uniform.base_type == GL_BOOL:
+                values = [int(bool(v)) for v in values]
+            if uniform.matrix_stride:
+                #Matrix columns are aligned to matrix_stride
+                rows = { 4 : 2, 9 : 3, 16 : 4 }[uniform.base_size]
+                for column in range(rows):
+                    struct.pack_into(f'<{rows}{format}', self.data, uniform.block_offset + column * uniform.matrix_stride,
+                        *values[column*rows:column*rows+rows])
+            else:
+                struct.pack_into(f'<{len(values)}{format}', self.data, uniform.block_offset, *values)
+        self.UBO.load_data(self.data)
+        return True
+    
+    def bind(self):
+        self.update()
+        self.UBO.bind(self.uniform_block)
 
 
 class UBO():
@@ -141,6 +308,18 @@ class UBO():
         glBindBuffer(GL_UNIFORM_BUFFER, self.buffer[0])
         glBufferData(GL_UNIFORM_BUFFER, self.size, ctypes.pointer(structure), GL_STREAM_DRAW)
         glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    
+    def allocate(self, size):
+        #Reserve storage to be updated with load_sub_data
+        self.size = size
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer[0])
+        glBufferData(GL_UNIFORM_BUFFER, self.size, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    
+    def load_sub_data(self, offset, size, address):
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer[0])
+        glBufferSubData(GL_UNIFORM_BUFFER, offset, size, ctypes.c_void_p(address))
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
 
     def bind(self, uniform_block):
         location = uniform_block['bind']
@@ -153,7 +332,120 @@ class UBO():
         glDeleteBuffers(1, self.buffer[0])
 
 
+USE_MCPP_PREPROCESSOR = False
+
 def shader_preprocessor(shader_source, include_directories=[], definitions=[]):
+    if USE_MCPP_PREPROCESSOR:
+        return mcpp_preprocessor(shader_source, include_directories, definitions)
+    
+    cache_key = preprocessor_cache_key(shader_source, include_directories, definitions)
+    cached = load_preprocessor_cache(cache_key)
+    if cached is not None:
+        return cached
+
+    from Malt.GL.GLSLPreprocessor import preprocess, GLSLPreprocessorError
+    try:
+        dependencies = {}
+        missing = set()
+        result = preprocess(shader_source + '\n', include_directories, definitions, dependencies, missing)
+    except GLSLPreprocessorError as e:
+        raise Exception(str(e))
+    except:
+        import traceback
+        LOG.error(traceback.format_exc())
+        LOG.warning('GLSL preprocessor failed. Falling back to mcpp.')
+        return mcpp_preprocessor(shader_source, include_directories, definitions)
+    
+    import hashlib
+    dependencies = { path : hashlib.sha1(text.encode('utf-8')).hexdigest() for path, text in dependencies.items() }
+    save_preprocessor_cache(cache_key, dependencies, missing, result)
+    return result
+
+
+# Preprocessed sources are cached by source, include directories and definitions.
+# Each entry stores the content hash of every file reached during inclusion,
+# so changing any of them invalidates the entry.
+# It also stores the include candidates that didn't exist,
+# so adding a file that shadows an include from a later directory invalidates it too.
+_PREPROCESSOR_CACHE = {}
+_FILE_HASHES = {}
+
+def preprocessor_cache_key(shader_source, include_directories, definitions):
+    import hashlib
+    key = '\0'.join([shader_source, *include_directories, '\0', *definitions])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def file_content_hash(path):
+    #Content hashes are memoized by file modification time and size
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _FILE_HASHES.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    import hashlib
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            content_hash = hashlib.sha1(f.read().encode('utf-8')).hexdigest()
+    except (OSError, UnicodeDecodeError):
+        return None
+    _FILE_HASHES[path] = (signature, content_hash)
+    return content_hash
+
+def load_preprocessor_cache(cache_key):
+    entry = _PREPROCESSOR_CACHE.get(cache_key)
+    if entry is None:
+        import json
+        data = get_preprocessor_cache().load_data(cache_key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+        except ValueError:
+            return None
+    for path, content_hash in entry['dependencies'].items():
+        if file_content_hash(path) != content_hash:
+            _PREPROCESSOR_CACHE.pop(cache_key, None)
+            return None
+    for path in entry.get('missing', []):
+        if os.path.isfile(path):
+            _PREPROCESSOR_CACHE.pop(cache_key, None)
+            return None
+    _PREPROCESSOR_CACHE[cache_key] = entry
+    return entry['source']
+
+def save_preprocessor_cache(cache_key, dependencies, missing, source):
+    entry = {
+        'dependencies' : dependencies,
+        'missing' : sorted(missing),
+        'source' : source,
+    }
+    if len(_PREPROCESSOR_CACHE) > 1024:
+        _PREPROCESSOR_CACHE.clear()
+    _PREPROCESSOR_CACHE[cache_key] = entry
+    import json
+    get_preprocessor_cache().store_data(cache_key, json.dumps(entry))
+
+def write_cache_file(path, data):
+    #Write to a temporary file first, so other threads/processes never read partial files
+    import threading
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        import traceback
+        LOG.warning(traceback.format_exc())
+        try: os.remove(tmp_path)
+        except OSError: pass
+
+
+def mcpp_preprocessor(shader_source, include_directories=[], definitions=[]):
     import tempfile, subprocess, sys, platform
     
     shader_source = shader_source + '\n'
@@ -257,40 +549,74 @@ def fix_line_directive_paths(source):
     return result
 
 
-def compile_gl_program(vertex, fragment):
-    status = gl_buffer(GL_INT,1)
-    info_log = gl_buffer(GL_BYTE, 1024)
-
-    hash_src = vertex + fragment
-    ''.splitlines()
-    hash_src = ''.join([line for line in hash_src.splitlines(True) if line.startswith('#line') == False])
-    import hashlib, tempfile
-    shader_hash = hashlib.sha1(hash_src.encode()).hexdigest()
-    cache_folder = os.path.join(tempfile.gettempdir(), 'MALT_SHADERS_CACHE')
-    os.makedirs(cache_folder, exist_ok=True)
-    cache_path = os.path.join(cache_folder, shader_hash+'.bin')
-    format_path = os.path.join(cache_folder, shader_hash+'.fmt')
-    cache, format = None, None
-    if os.path.exists(cache_path) and os.path.exists(format_path):
-        from pathlib import Path
-        Path(cache_path).touch()
-        with open(cache_path, 'rb') as f:
-            bin = f.read()
-            cache = (GLubyte*len(bin)).from_buffer_copy(bin)
-        Path(format_path).touch()
-        with open(format_path, 'rb') as f:
-            format = GLuint.from_buffer_copy(f.read())
-    
-    program = glCreateProgram()
-    error = ""
-
-    if cache:
-        glProgramBinary(program, format, cache, len(cache))
-        glGetProgramiv(program, GL_LINK_STATUS, status)
-        if status[0] != GL_FALSE:
-            return (program, error)
-
-    def compile_shader (source, shader_type):
+__PARALLEL_COMPILE_SUPPORT = None
+
+def parallel_compile_support():
+    #Returns the GL_COMPLETION_STATUS enum if the driver supports non-blocking shader compilation
+    global __PARALLEL_COMPILE_SUPPORT
+    if __PARALLEL_COMPILE_SUPPORT is not None:
+        return __PARALLEL_COMPILE_SUPPORT
+    __PARALLEL_COMPILE_SUPPORT = False
+    try:
+        if hasGLExtension('GL_KHR_parallel_shader_compile'):
+            from OpenGL.GL.KHR.parallel_shader_compile import GL_COMPLETION_STATUS_KHR, glMaxShaderCompilerThreadsKHR
+            glMaxShaderCompilerThreadsKHR(0xFFFFFFFF)
+            __PARALLEL_COMPILE_SUPPORT = GL_COMPLETION_STATUS_KHR
+        elif hasGLExtension('GL_ARB_parallel_shader_compile'):
+            from OpenGL.GL.ARB.parallel_shader_compile import GL_COMPLETION_STATUS_ARB, glMaxShaderCompilerThreadsARB
+            glMaxShaderCompilerThreadsARB(0xFFFFFFFF)
+            __PARALLEL_COMPILE_SUPPORT = GL_COMPLETION_STATUS_ARB
+    except:
+        import traceback
+        LOG.warning(traceback.format_exc())
+        __PARALLEL_COMPILE_SUPPORT = False
+    return __PARALLEL_COMPILE_SUPPORT
+
+
+class GLProgramCompilation():
+    #Submits the shaders to the driver without waiting for the compilation results.
+    #When parallel compilation is supported, is_ready can be polled to avoid blocking on finish.
+
+    def __init__(self, vertex, fragment, geometry=None):
+        hash_src = vertex + fragment + (geometry or '')
+        hash_src = ''.join([line for line in hash_src.splitlines(True) if line.startswith('#line') == False])
+        import hashlib
+        self.cache_key = hashlib.sha1((hash_src + '\0' + driver_signature()).encode()).hexdigest()
+        
+        self.shaders = []
+        self.from_cache = False
+        self.from_registry = self.cache_key in _PROGRAM_REGISTRY
+        if self.from_registry:
+            #Hold a reference until finish or discard, so the program can't be released while the compilation is pending
+            self.program = _PROGRAM_REGISTRY[self.cache_key]['program']
+            acquire_program(self.cache_key)
+            return
+        
+        self.program = glCreateProgram()
+
+        cache = get_program_cache().load(self.cache_key)
+        if cache:
+            format, bin = cache
+            bin = (GLubyte*len(bin)).from_buffer_copy(bin)
+            status = gl_buffer(GL_INT,1)
+            glProgramBinary(self.program, format, bin, len(bin))
+            glGetProgramiv(self.program, GL_LINK_STATUS, status)
+            if status[0] != GL_FALSE:
+                self.from_cache = True
+                return
+            get_program_cache().remove(self.cache_key)
+
+        self.shaders = [
+            self.compile_shader(vertex, GL_VERTEX_SHADER),
+            self.compile_shader(fragment, GL_FRAGMENT_SHADER),
+        ]
+        if geometry:
+            self.shaders.append(self.compile_shader(geometry, GL_GEOMETRY_SHADER))
+        for shader in self.shaders:
+            glAttachShader(self.program, shader)
+        glLinkProgram(self.program)
+    
+    def compile_shader(self, source, shader_type):
         bindless_setup = ''
         if hasGLExtension('GL_ARB_bindless_texture'):
             bindless_setup = '''
@@ -309,41 +635,287 @@ def compile_gl_program(vertex, fragment):
         shader = glCreateShader(shader_type)
         glShaderSource(shader, source)
         glCompileShader(shader)
+        return shader
+    
+    def is_ready(self):
+        if self.from_cache or self.from_registry:
+            return True
+        completion_status = parallel_compile_support()
+        if completion_status == False:
+            return True
+        status = gl_buffer(GL_INT,1)
+        glGetProgramiv(self.program, completion_status, status)
+        return status[0] != GL_FALSE
+    
+    def finish(self):
+        #Blocks until the program is linked. Returns (program, error)
+        #The program is registered (or acquired if it's already registered), so it must be released with release_program.
+        if self.from_registry:
+            #Hand over the reference taken in __init__
+            entry = _PROGRAM_REGISTRY[self.cache_key]
+            return (entry['program'], entry['error'])
+        program, error = self.link_result()
+        if self.cache_key in _PROGRAM_REGISTRY:
+            #The same program finished compiling first somewhere else
+            glDeleteProgram(program)
+        else:
+            _PROGRAM_REGISTRY[self.cache_key] = {
+                'program' : program,
+                'error' : error,
+                'refcount' : 0,
+            }
+        entry = _PROGRAM_REGISTRY[self.cache_key]
+        entry['refcount'] += 1
+        return (entry['program'], entry['error'])
+    
+    def discard(self):
+        #Release the GL objects of a compilation that was never finished
+        if self.from_registry:
+            release_program(self.cache_key)
+        else:
+            for shader in self.shaders:
+                glDeleteShader(shader)
+            self.shaders = []
+            glDeleteProgram(self.program)
+    
+    def link_result(self):
+        error = ""
+        if self.from_cache:
+            return (self.program, error)
+        
+        status = gl_buffer(GL_INT,1)
+        for shader in self.shaders:
+            glGetShaderiv(shader, GL_COMPILE_STATUS, status)
+            if status[0] == GL_FALSE:
+                info_log = glGetShaderInfoLog(shader)
+                error += 'SHADER COMPILER ERROR :\n' + buffer_to_string(info_log)
+            glDeleteShader(shader)
+        self.shaders = []
 
-        glGetShaderiv(shader, GL_COMPILE_STATUS, status)
+        glGetProgramiv(self.program, GL_LINK_STATUS, status)
         if status[0] == GL_FALSE:
-            info_log = glGetShaderInfoLog(shader)
-            nonlocal error
-            error += 'SHADER COMPILER ERROR :\n' + buffer_to_string(info_log)
-        
-        return shader
+            info_log = glGetProgramInfoLog(self.program)
+            error += 'SHADER LINKER ERROR :\n' + buffer_to_string(info_log)
+        else:
+            length = gl_buffer(GL_INT, 1)
+            glGetProgramiv(self.program, GL_PROGRAM_BINARY_LENGTH, length)
+            format = gl_buffer(GL_UNSIGNED_INT, 1)
+            buffer = gl_buffer(GL_UNSIGNED_BYTE, length[0])
+            glGetProgramBinary(self.program, length[0], NULL, format, buffer)
+            get_program_cache().store(self.cache_key, format[0], bytes(buffer))
+
+        return (self.program, error)
+
+
+def compile_gl_program(vertex, fragment, geometry=None):
+    return GLProgramCompilation(vertex, fragment, geometry).finish()
+
+
+def invalidate_bind_state():
+    #Forces the next Shader.bind calls to set their full state
+    global _BOUND_PROGRAM
+    _BOUND_PROGRAM = None
+    _PROGRAM_UNIFORM_STATE.clear()
+    TEXTURE_UNIT_BINDINGS.clear()
+
+
+# GL programs are deduplicated by source and shared by all the Shaders (and Shader copies) that use them.
+# They are deleted once the last Shader releases them.
+_PROGRAM_REGISTRY = {}
+
+def acquire_program(key):
+    _PROGRAM_REGISTRY[key]['refcount'] += 1
+
+def release_program(key):
+    entry = _PROGRAM_REGISTRY.get(key)
+    if entry is None:
+        return
+    entry['refcount'] -= 1
+    if entry['refcount'] <= 0:
+        _PROGRAM_REGISTRY.pop(key)
+        _PROGRAM_UNIFORM_STATE.pop(entry['program'], None)
+        global _BOUND_PROGRAM
+        if _BOUND_PROGRAM == entry['program']:
+            _BOUND_PROGRAM = None
+        glDeleteProgram(entry['program'])
+
 
-    vertex_shader = compile_shader(vertex, GL_VERTEX_SHADER)
-    fragment_shader = compile_shader(fragment, GL_FRAGMENT_SHADER)
+__DRIVER_SIGNATURE = None
 
-    glAttachShader(program, vertex_shader)
-    glAttachShader(program, fragment_shader)
-    glLinkProgram(program)
+def driver_signature():
+    #Program binaries are only valid for the driver that generated them
+    global __DRIVER_SIGNATURE
+    if __DRIVER_SIGNATURE is None:
+        __DRIVER_SIGNATURE = '\0'.join(
+            (glGetString(name) or b'').decode('utf-8', 'replace') for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+    return __DRIVER_SIGNATURE
 
-    glDeleteShader(vertex_shader)
-    glDeleteShader(fragment_shader)
+
+# Maximum disk size of each shader cache. Least recently used entries are evicted first.
+PROGRAM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PREPROCESSOR_CACHE_MAX_BYTES = 128 * 1024 * 1024
+REFLECTION_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# Full caches are evicted down to this fraction of their maximum size.
+DISK_CACHE_EVICTION_RATIO = 0.75
+
+class DiskCache():
+    #Entries are stored as <key><extension> files.
+    #The manifest keeps the size and last use time of each entry.
+    #It's only merged with other processes, evicted and written to disk when the cache goes over max_bytes,
+    #and when save_manifest is called (at exit), so storing entries doesn't rewrite it every time.
+
+    def __init__(self, folder, extension, max_bytes):
+        self.folder = folder
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.evictions_stat = None
+        os.makedirs(folder, exist_ok=True)
+        self.manifest_path = os.path.join(folder, 'manifest.json')
+        self.manifest = self.load_manifest()
+        self.manifest_needs_save = False
+        #Index entries missing from the manifest (ie. if a previous session didn't exit cleanly)
+        for file in os.listdir(folder):
+            key, extension = os.path.splitext(file)
+            if extension == self.extension and key not in self.manifest and file != 'manifest.json':
+                stat = os.stat(os.path.join(folder, file))
+                self.manifest[key] = { 'size' : stat.st_size, 'last_use' : stat.st_mtime }
+                self.manifest_needs_save = True
+        self.total_size = sum(entry['size'] for entry in self.manifest.values())
+        import threading
+        self.lock = threading.Lock()
     
-    glGetProgramiv(program, GL_LINK_STATUS, status)
-    if status[0] == GL_FALSE:
-        info_log = glGetProgramInfoLog(program)
-        error += 'SHADER LINKER ERROR :\n' + buffer_to_string(info_log)
-    else:
-        length = gl_buffer(GL_INT, 1)
-        glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH, length)
-        format = gl_buffer(GL_UNSIGNED_INT, 1)
-        buffer = gl_buffer(GL_UNSIGNED_BYTE, length[0])
-        glGetProgramBinary(program, length[0], NULL, format, buffer)
-        with open(cache_path, 'wb') as f:
-            f.write(buffer)
-        with open(format_path, 'wb') as f:
-            f.write(format)
+    def entry_path(self, key):
+        return os.path.join(self.folder, key + self.extension)
+    
+    def load_manifest(self):
+        import json
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def set_entry(self, key, size):
+        #Must be called with the lock held
+        import time
+        previous = self.manifest.get(key)
+        if previous:
+            self.total_size -= previous['size']
+        self.manifest[key] = { 'size' : size, 'last_use' : time.time() }
+        self.total_size += size
+        self.manifest_needs_save = True
+    
+    def load_data(self, key):
+        try:
+            with open(self.entry_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            self.set_entry(key, len(data))
+        return data
+    
+    def store_data(self, key, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        write_cache_file(self.entry_path(key), data)
+        with self.lock:
+            self.set_entry(key, len(data))
+            over_budget = self.total_size > self.max_bytes
+        if over_budget:
+            self.evict()
+    
+    def remove(self, key):
+        try: os.remove(self.entry_path(key))
+        except OSError: pass
+        with self.lock:
+            entry = self.manifest.pop(key, None)
+            if entry:
+                self.total_size -= entry['size']
+            self.manifest_needs_save = True
+    
+    def evict(self):
+        with self.lock:
+            self.manifest_needs_save = True
+        self.save_manifest()
+    
+    def save_manifest(self):
+        #Merges the manifest with the one on disk, removes the least recently used entries over max_bytes and saves it
+        import json
+        with self.lock:
+            if self.manifest_needs_save == False:
+                return
+            #Merge entries written by other processes.
+            #Entries lost by concurrent manifest writes are indexed again on the next session.
+            for key, entry in self.load_manifest().items():
+                if key not in self.manifest or self.manifest[key]['last_use'] < entry['last_use']:
+                    self.manifest[key] = entry
+            self.total_size = sum(entry['size'] for entry in self.manifest.values())
+            if self.total_size > self.max_bytes:
+                #Leave some room, so a full cache isn't evicted (and saved) again on every store
+                target_size = self.max_bytes * DISK_CACHE_EVICTION_RATIO
+                for key in sorted(self.manifest.keys(), key=lambda k: self.manifest[k]['last_use']):
+                    if self.total_size <= target_size:
+                        break
+                    self.total_size -= self.manifest.pop(key)['size']
+                    try: os.remove(self.entry_path(key))
+                    except OSError: pass
+                    if self.evictions_stat:
+                        CACHE_STATS[self.evictions_stat] += 1
+            self.manifest_needs_save = False
+            data = json.dumps(self.manifest)
+        write_cache_file(self.manifest_path, data)
 
-    return (program, error)
+
+class ProgramBinaryCache(DiskCache):
+    #Program binaries are stored as .bin files (binary format + binary data).
+
+    def __init__(self, folder):
+        super().__init__(folder, '.bin', PROGRAM_CACHE_MAX_BYTES)
+        self.evictions_stat = 'Program Cache Evictions'
+    
+    def load(self, key):
+        import struct
+        data = self.load_data(key)
+        if data is None or len(data) <= 4:
+            CACHE_STATS['Program Cache Misses'] += 1
+            return None
+        CACHE_STATS['Program Cache Hits'] += 1
+        format = struct.unpack('<I', data[:4])[0]
+        return (format, data[4:])
+    
+    def store(self, key, format, binary):
+        import struct
+        self.store_data(key, struct.pack('<I', format) + binary)
+
+
+__PROGRAM_CACHE = None
+
+def get_program_cache():
+    global __PROGRAM_CACHE
+    if __PROGRAM_CACHE is None:
+        import tempfile, glob
+        cache_folder = os.path.join(tempfile.gettempdir(), 'MALT_SHADERS_CACHE')
+        #Remove unmanaged binaries from older versions
+        for path in glob.glob(os.path.join(cache_folder, '*.bin')) + glob.glob(os.path.join(cache_folder, '*.fmt')):
+            try: os.remove(path)
+            except OSError: pass
+        __PROGRAM_CACHE = ProgramBinaryCache(os.path.join(cache_folder, 'PROGRAMS'))
+        import atexit
+        atexit.register(__PROGRAM_CACHE.save_manifest)
+    return __PROGRAM_CACHE
+
+__PREPROCESSOR_CACHE = None
+
+def get_preprocessor_cache():
+    global __PREPROCESSOR_CACHE
+    if __PREPROCESSOR_CACHE is None:
+        import tempfile
+        folder = os.path.join(tempfile.gettempdir(), 'MALT_SHADERS_CACHE', 'PREPROCESSOR')
+        __PREPROCESSOR_CACHE = DiskCache(folder, '.json', PREPROCESSOR_CACHE_MAX_BYTES)
+        import atexit
+        atexit.register(__PREPROCESSOR_CACHE.save_manifest)
+    return __PREPROCESSOR_CACHE
 
 
 def reflect_program_uniforms(program):
@@ -458,6 +1030,100 @@ def uniform_type_set_function(uniform_type):
         return function
 
 
+def reflect_program_block_uniforms(program, block_name):
+    #Returns the members of a uniform block as GLUniforms with their block layout.
+    #Arrays are split into one uniform per element, like in reflect_program_uniforms.
+    block_index = glGetUniformBlockIndex(program, block_name)
+    if block_index == GL_INVALID_INDEX:
+        return {}
+    
+    max_string_length = 128
+    string_length = gl_buffer(GL_INT, 1)
+    uniform_type = gl_buffer(GL_INT, 1)
+    uniform_name = gl_buffer(GL_BYTE, max_string_length)
+    array_length = gl_buffer(GL_INT, 1)
+    uniform_count = gl_buffer(GL_INT,1)
+    glGetProgramiv(program, GL_ACTIVE_UNIFORMS, uniform_count)
+
+    query_indices = gl_buffer(GL_INT, uniform_count[0])
+    for i in range(len(query_indices)):
+        query_indices[i] = i
+    def query(parameter):
+        result = gl_buffer(GL_INT, uniform_count[0])
+        glGetActiveUniformsiv(program, uniform_count[0], query_indices, parameter, result)
+        return result
+    block_indices = query(GL_UNIFORM_BLOCK_INDEX)
+    offsets = query(GL_UNIFORM_OFFSET)
+    array_strides = query(GL_UNIFORM_ARRAY_STRIDE)
+    matrix_strides = query(GL_UNIFORM_MATRIX_STRIDE)
+
+    uniforms = {}
+    for i in range(0, uniform_count[0]):
+        if block_indices[i] != block_index:
+            continue
+        glGetActiveUniform(program, i, max_string_length, string_length,
+        array_length, uniform_type, uniform_name)
+        name = buffer_to_string(uniform_name)
+        
+        def add_uniform(name, offset):
+            uniform = GLUniform(-1, uniform_type[0], 0)
+            uniform.block_offset = offset
+            uniform.matrix_stride = matrix_strides[i]
+            uniforms[name] = uniform
+        
+        if array_length[0] > 1:
+            for element in range(array_length[0]):
+                _name = '[{}]'.format(element).join(name.rsplit('[0]', 1))
+                add_uniform(_name, offsets[i] + element * array_strides[i])
+        else:
+            add_uniform(name, offsets[i])
+    
+    return uniforms
+
+
+def pack_material_uniforms(sources):
+    #Moves the generated material uniforms (see GLSLTranspiler.global_declaration) into a std140 uniform block.
+    #All sources get the same block declaration, so it can be shared by every stage.
+    #Returns the new sources and the initialization expressions of the moved uniforms.
+    import re
+    declaration_re = re.compile(
+        r'^[ \t]*uniform[ \t]+(\w+)[ \t]+(U_0\w*)[ \t]*(\[[ \t]*\d+[ \t]*\])?[ \t]*(?:=(.*))?;[ \t]*$', re.MULTILINE)
+    declarations = {}
+    for source in sources:
+        for match in declaration_re.finditer(source):
+            type, name, array, initialization = match.groups()
+            if 'sampler' in type or 'image' in type:
+                continue
+            declarations[name] = (type, array or '', initialization)
+    
+    if len(declarations) == 0:
+        return sources, {}
+    
+    members = ' '.join(f'{type} {name}{array};' for name, (type, array, initialization) in sorted(declarations.items()))
+    #Keep it in a single line to preserve line numbers
+    block = f'layout(std140) uniform {MATERIAL_UNIFORM_BLOCK} {{ {members} }};'
+
+    result = []
+    for source in sources:
+        declared = False
+        def replace(match):
+            nonlocal declared
+            if match.group(2) not in declarations:
+                return match.group(0)
+            if declared:
+                return ''
+            declared = True
+            return block
+        result.append(declaration_re.sub(replace, source))
+    
+    defaults = {}
+    for name, (type, array, initialization) in declarations.items():
+        if initialization and array == '':
+            defaults[name] = initialization.strip()
+    
+    return result, defaults
+
+
 def reflect_program_uniform_blocks(program):
     block_count = gl_buffer(GL_INT,1)
     max_string_length = 128
@@ -484,28 +1150,25 @@ def reflect_program_uniform_blocks(program):
 
 USE_GLSLANG_VALIDATOR = False
 
-def glsl_reflection(code, root_paths=[]):
-    import tempfile, subprocess, json, platform
-    
-    GLSLParser = os.path.join(os.path.dirname(__file__), 'GLSLParser', '.bin', 'GLSLParser')
-    
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    tmp.write(code.encode('utf-8'))
-    tmp.close()
+CACHE_STATS = {
+    'Reflection Cache Hits' : 0,
+    'Reflection Cache Misses' : 0,
+    'Program Cache Hits' : 0,
+    'Program Cache Misses' : 0,
+    'Program Cache Evictions' : 0,
+}
 
-    command = f'"{GLSLParser}" "{tmp.name}"'
-    if platform.system() == 'Windows':
-        #run with utf8 code page to support non-ascii paths
-        command = f'CHCP 65001 > nul && {command}'
-    
-    try:
-        json_string = subprocess.check_output(command, shell=True)
-    except:
-        import stat
-        os.chmod(GLSLParser, os.stat(GLSLParser).st_mode | stat.S_IEXEC)
-        json_string = subprocess.check_output(command, shell=True)
+def glsl_reflection(code, root_paths=[]):
+    import json
     
-    os.remove(tmp.name)
+    reflection_hash = reflection_cache_key(code)
+    json_string = load_reflection_cache(reflection_hash)
+    if json_string is None:
+        CACHE_STATS['Reflection Cache Misses'] += 1
+        json_string = run_glsl_parser(code)
+        save_reflection_cache(reflection_hash, json_string)
+    else:
+        CACHE_STATS['Reflection Cache Hits'] += 1
     
     reflection = json.loads(json_string)
 
@@ -560,6 +1223,143 @@ def glsl_reflection(code, root_paths=[]):
     return reflection
 
 
+def glsl_parser_path():
+    return os.path.join(os.path.dirname(__file__), 'GLSLParser', '.bin', 'GLSLParser')
+
+
+class GLSLParserProcess():
+    #A long-lived GLSLParser process running in --server mode.
+    #Sources are sent through stdin and reflections are read from stdout, both prefixed by their size in bytes.
+
+    def __init__(self):
+        import subprocess, threading
+        GLSLParser = glsl_parser_path()
+        command = [GLSLParser, '--server']
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except PermissionError:
+            import stat
+            os.chmod(GLSLParser, os.stat(GLSLParser).st_mode | stat.S_IEXEC)
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+    
+    def is_alive(self):
+        return self.process.poll() is None
+    
+    def reflect(self, code):
+        data = code.encode('utf-8')
+        with self.lock:
+            self.process.stdin.write(f'{len(data)}\n'.encode('utf-8') + data)
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if header == b'':
+                raise Exception('GLSLParser process closed')
+            size = int(header)
+            if size == 0:
+                raise Exception('GLSLParser failed')
+            result = self.process.stdout.read(size)
+        return result.decode('utf-8')
+    
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(1)
+        except:
+            self.process.kill()
+
+
+__GLSL_PARSER_PROCESS = None
+__GLSL_PARSER_SERVER_SUPPORT = True
+
+def run_glsl_parser(code):
+    global __GLSL_PARSER_PROCESS, __GLSL_PARSER_SERVER_SUPPORT
+    if __GLSL_PARSER_SERVER_SUPPORT:
+        try:
+            if __GLSL_PARSER_PROCESS is None or __GLSL_PARSER_PROCESS.is_alive() == False:
+                __GLSL_PARSER_PROCESS = GLSLParserProcess()
+                import atexit
+                atexit.register(__GLSL_PARSER_PROCESS.close)
+            return __GLSL_PARSER_PROCESS.reflect(code)
+        except:
+            import traceback
+            LOG.warning(traceback.format_exc())
+            #Parser builds without --server support exit right away
+            if __GLSL_PARSER_PROCESS is None or __GLSL_PARSER_PROCESS.is_alive() == False:
+                LOG.warning('GLSLParser server mode failed. Falling back to one process per reflection.')
+                __GLSL_PARSER_SERVER_SUPPORT = False
+    return run_glsl_parser_process(code)
+
+
+def run_glsl_parser_process(code):
+    import tempfile, subprocess, platform
+    
+    GLSLParser = glsl_parser_path()
+    
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    tmp.write(code.encode('utf-8'))
+    tmp.close()
+
+    command = f'"{GLSLParser}" "{tmp.name}"'
+    if platform.system() == 'Windows':
+        #run with utf8 code page to support non-ascii paths
+        command = f'CHCP 65001 > nul && {command}'
+    
+    try:
+        json_string = subprocess.check_output(command, shell=True)
+    except:
+        import stat
+        os.chmod(GLSLParser, os.stat(GLSLParser).st_mode | stat.S_IEXEC)
+        json_string = subprocess.check_output(command, shell=True)
+    
+    os.remove(tmp.name)
+
+    return json_string.decode('utf-8')
+
+
+# Raw GLSLParser output is cached by preprocessed source hash and GLSLParser build.
+# Reflections of outdated sources are never hit again, so they're removed by the LRU eviction.
+__REFLECTION_CACHE = None
+
+def get_reflection_cache():
+    global __REFLECTION_CACHE
+    if __REFLECTION_CACHE is None:
+        import tempfile
+        folder = os.path.join(tempfile.gettempdir(), 'MALT_SHADERS_CACHE', 'REFLECTION')
+        #Remove the index from older versions
+        try: os.remove(os.path.join(folder, 'index.json'))
+        except OSError: pass
+        __REFLECTION_CACHE = DiskCache(folder, '.json', REFLECTION_CACHE_MAX_BYTES)
+        import atexit
+        atexit.register(__REFLECTION_CACHE.save_manifest)
+    return __REFLECTION_CACHE
+
+__GLSL_PARSER_SIGNATURE = None
+
+def glsl_parser_signature():
+    #Rebuilding GLSLParser can change its output
+    global __GLSL_PARSER_SIGNATURE
+    if __GLSL_PARSER_SIGNATURE is None:
+        try:
+            stat = os.stat(glsl_parser_path())
+            __GLSL_PARSER_SIGNATURE = f'{stat.st_mtime_ns}:{stat.st_size}'
+        except OSError:
+            __GLSL_PARSER_SIGNATURE = ''
+    return __GLSL_PARSER_SIGNATURE
+
+def reflection_cache_key(code):
+    import hashlib
+    return hashlib.sha1((glsl_parser_signature() + '\0' + code).encode('utf-8')).hexdigest()
+
+def load_reflection_cache(reflection_hash):
+    data = get_reflection_cache().load_data(reflection_hash)
+    if data is None:
+        return None
+    return data.decode('utf-8')
+
+def save_reflection_cache(reflection_hash, json_string):
+    get_reflection_cache().store_data(reflection_hash, json_string)
+
+
 def glslang_validator(source, stage):
     if not USE_GLSLANG_VALIDATOR:
         return ''
@@ -587,6 +1387,7 @@ def glslang_validator(source, stage):
         stages = {
             'vert' : 'VERTEX',
             'frag' : 'PIXEL',
+            'geom' : 'GEOMETRY',
         }
         return '{} SHADER VALIDATION :\n{}'.format(stages[stage], out)
     else:
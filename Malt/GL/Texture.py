@@ -34,12 +34,14 @@ class Texture():
             glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAX_ANISOTROPY, level)
 
         glBindTexture(GL_TEXTURE_2D, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
     
     def bind(self):
         glBindTexture(GL_TEXTURE_2D, self.texture[0])
     
     def __del__(self):
         glDeleteTextures(1, self.texture)
+        TEXTURE_UNIT_BINDINGS.clear()
 
 
 class TextureArray():
@@ -66,12 +68,14 @@ class TextureArray():
         glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, mag_filter)
 
         glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
     
     def bind(self):
         glBindTexture(GL_TEXTURE_2D_ARRAY, self.texture[0])
     
     def __del__(self):
         glDeleteTextures(1, self.texture)
+        TEXTURE_UNIT_BINDINGS.clear()
 
 
 class CubeMap():
@@ -99,12 +103,14 @@ class CubeMap():
         glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_MAG_FILTER, mag_filter)
 
         glBindTexture(GL_TEXTURE_CUBE_MAP, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
     
     def bind(self):
         glBindTexture(GL_TEXTURE_CUBE_MAP, self.texture[0])
     
     def __del__(self):
         glDeleteTextures(1, self.texture)
+        TEXTURE_UNIT_BINDINGS.clear()
 
 
 class CubeMapArray():
@@ -132,12 +138,14 @@ class CubeMapArray():
         glTexParameteri(GL_TEXTURE_CUBE_MAP_ARRAY, GL_TEXTURE_MAG_FILTER, mag_filter)
 
         glBindTexture(GL_TEXTURE_CUBE_MAP_ARRAY, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
     
     def bind(self):
         glBindTexture(GL_TEXTURE_CUBE_MAP_ARRAY, self.texture[0])
     
     def __del__(self):
         glDeleteTextures(1, self.texture)
+        TEXTURE_UNIT_BINDINGS.clear()
 
 
 class Gradient():
@@ -161,12 +169,14 @@ class Gradient():
         glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, interpolation)
 
         glBindTexture(GL_TEXTURE_1D, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
     
     def bind(self):
         glBindTexture(GL_TEXTURE_1D, self.texture[0])
     
     def __del__(self):
         glDeleteTextures(1, self.texture)
+        TEXTURE_UNIT_BINDINGS.clear()
 
 
 def internal_format_to_data_format(internal_format):
@@ -244,3 +254,85 @@ def format_channels(format):
     
 
 
+
+
+class TextureBuffer():
+    #A buffer object read from the shaders as a samplerBuffer (only with texelFetch).
+    #Useful for arrays that don't fit in a uniform block.
+
+    def __init__(self, internal_format=GL_R32UI):
+        self.internal_format = internal_format
+        self.size = 0
+        self.capacity = 0
+        #A copy of the uploaded data, so update only uploads the records that changed
+        self.data = None
+
+        self.buffer = gl_buffer(GL_INT, 1)
+        glGenBuffers(1, self.buffer)
+        self.texture = gl_buffer(GL_INT, 1)
+        glGenTextures(1, self.texture)
+        self.allocate(16)
+
+        glBindTexture(GL_TEXTURE_BUFFER, self.texture[0])
+        glTexBuffer(GL_TEXTURE_BUFFER, self.internal_format, self.buffer[0])
+        glBindTexture(GL_TEXTURE_BUFFER, 0)
+        TEXTURE_UNIT_BINDINGS.clear()
+    
+    def allocate(self, capacity):
+        #Re-allocating the buffer storage keeps it attached to the texture
+        self.capacity = capacity
+        glBindBuffer(GL_TEXTURE_BUFFER, self.buffer[0])
+        glBufferData(GL_TEXTURE_BUFFER, capacity, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+    
+    def load(self, data):
+        #data is a contiguous numpy array (or anything with the buffer protocol)
+        import numpy as np
+        data = np.ascontiguousarray(data)
+        self.data = None
+        self.size = data.nbytes
+        if self.size > self.capacity:
+            self.allocate(max(self.size, self.capacity * 2))
+        if self.size > 0:
+            self.load_sub_data(0, self.size, data.ctypes.data)
+    
+    def update(self, data):
+        #data is a numpy array of records (first axis). Only the runs of records that changed since the last update are uploaded.
+        #Returns the uploaded size in bytes.
+        import numpy as np
+        data = np.ascontiguousarray(data)
+        old = self.data
+        if old is None or old.dtype != data.dtype or old.shape[1:] != data.shape[1:] or data.nbytes > self.capacity:
+            self.load(data)
+            self.data = data.copy()
+            return self.size
+        
+        count = len(data)
+        common = min(count, len(old))
+        changed = np.ones(count, bool)
+        if common > 0:
+            changed[:common] = np.any((data[:common] != old[:common]).reshape(common, -1), axis=1)
+        runs = np.flatnonzero(np.diff(np.concatenate(([False], changed, [False])).astype(np.int8)))
+        record_size = data.itemsize * (data.size // count) if count else 0
+        uploaded = 0
+        for start, end in zip(runs[0::2], runs[1::2]):
+            offset = int(start) * record_size
+            size = int(end - start) * record_size
+            self.load_sub_data(offset, size, data.ctypes.data + offset)
+            uploaded += size
+        self.size = data.nbytes
+        self.data = data.copy()
+        return uploaded
+    
+    def load_sub_data(self, offset, size, address):
+        glBindBuffer(GL_TEXTURE_BUFFER, self.buffer[0])
+        glBufferSubData(GL_TEXTURE_BUFFER, offset, size, ctypes.c_void_p(address))
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+    
+    def bind(self):
+        glBindTexture(GL_TEXTURE_BUFFER, self.texture[0])
+    
+    def __del__(self):
+        glDeleteTextures(1, self.texture)
+        glDeleteBuffers(1, self.buffer)
+        TEXTURE_UNIT_BINDINGS.clear()
@@ -0,0 +1,262 @@
+import collections, threading, weakref
+
+from Malt.GL.GL import *
+from Malt.GL.Mesh import Mesh
+
+class ArenaAllocation():
+    #The offset can change when the arena is compacted, so always read it at draw time
+
+    def __init__(self, allocator, offset, size):
+        self.allocator = allocator
+        self.offset = offset
+        self.size = size
+
+    def __del__(self):
+        self.allocator.free(self)
+
+
+class FreeListAllocator():
+    #First fit sub-allocator. Free blocks are kept sorted by offset and merged with their neighbours.
+    #free only queues the allocation (no locks and no GL calls), so it's safe to call from __del__ at any point,
+    #even from a garbage collection triggered while the lock is held. The queue is drained under the lock.
+
+    def __init__(self, capacity, alignment=1):
+        self.capacity = capacity
+        self.alignment = alignment
+        self.free_blocks = [[0, capacity]]
+        self.allocations = weakref.WeakSet()
+        self.pending_frees = collections.deque()
+        self.lock = threading.Lock()
+
+    def align(self, size):
+        return ((size + self.alignment - 1) // self.alignment) * self.alignment
+
+    def allocate(self, size):
+        size = self.align(max(size, 1))
+        with self.lock:
+            self.free_pending()
+            for i, (offset, block_size) in enumerate(self.free_blocks):
+                if block_size >= size:
+                    if block_size == size:
+                        self.free_blocks.pop(i)
+                    else:
+                        self.free_blocks[i] = [offset + size, block_size - size]
+                    allocation = ArenaAllocation(self, offset, size)
+                    self.allocations.add(allocation)
+                    return allocation
+        return None
+
+    def free(self, allocation):
+        #Keeps the allocation alive until it's drained, so compact still moves it along the others
+        self.pending_frees.append(allocation)
+
+    def free_pending(self):
+        #Must be called with the lock held
+        while self.pending_frees:
+            allocation = self.pending_frees.popleft()
+            self.allocations.discard(allocation)
+            self.insert_block(allocation.offset, allocation.size)
+
+    def insert_block(self, offset, size):
+        blocks = self.free_blocks
+        i = 0
+        while i < len(blocks) and blocks[i][0] < offset:
+            i += 1
+        blocks.insert(i, [offset, size])
+        if i + 1 < len(blocks) and blocks[i][0] + blocks[i][1] == blocks[i+1][0]:
+            blocks[i][1] += blocks[i+1][1]
+            blocks.pop(i+1)
+        if i > 0 and blocks[i-1][0] + blocks[i-1][1] == blocks[i][0]:
+            blocks[i-1][1] += blocks[i][1]
+            blocks.pop(i)
+
+    def grow(self, capacity):
+        if capacity <= self.capacity:
+            return
+        with self.lock:
+            self.free_pending()
+            self.insert_block(self.capacity, capacity - self.capacity)
+            self.capacity = capacity
+
+    def used_size(self):
+        with self.lock:
+            self.free_pending()
+            return self.capacity - sum(size for offset, size in self.free_blocks)
+
+    def fragmented_size(self):
+        #Free space that is not at the end of the buffer
+        with self.lock:
+            self.free_pending()
+            free = sum(size for offset, size in self.free_blocks)
+            if self.free_blocks and sum(self.free_blocks[-1]) == self.capacity:
+                free -= self.free_blocks[-1][1]
+            return free
+
+    def compact(self):
+        #Moves all the allocations to the start of the buffer.
+        #Returns the moves as a list of (old offset, new offset, size)
+        moves = []
+        with self.lock:
+            self.free_pending()
+            offset = 0
+            for allocation in sorted(self.allocations, key=lambda a: a.offset):
+                moves.append((allocation.offset, offset, allocation.size))
+                allocation.offset = offset
+                offset += allocation.size
+            self.free_blocks = [[offset, self.capacity - offset]] if offset < self.capacity else []
+        return moves
+
+
+class ArenaMesh(Mesh):
+    #A sub-allocated mesh. The arena owns the buffers and the VAO, so there's nothing to delete here
+
+    def __init__(self, arena, vertex_allocation, index_allocation, index_count, index_type):
+        self.position = None
+        self.normal = None
+        self.tangent = None
+        self.uvs = []
+        self.colors = []
+        self.arena = arena
+        self.VAO = arena.VAO
+        self.EBO = None
+        self.vertex_allocation = vertex_allocation
+        self.index_allocation = index_allocation
+        self.index_count = index_count
+        self.index_type = index_type
+        self.bounds = None
+
+    def __del__(self):
+        pass
+
+
+class VertexArena():
+    #Interleaved vertices and indices for all the meshes that share the same vertex layout,
+    #so they can share a single VAO and be drawn with base vertex offsets.
+    #Layout : (stride, ((location, element_size, gl_type, gl_normalize, offset), ...))
+
+    INITIAL_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.stride = layout[0]
+        self.VBO = gl_buffer(GL_INT, 1)
+        self.EBO = gl_buffer(GL_INT, 1)
+        self.VAO = gl_buffer(GL_INT, 1)
+        self.vertices = FreeListAllocator(max(1, self.INITIAL_SIZE // self.stride))
+        self.indices = FreeListAllocator(self.INITIAL_SIZE, 4)
+        self.VBO[0] = self.create_buffer(self.vertices.capacity * self.stride)
+        self.EBO[0] = self.create_buffer(self.indices.capacity)
+        glGenVertexArrays(1, self.VAO)
+        self.setup_VAO()
+
+    def create_buffer(self, size):
+        buffer = gl_buffer(GL_INT, 1)
+        glGenBuffers(1, buffer)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, buffer[0])
+        glBufferData(GL_COPY_WRITE_BUFFER, size, None, GL_STATIC_DRAW)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        return buffer[0]
+
+    def copy_ranges(self, source, destination, ranges):
+        glBindBuffer(GL_COPY_READ_BUFFER, source)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, destination)
+        for source_offset, destination_offset, size in ranges:
+            if size > 0:
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, source_offset, destination_offset, size)
+        glBindBuffer(GL_COPY_READ_BUFFER, 0)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+    def setup_VAO(self):
+        glBindVertexArray(self.VAO[0])
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.EBO[0])
+        glBindBuffer(GL_ARRAY_BUFFER, self.VBO[0])
+        for location, element_size, gl_type, gl_normalize, offset in self.layout[1]:
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, element_size, gl_type, gl_normalize, self.stride, ctypes.c_void_p(offset))
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def replace_buffers(self, vertex_ranges, vertex_capacity, index_ranges, index_capacity):
+        #Copy the given ranges (in bytes) into new buffers and rebuild the VAO
+        VBO = self.create_buffer(vertex_capacity * self.stride)
+        self.copy_ranges(self.VBO[0], VBO, vertex_ranges)
+        glDeleteBuffers(1, self.VBO)
+        self.VBO[0] = VBO
+        EBO = self.create_buffer(index_capacity)
+        self.copy_ranges(self.EBO[0], EBO, index_ranges)
+        glDeleteBuffers(1, self.EBO)
+        self.EBO[0] = EBO
+        self.setup_VAO()
+
+    def grow(self, vertex_count, index_size):
+        vertex_capacity = self.vertices.capacity
+        index_capacity = self.indices.capacity
+        while vertex_capacity - self.vertices.used_size() < vertex_count:
+            vertex_capacity *= 2
+        while index_capacity - self.indices.used_size() < index_size:
+            index_capacity *= 2
+        #Compact while copying, there may be enough free space but not in a single block
+        vertex_moves = self.vertices.compact()
+        index_moves = self.indices.compact()
+        self.vertices.grow(vertex_capacity)
+        self.indices.grow(index_capacity)
+        self.replace_buffers(
+            [(old * self.stride, new * self.stride, size * self.stride) for old, new, size in vertex_moves], vertex_capacity,
+            index_moves, index_capacity)
+
+    def allocate(self, vertex_count, index_sizes):
+        #Returns a vertex allocation and one index allocation per index size (in bytes)
+        vertex_allocation = self.vertices.allocate(vertex_count)
+        index_allocations = [self.indices.allocate(size) for size in index_sizes]
+        if vertex_allocation is None or None in index_allocations:
+            vertex_allocation = None
+            index_allocations = None
+            self.grow(vertex_count, sum(self.indices.align(size) for size in index_sizes))
+            vertex_allocation = self.vertices.allocate(vertex_count)
+            index_allocations = [self.indices.allocate(size) for size in index_sizes]
+        return vertex_allocation, index_allocations
+
+    def load(self, staging_vertices, staging_indices, vertex_count, submeshes):
+        #Copies a mesh from staging buffers (see Bridge.Mesh.upload_mesh) and returns an ArenaMesh per submesh.
+        #submeshes : [(staging index offset, index count, index type), ...]
+        index_sizes = []
+        for offset, count, index_type in submeshes:
+            index_sizes.append(count * (2 if index_type == GL_UNSIGNED_SHORT else 4))
+        vertex_allocation, index_allocations = self.allocate(vertex_count, index_sizes)
+        self.copy_ranges(staging_vertices, self.VBO[0], [(0, vertex_allocation.offset * self.stride, vertex_count * self.stride)])
+        self.copy_ranges(staging_indices, self.EBO[0], [(submesh[0], allocation.offset, size)
+            for submesh, allocation, size in zip(submeshes, index_allocations, index_sizes)])
+        return [ArenaMesh(self, vertex_allocation, allocation, count, index_type)
+            for allocation, (offset, count, index_type) in zip(index_allocations, submeshes)]
+
+    def compact(self, min_fragmented_size=INITIAL_SIZE//4):
+        #Compact when the holes are larger than the used space
+        vertex_holes = self.vertices.fragmented_size() * self.stride
+        index_holes = self.indices.fragmented_size()
+        if max(vertex_holes, index_holes) < min_fragmented_size:
+            return False
+        if vertex_holes < self.vertices.used_size() * self.stride and index_holes < self.indices.used_size():
+            return False
+        vertex_moves = self.vertices.compact()
+        index_moves = self.indices.compact()
+        self.replace_buffers(
+            [(old * self.stride, new * self.stride, size * self.stride) for old, new, size in vertex_moves], self.vertices.capacity,
+            index_moves, self.indices.capacity)
+        return True
+
+    def __del__(self):
+        try:
+            glDeleteVertexArrays(1, self.VAO)
+            glDeleteBuffers(1, self.VBO)
+            glDeleteBuffers(1, self.EBO)
+        except:
+            pass
+
+
+ARENAS = {}
+
+def get_arena(layout):
+    if layout not in ARENAS:
+        ARENAS[layout] = VertexArena(layout)
+    return ARENAS[layout]
+
@@ -1,3 +1,5 @@
+import math
+
 from Malt.GL.GL import *
 from Malt.GL.Texture import Texture
 from Malt.GL.RenderTarget import RenderTarget
@@ -5,6 +7,14 @@ from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
 
 _SHADER = None
+_JUMP_FLOOD_SHADER = None
+
+def get_jump_flood_steps(max_width):
+    #Halving step widths, their sum covers the max half width
+    max_half_width = math.ceil(max_width / 2)
+    if max_half_width < 1:
+        return []
+    return [2**i for i in reversed(range(int(math.log2(max_half_width)) + 1))]
 
 class LineRender(PipelineNode):
     """
@@ -28,6 +38,9 @@ class LineRender(PipelineNode):
         inputs['Line Scale'] = Parameter(1.0, Type.FLOAT, doc="""
             Scale all Line Width values with this one.  
             *(Useful for rendering at different resolutions)*""")
+        inputs['Jump Flood'] = Parameter(False, Type.BOOL, doc="""
+            Expand the lines with log2(Max Width) jump flood passes instead of checking every pixel in range.  
+            *(Faster for wide lines, but overlapping lines can differ slightly)*""")
         inputs['Normal Depth'] = Parameter('', Type.TEXTURE)
         inputs['ID'] = Parameter('', Type.TEXTURE)
         return inputs
@@ -41,6 +54,37 @@ class LineRender(PipelineNode):
     def setup_render_targets(self, resolution):
         self.t_color = Texture(resolution, GL_RGBA16F)
         self.fbo_color = RenderTarget([self.t_color])
+        self.t_jump_flood = []
+        self.fbo_jump_flood = []
+        for i in range(2):
+            texture = Texture(resolution, GL_RGBA32F, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
+            self.t_jump_flood.append(texture)
+            self.fbo_jump_flood.append(RenderTarget([texture]))
+
+    def jump_flood(self, inputs):
+        global _JUMP_FLOOD_SHADER
+        if _JUMP_FLOOD_SHADER is None:
+            _JUMP_FLOOD_SHADER = self.pipeline.compile_shader_from_source('#include "Passes/LineJumpFlood.glsl"')
+        
+        shader = _JUMP_FLOOD_SHADER
+        shader.textures['depth_texture'] = inputs['Normal Depth']
+        shader.uniforms['depth_channel'].set_value(3)
+        shader.textures['id_texture'] = inputs['ID']
+        shader.textures['line_color_texture'] = inputs['Line Color']
+        shader.textures['line_width_texture'] = inputs['Line Width']
+        shader.uniforms['line_width_scale'].set_value(inputs['Line Scale'])
+        shader.uniforms['max_width'].set_value(inputs['Max Width'])
+        self.pipeline.common_buffer.shader_callback(shader)
+
+        #Step 0 renders the seeds, then ping-pong between both targets
+        current = 0
+        for step_width in [0] + get_jump_flood_steps(inputs['Max Width']):
+            shader.textures['jump_flood_texture'] = self.t_jump_flood[current]
+            shader.uniforms['step_width'].set_value(step_width)
+            current = 1 - current
+            self.pipeline.draw_screen_pass(shader, self.fbo_jump_flood[current])
+        
+        return self.t_jump_flood[current]
 
     def execute(self, parameters):
         inputs = parameters['IN']
@@ -62,6 +106,9 @@ class LineRender(PipelineNode):
         _SHADER.textures['line_width_texture'] = inputs['Line Width']
         _SHADER.uniforms['line_width_scale'].set_value(inputs['Line Scale'])
         _SHADER.uniforms['brute_force_range'].set_value(inputs['Max Width'])
+        if inputs['Jump Flood']:
+            _SHADER.textures['jump_flood_texture'] = self.jump_flood(inputs)
+        _SHADER.uniforms['jump_flood'].set_value(inputs['Jump Flood'])
         
         self.pipeline.common_buffer.shader_callback(_SHADER)
         self.pipeline.draw_screen_pass(_SHADER, self.fbo_color)
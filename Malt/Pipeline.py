@@ -2,15 +2,78 @@ import os
 from os import path
 import ctypes
 
+import numpy as np
+
 from Malt.GL.GL import *
 from Malt.GL.Mesh import Mesh
-from Malt.GL.Shader import Shader, UBO, shader_preprocessor
+from Malt.GL.Shader import Shader, UBO, shader_preprocessor, invalidate_bind_state
 
 from Malt.Render import Common
+from Malt.Render.Culling import SceneCulling, CULLING_STATS, frustum_planes, gl_matrix
 from Malt.PipelineParameters import *
 
 SHADER_DIR = path.join(path.dirname(__file__), 'Shaders')
 
+#Render Layer graph runs (opaque and transparent layers) since the last reset, and the maximum allowed by the Transparent Layers settings
+RENDER_LAYERS_STATS = {
+    'Rendered' : 0,
+    'Max' : 0,
+}
+
+def scene_matrices(matrices):
+    #Returns a list of flat 4x4 matrices (ctypes arrays or sequences) as a (n,16) float32 array
+    if len(matrices) and isinstance(matrices[0], ctypes.Array):
+        return np.frombuffer(b''.join(map(bytes, matrices)), np.float32).reshape(-1,16).copy()
+    return np.array(matrices, np.float32).reshape(-1,16)
+
+class SceneBatchBuffers():
+    #Persistent BATCH_MODELS and BATCH_IDS buffers.
+    #Keeps a copy of the uploaded data and only uploads the ranges that changed.
+
+    #Changed ranges closer than this (in instances) are merged into a single upload
+    MERGE_DISTANCE = 32
+
+    def __init__(self, max_instances):
+        self.max_instances = max_instances
+        self.models = (max_instances * (ctypes.c_float * 16))()
+        self.ids = (max_instances * ctypes.c_uint)()
+        self.models_UBO = UBO()
+        self.models_UBO.allocate(ctypes.sizeof(self.models))
+        self.ids_UBO = UBO()
+        self.ids_UBO.allocate(ctypes.sizeof(self.ids))
+        self.instances_count = 0
+    
+    def update(self, models, ids, instances_count):
+        new_models = np.frombuffer(models, np.float32, instances_count * 16).reshape(instances_count, 16)
+        new_ids = np.frombuffer(ids, np.uint32, instances_count)
+        old_models = np.frombuffer(self.models, np.float32, instances_count * 16).reshape(instances_count, 16)
+        old_ids = np.frombuffer(self.ids, np.uint32, instances_count)
+
+        changed = np.any(new_models != old_models, axis=1) | (new_ids != old_ids)
+        #Instances that were not uploaded yet
+        changed[self.instances_count:] = True
+        self.instances_count = max(self.instances_count, instances_count)
+        
+        changed = np.flatnonzero(changed)
+        if len(changed) == 0:
+            return
+        
+        old_models[changed] = new_models[changed]
+        old_ids[changed] = new_ids[changed]
+        
+        breaks = np.flatnonzero(np.diff(changed) > self.MERGE_DISTANCE)
+        starts = np.concatenate(([changed[0]], changed[breaks + 1]))
+        ends = np.concatenate((changed[breaks], [changed[-1]])) + 1
+
+        model_size = ctypes.sizeof(ctypes.c_float * 16)
+        id_size = ctypes.sizeof(ctypes.c_uint)
+        models_address = ctypes.addressof(self.models)
+        ids_address = ctypes.addressof(self.ids)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.models_UBO.load_sub_data(start * model_size, (end - start) * model_size, models_address + start * model_size)
+            self.ids_UBO.load_sub_data(start * id_size, (end - start) * id_size, ids_address + start * id_size)
+
+
 class Pipeline():
 
     SHADER_INCLUDE_PATHS = []
@@ -25,10 +88,7 @@ class Pipeline():
         if SHADER_DIR not in Pipeline.SHADER_INCLUDE_PATHS:
             Pipeline.SHADER_INCLUDE_PATHS.append(SHADER_DIR)
 
-        self.resolution = None
-        self.sample_count = 0
-        self.result = None
-        self.is_final_render = None
+        self.setup_render_state()
         
         plugins = [plugin for plugin in plugins if plugin.poll_pipeline(self)]
         self.setup_parameters()
@@ -44,6 +104,30 @@ class Pipeline():
             graph.setup_reflection()
         self.setup_resources()
     
+    def create_shared_instance(self):
+        #Returns a new pipeline instance that shares parameters, graphs and reflection with this one.
+        #Only the render state and resources are initialized for the new instance.
+        from copy import copy
+        instance = copy(self)
+        #Share the graphs and the default shader, but not their containers
+        instance.graphs = dict(self.graphs)
+        if isinstance(getattr(self, 'default_shader', None), dict):
+            instance.default_shader = dict(self.default_shader)
+        instance.setup_render_state()
+        instance.setup_resources()
+        return instance
+    
+    def setup_render_state(self):
+        self.resolution = None
+        self.sample_count = 0
+        self.result = None
+        self.is_final_render = None
+        self.scene_batch_buffers = {}
+        self.scene_culling = None
+        self.frustum_culling = True
+        self.culled_batch_buffers = {}
+        self.previous_culled_batch_buffers = {}
+    
     def setup_parameters(self):
         self.parameters = PipelineParameters()
         
@@ -55,6 +139,22 @@ class Pipeline():
             It's disabled by default since it slows down mesh loading in Blender.  
             When disabled, the *tangents* are calculated on the fly from the *pixel shader*.""")
         
+        self.parameters.mesh['optimize_mesh'] = Parameter(False, Type.BOOL, doc="""
+            Merge duplicated vertices and reorder triangles for better GPU vertex cache usage.  
+            It reduces the vertex count and speeds up rendering of heavy meshes, at the cost of slower mesh loading.""")
+        
+        self.parameters.mesh['compact_vertex_format'] = Parameter(False, Type.BOOL, doc="""
+            Store normals and tangents as 16 bit integers, UVs as half floats and vertex colors as 8 bit integers.  
+            It roughly halves the mesh memory and bandwidth, but can lower the precision of large UV coordinates.""")
+        
+        self.parameters.mesh['vertex_arena'] = Parameter(True, Type.BOOL, doc="""
+            Store the mesh inside shared vertex and index buffers, so meshes with the same vertex layout are drawn without switching VAOs.  
+            Disable it to give the mesh its own buffers.""")
+        
+        self.parameters.world['Culling.Frustum Culling'] = Parameter(True, Type.BOOL, doc="""
+            Skip the objects outside the view of each scene pass (camera and shadow maps).  
+            Objects with materials that displace vertices are never culled.""")
+        
         self.parameters.world['Material.Default'] = MaterialParameter('', '.mesh.glsl', doc=
             "The default material, used for objects with no material assigned.")
         
@@ -135,15 +235,15 @@ class Pipeline():
                     return full_path
         return None
     
-    def compile_shader_from_source(self, source, include_paths=[], defines=[]):
+    def compile_shader_from_source(self, source, include_paths=[], defines=[], deferred=False):
         vertex_src = shader_preprocessor(source, include_paths + self.SHADER_INCLUDE_PATHS, defines + ['VERTEX_SHADER'])
         pixel_src = shader_preprocessor(source, include_paths + self.SHADER_INCLUDE_PATHS, defines + ['PIXEL_SHADER'])
-        return Shader(vertex_src, pixel_src)
+        return Shader(vertex_src, pixel_src, deferred)
             
-    def compile_material_from_source(self, material_type, source, include_paths=[]):
-        return self.graphs[material_type].compile_material(source, include_paths)
+    def compile_material_from_source(self, material_type, source, include_paths=[], deferred=False):
+        return self.graphs[material_type].compile_material(source, include_paths, deferred)
     
-    def compile_material(self, shader_path, search_paths=[]):
+    def compile_material(self, shader_path, search_paths=[], deferred=False):
         try:
             file_dir = path.dirname(shader_path)
             source = '#include "{}"'.format(path.basename(shader_path))
@@ -151,7 +251,7 @@ class Pipeline():
             for graph in self.graphs.values():
                 if shader_path.endswith(graph.file_extension):
                     material_type = graph.name
-            return self.compile_material_from_source(material_type, source, [file_dir] + search_paths)
+            return self.compile_material_from_source(material_type, source, [file_dir] + search_paths, deferred)
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -202,54 +302,159 @@ class Pipeline():
         
         # Assume at least 64kb of UBO storage (d3d11 requirement) and max element size of mat4
         max_instances = 1000
-        models = (max_instances * (ctypes.c_float * 16))()
-        ids = (max_instances * ctypes.c_uint)()
 
+        #Gather all the instances in batch order, so each batch is a contiguous range of the scene arrays
+        groups = []
+        instances = []
         for material, meshes in result.items():
             for mesh, scale_groups in meshes.items():
                 for scale_group, objs in scale_groups.items():
-                    batches = []
-                    scale_groups[scale_group] = batches
-                    
-                    i = 0
-                    batch_length = len(objs)
-                    
-                    while i < batch_length:
-                        instance_i = i % max_instances
-                        models[instance_i] = objs[i].matrix
-                        ids[instance_i] = objs[i].parameters['ID']
-
-                        i+=1
-                        instances_count = instance_i + 1
-
-                        if i == batch_length or instances_count == max_instances:
-                            local_models = ((ctypes.c_float * 16) * instances_count).from_address(ctypes.addressof(models))
-                            local_ids = (ctypes.c_uint * instances_count).from_address(ctypes.addressof(ids))
-
-                            models_UBO = UBO()
-                            ids_UBO = UBO()
-
-                            models_UBO.load_data(local_models)
-                            ids_UBO.load_data(local_ids)
-
-                            batches.append({
-                                'instances_count': instances_count,
-                                'BATCH_MODELS':models_UBO,
-                                'BATCH_IDS':ids_UBO,
-                            })
+                    groups.append((material, mesh, scale_group, len(instances), len(objs)))
+                    instances.extend(objs)
+        
+        models = scene_matrices([obj.matrix for obj in instances])
+        ids = np.array([obj.parameters['ID'] for obj in instances], np.uint32)
+
+        #Batch buffers persist across scene updates, so only the instances that changed are uploaded
+        batch_buffers = {}
+
+        for material, mesh, scale_group, start, count in groups:
+            batches = []
+            result[material][mesh][scale_group] = batches
+
+            key = (self.get_scene_batch_key(material, mesh), scale_group, 0)
+            while key in batch_buffers:
+                key = key[:2] + (key[2] + 1,)
+            group_buffers = self.scene_batch_buffers.get(key, [])
+            batch_buffers[key] = group_buffers
+            
+            for batch_index, batch_start in enumerate(range(start, start + count, max_instances)):
+                batch_end = min(batch_start + max_instances, start + count)
+                instances_count = batch_end - batch_start
+                if batch_index == len(group_buffers):
+                    group_buffers.append(SceneBatchBuffers(max_instances))
+                buffers = group_buffers[batch_index]
+                buffers.update(models[batch_start:batch_end], ids[batch_start:batch_end], instances_count)
+
+                batches.append({
+                    'instances_count': instances_count,
+                    'BATCH_MODELS':buffers.models_UBO,
+                    'BATCH_IDS':buffers.ids_UBO,
+                    #Range in the scene instance arrays, used for culling
+                    'instances': (batch_start, batch_end),
+                })
+            
+            del group_buffers[len(batches):]
+        
+        self.scene_batch_buffers = batch_buffers
+        self.build_scene_culling(instances, models, ids)
             
         return result
     
-    def draw_scene_pass(self, render_target, scene_batches, pass_name=None, default_shader=None, shader_resources={}, depth_test_function=GL_LEQUAL):
-        glDisable(GL_BLEND)
+    def build_scene_culling(self, instances, models, ids):
+        #Build the BVH over the instances world space bounds. It's only rebuilt when the instances change.
+        #Instances with vertex displacement materials have no bounds, so they're never culled.
+        def get_bounds(obj):
+            if obj.material and obj.material.shader:
+                if any(shader.displaces_vertices for shader in obj.material.shader.values() if shader):
+                    return None
+            return getattr(obj.mesh.mesh, 'bounds', None)
+        bounds = [get_bounds(obj) for obj in instances]
+        has_bounds = np.array([b is not None for b in bounds], bool)
+        bounds_min = np.array([b[0] if b else (0,0,0) for b in bounds], np.float32).reshape(-1,3)
+        bounds_max = np.array([b[1] if b else (0,0,0) for b in bounds], np.float32).reshape(-1,3)
+        
+        previous = self.scene_culling
+        if (previous and np.array_equal(previous.models, models) and np.array_equal(previous.ids, ids) and
+            np.array_equal(previous.bounds_min, bounds_min) and np.array_equal(previous.bounds_max, bounds_max) and
+            np.array_equal(previous.unbounded, ~has_bounds)):
+            return
+        
+        #Scene matrices are column-major
+        matrices = models.reshape(-1,4,4).transpose(0,2,1)
+        self.scene_culling = SceneCulling(matrices, bounds_min, bounds_max, has_bounds)
+        self.scene_culling.models = models
+        self.scene_culling.ids = ids
+        self.scene_culling.bounds_min = bounds_min
+        self.scene_culling.bounds_max = bounds_max
+        #Keep only the compacted buffers that were used since the last update
+        self.previous_culled_batch_buffers = self.culled_batch_buffers
+        self.culled_batch_buffers = {}
+    
+    def cull_scene(self, shader_resources):
+        #Returns the visibility mask of the scene instances for the view loaded in COMMON_UNIFORMS, or None
+        common_buffer = shader_resources.get('COMMON_UNIFORMS')
+        if common_buffer is None:
+            return None
+        #Depth clamped passes (sun shadows) draw geometry outside the near and far planes
+        near_far = glIsEnabled(GL_DEPTH_CLAMP) == GL_FALSE
+        return self.cull_view(common_buffer.data.CAMERA, common_buffer.data.PROJECTION, near_far, near_far)
+    
+    def cull_view(self, camera, projection, near=True, far=True, candidates=None):
+        #Returns the visibility mask of the scene instances inside the camera frustum, or None when culling is disabled.
+        #candidates is an optional mask of the instances to test
+        if self.frustum_culling == False or self.scene_culling is None:
+            return None
+        view_projection = gl_matrix(projection) @ gl_matrix(camera)
+        return self.scene_culling.cull(frustum_planes(view_projection, near, far), candidates)
+    
+    def cull_sphere(self, center, radius):
+        if self.frustum_culling == False or self.scene_culling is None:
+            return None
+        return self.scene_culling.cull_sphere(center, radius)
+    
+    def get_visible_instances(self, scene_batches, visibility):
+        #Returns the mask of the visible instances that belong to the given batches
+        result = np.zeros(len(visibility), bool)
+        for meshes in scene_batches.values():
+            for scale_groups in meshes.values():
+                for batches in scale_groups.values():
+                    for batch in batches:
+                        start, end = batch['instances']
+                        result[start:end] = visibility[start:end]
+        return result
+    
+    def get_culled_batch(self, batch, visible, key):
+        #Returns the (models, ids) buffers with only the visible instances of the batch
+        buffers = self.culled_batch_buffers.get(key)
+        if buffers is None:
+            buffers = self.previous_culled_batch_buffers.pop(key, None)
+        if buffers is None or buffers.max_instances < batch['instances_count']:
+            buffers = SceneBatchBuffers(batch['instances_count'])
+        self.culled_batch_buffers[key] = buffers
+        start, end = batch['instances']
+        models = np.ascontiguousarray(self.scene_culling.models[start:end][visible])
+        ids = np.ascontiguousarray(self.scene_culling.ids[start:end][visible])
+        buffers.update(models, ids, len(ids))
+        return buffers.models_UBO, buffers.ids_UBO
+    
+    def get_scene_batch_key(self, material, mesh):
+        #Scene materials and meshes are new objects on every scene update,
+        #so use their sources as keys when available to reuse the same batch buffers
+        material_key = getattr(material, 'path', None)
+        mesh_key = (getattr(mesh.mesh, 'name', None), getattr(mesh.mesh, 'submesh_index', None))
+        return (material_key, mesh_key)
+    
+    def draw_scene_pass(self, render_target, scene_batches, pass_name=None, default_shader=None, shader_resources={}, depth_test_function=GL_LEQUAL, visibility=None,
+        blend=False, depth_write=True):
+        #When blend is True, the blend function must be set by the caller
+        if blend:
+            glEnable(GL_BLEND)
+        else:
+            glDisable(GL_BLEND)
         glEnable(GL_DEPTH_TEST)
         glDepthFunc(depth_test_function)
-        glDepthMask(GL_TRUE)
+        glDepthMask(GL_TRUE if depth_write else GL_FALSE)
         glDepthRange(0,1)
 
         render_target.bind()
 
         _double_sided = None
+        _VAO = None
+
+        #A precomputed visibility mask can be passed (see cull_view), otherwise the COMMON_UNIFORMS view is used
+        if visibility is None:
+            visibility = self.cull_scene(shader_resources)
 
         for material in scene_batches.keys():
             shader = default_shader
@@ -267,7 +472,12 @@ class Pipeline():
             
             meshes = scene_batches[material]
             for mesh in meshes.keys():
-                mesh.mesh.bind()
+                #Sub-allocated meshes share their VAO (see Malt.GL.VertexArena)
+                if mesh.mesh.VAO is None or mesh.mesh.VAO is not _VAO:
+                    mesh.mesh.bind()
+                    _VAO = mesh.mesh.VAO
+                index_offset = ctypes.c_void_p(mesh.mesh.index_offset())
+                base_vertex = mesh.mesh.base_vertex()
                 
                 double_sided = mesh.parameters['double_sided']
                 if double_sided != _double_sided:
@@ -297,12 +507,28 @@ class Pipeline():
                                 shader.uniforms['MIRROR_SCALE'].bind(True)
                 
                     for batch in batches:
-                        batch['BATCH_MODELS'].bind(shader.uniform_blocks['BATCH_MODELS'])
-                        batch['BATCH_IDS'].bind(shader.uniform_blocks['BATCH_IDS'])
-                        glDrawElementsInstanced(GL_TRIANGLES, mesh.mesh.index_count, GL_UNSIGNED_INT, NULL, batch['instances_count'])
+                        models = batch['BATCH_MODELS']
+                        ids = batch['BATCH_IDS']
+                        instances_count = batch['instances_count']
+                        if visibility is not None and 'instances' in batch:
+                            start, end = batch['instances']
+                            visible = visibility[start:end]
+                            visible_count = int(np.count_nonzero(visible))
+                            CULLING_STATS['Instances'] += instances_count
+                            CULLING_STATS['Culled'] += instances_count - visible_count
+                            if visible_count == 0:
+                                continue
+                            if visible_count < instances_count:
+                                models, ids = self.get_culled_batch(batch, visible, (pass_name, id(render_target), start))
+                                instances_count = visible_count
+                        models.bind(shader.uniform_blocks['BATCH_MODELS'])
+                        ids.bind(shader.uniform_blocks['BATCH_IDS'])
+                        glDrawElementsInstancedBaseVertex(GL_TRIANGLES, mesh.mesh.index_count, mesh.mesh.index_type, 
+                            index_offset, instances_count, base_vertex)
 
 
     def render(self, resolution, scene, is_final_render, is_new_frame):
+        invalidate_bind_state()
         self.is_final_render = is_final_render
         if self.resolution != resolution:
             self.resolution = resolution
@@ -315,6 +541,7 @@ class Pipeline():
         if self.needs_more_samples() == False:
             return self.result
         
+        self.frustum_culling = scene.world_parameters['Culling.Frustum Culling']
         self.common_buffer.load(scene, resolution)
         self.result = self.do_render(resolution, scene, is_final_render, is_new_frame)
         
@@ -1,4 +1,6 @@
-from Malt.Utils import scan_dirs
+import weakref
+
+from Malt.Utils import scan_dirs, LOG
 
 
 class PipelineGraphIO():
@@ -90,12 +92,21 @@ class GLSLGraphIO(PipelineGraphIO):
 
 class GLSLPipelineGraph(PipelineGraph):
 
-    def __init__(self, name, graph_type, default_global_scope, default_shader_src, shaders=['SHADER'], graph_io=[]):
+    def __init__(self, name, graph_type, default_global_scope, default_shader_src, shaders=['SHADER'], graph_io=[],
+        material_uniform_block=False, layered_shaders=[], vertex_displacement_marker=None):
         file_extension = f'.{name.lower()}.glsl'
         super().__init__(name, 'GLSL', file_extension, graph_type, graph_io)
         self.default_global_scope = default_global_scope
         self.default_shader_src = default_shader_src
         self.shaders = shaders
+        #Pack the material parameters into a single uniform block (see Malt.GL.Shader.pack_material_uniforms)
+        self.material_uniform_block = material_uniform_block
+        #Shaders that also get a {shader}_LAYERED variant, that renders multiple views in a single draw (see Common.glsl LAYERED_PASS)
+        #The variants are only compiled the first time they're needed (see get_layered_shader)
+        self.layered_shaders = layered_shaders
+        #Materials whose preprocessed vertex source contains this marker can move vertices on the GPU,
+        #so their mesh bounds can't be used for culling (see displaces_vertices)
+        self.vertex_displacement_marker = vertex_displacement_marker
         from multiprocessing.dummy import Pool
         self.pool = Pool(16)
     
@@ -155,7 +166,7 @@ class GLSLPipelineGraph(PipelineGraph):
         code += '\n\n'
         return code
     
-    def compile_material(self, source, include_paths=[]):
+    def compile_material(self, source, include_paths=[], deferred=False):
         def preprocess(params):
             return self.preprocess_shader_from_source(*params)
         
@@ -164,12 +175,68 @@ class GLSLPipelineGraph(PipelineGraph):
             params.append((source, include_paths, [shader, 'VERTEX_SHADER']))
             params.append((source, include_paths, [shader, 'PIXEL_SHADER']))
         preprocessed = self.pool.map(preprocess, params)
+        #The material defines are usually inside its included files, so check the resolved source
+        displaces_vertices = any(self.displaces_vertices(vertex_source) for vertex_source in preprocessed[0::2])
 
-        from Malt.GL.Shader import Shader
+        from Malt.GL.Shader import Shader, pack_material_uniforms
         shaders = {}
         for shader in self.shaders:
-            shaders[shader] = Shader(preprocessed.pop(0), preprocessed.pop(0))
+            sources = [preprocessed.pop(0), preprocessed.pop(0)]
+            uniform_defaults = {}
+            if self.material_uniform_block:
+                sources, uniform_defaults = pack_material_uniforms(sources)
+            shaders[shader] = Shader(*sources, deferred, uniform_defaults)
+            shaders[shader].displaces_vertices = displaces_vertices
+            if shader in self.layered_shaders:
+                #Shared by all the shader copies, so the variant is compiled only once
+                shaders[shader].layered_variant = {
+                    'source' : source,
+                    'include_paths' : include_paths,
+                    'defines' : [shader, 'LAYERED_PASS'],
+                    'shader' : None,
+                }
         return shaders
+    
+    def displaces_vertices(self, vertex_source):
+        return self.vertex_displacement_marker is not None and self.vertex_displacement_marker in vertex_source
+    
+    def get_layered_shader(self, shader):
+        #Returns a copy of the shader _LAYERED variant, with the same parameters as the shader
+        #Returns None if the shader doesn't have one or it failed to compile
+        if shader is None or shader.error or shader.layered_variant is None:
+            return None
+        variant = shader.layered_variant
+        if variant['shader'] is None:
+            def preprocess(params):
+                return self.preprocess_shader_from_source(*params)
+            
+            defines = variant['defines']
+            preprocessed = self.pool.map(preprocess, [
+                (variant['source'], variant['include_paths'], defines + ['VERTEX_SHADER']),
+                (variant['source'], variant['include_paths'], defines + ['PIXEL_SHADER']),
+                #The geometry shader doesn't run any material code
+                ('#include "Common.glsl"\nvoid main(){ LAYERED_GEOMETRY_SHADER(); }\n', [], defines + ['GEOMETRY_SHADER']),
+            ])
+            from Malt.GL.Shader import Shader, pack_material_uniforms
+            sources = preprocessed[:2]
+            uniform_defaults = {}
+            if self.material_uniform_block:
+                sources, uniform_defaults = pack_material_uniforms(sources)
+            variant['shader'] = Shader(*sources, False, uniform_defaults, preprocessed[2])
+            variant['shader'].displaces_vertices = shader.displaces_vertices
+            if variant['shader'].error:
+                LOG.error(variant['shader'].error)
+        if variant['shader'].error:
+            return None
+        
+        result = variant['shader'].copy()
+        for name, uniform in shader.uniforms.items():
+            if name in result.uniforms and name not in result.textures:
+                result.uniforms[name].set_value(uniform.value)
+        for name, texture in shader.textures.items():
+            if name in result.textures:
+                result.textures[name] = texture
+        return result
 
 class PythonGraphIO(PipelineGraphIO):
 
@@ -185,7 +252,9 @@ class PythonPipelineGraph(PipelineGraph):
     def __init__(self, name, graph_io):
         extension = f'-{name}.py'
         super().__init__(name, 'Python', extension, self.GLOBAL_GRAPH, graph_io)
-        self.node_instances = {}
+        #Graphs are shared across pipeline instances, so node instances are stored per pipeline.
+        #Keys are weak, so released pipelines don't keep their node render targets alive.
+        self.node_instances = weakref.WeakKeyDictionary()
         self.nodes = {}
 
     def get_serializable_copy(self):
@@ -198,7 +267,7 @@ class PythonPipelineGraph(PipelineGraph):
         super().setup_reflection()
         import importlib.util
         nodes = []
-        self.node_instances = {}
+        self.node_instances.clear()
         for file in self.lib_files:
             try:
                 spec = importlib.util.spec_from_file_location("_dynamic_node_module_", file)
@@ -225,12 +294,15 @@ class PythonPipelineGraph(PipelineGraph):
     
     def run_source(self, pipeline, source, PARAMETERS, IN, OUT):
         try:
+            if pipeline not in self.node_instances:
+                self.node_instances[pipeline] = {}
+            node_instances = self.node_instances[pipeline]
             def run_node(node_name, node_type, parameters):
-                if node_name not in self.node_instances.keys():
+                if node_name not in node_instances.keys():
                     node_class = self.nodes[node_type]
-                    self.node_instances[node_name] = node_class(pipeline)
+                    node_instances[node_name] = node_class(pipeline)
                 parameters['__GLOBALS__'] = PARAMETERS
-                self.node_instances[node_name].execute(parameters)
+                node_instances[node_name].execute(parameters)
             exec(source)
         except:
             import traceback
@@ -41,10 +41,10 @@ class MiniPipeline(Pipeline):
         
         self.default_shader = MiniPipeline.DEFAULT_SHADER
         
-    def compile_material_from_source(self, material_type, source, include_paths=[]):
+    def compile_material_from_source(self, material_type, source, include_paths=[], deferred=False):
         return {
             'MAIN_PASS' : self.compile_shader_from_source(
-                source, include_paths, ['MAIN_PASS']
+                source, include_paths, ['MAIN_PASS'], deferred
             )
         }
     
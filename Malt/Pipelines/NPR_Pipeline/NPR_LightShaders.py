@@ -1,39 +1,28 @@
 
+import numpy as np
+
 from Malt.GL.GL import *
-from Malt.GL.Shader import UBO
-from Malt.GL.Texture import TextureArray
+from Malt.GL.Texture import TextureArray, TextureBuffer
 from Malt.GL.RenderTarget import ArrayLayerTarget, RenderTarget
 
-from Malt.Render import Lighting
-
 from Malt.PipelineGraph import *
 
-import ctypes
-
 class NPR_LightShaders():
 
     def __init__(self):
-        class C_NPR_LightShadersBuffer(ctypes.Structure):
-            _fields_ = [
-                ('custom_shading_index', ctypes.c_int*Lighting.MAX_LIGHTS),
-            ]
-        self.data = C_NPR_LightShadersBuffer()
         self.custom_shading_count = 0
-        self.UBO = UBO()
+        self.indices = TextureBuffer(GL_R32I)
 
         self.texture = None
         self.fbos = None
     
     def load(self, pipeline, depth_texture, scene):
-        self.custom_shading_count = 0
-        for i, light in enumerate(scene.lights):
-            custom_shading_index = -1
-            if light.parameters['Shader'] is not None:
-                custom_shading_index = self.custom_shading_count
-                self.custom_shading_count += 1
-            self.data.custom_shading_index[i] = custom_shading_index
-
-        self.UBO.load_data(self.data)
+        #The index of each light in the custom shading texture array, -1 for lights without custom shading
+        has_shader = np.array([light.parameters['Shader'] is not None for light in scene.lights], bool)
+        indices = np.full(len(has_shader), -1, np.int32)
+        indices[has_shader] = np.arange(np.count_nonzero(has_shader))
+        self.custom_shading_count = int(np.count_nonzero(has_shader))
+        self.indices.update(indices)
 
         if self.custom_shading_count == 0:
             return
@@ -59,8 +48,7 @@ class NPR_LightShaders():
                 pipeline.draw_screen_pass(shader, self.fbos[i])
     
     def shader_callback(self, shader):
-        if 'LIGHTS_CUSTOM_SHADING' in shader.uniform_blocks:
-            self.UBO.bind(shader.uniform_blocks['LIGHTS_CUSTOM_SHADING'])
+        shader.textures['LIGHTS_CUSTOM_SHADING'] = self.indices
         shader.textures['IN_LIGHT_CUSTOM_SHADING'] = self.texture
 
 
@@ -1,25 +1,18 @@
+import numpy as np
+
 from Malt.GL.GL import *
-from Malt.GL.Shader import UBO
-from Malt.GL.Texture import TextureArray, CubeMapArray
-from Malt.GL.RenderTarget import ArrayLayerTarget, RenderTarget
+from Malt.GL.Texture import TextureArray, CubeMapArray, TextureBuffer
+from Malt.GL.RenderTarget import ArrayLayerTarget, LayeredTarget, RenderTarget, RenderTargetLayers
 
 from Malt.Render import Lighting
 
 class NPR_LightsGroupsBuffer():
 
     def __init__(self):
-        class C_NPR_LightGroupsBuffer(ctypes.Structure):
-            _fields_ = [
-                ('light_group_index', ctypes.c_int*Lighting.MAX_LIGHTS),
-            ]
-        self.data = C_NPR_LightGroupsBuffer()
-        self.UBO = UBO()
+        self.texture = TextureBuffer(GL_R32I)
     
     def load(self, scene):
-        for i, light in enumerate(scene.lights):
-            self.data.light_group_index[i] = light.parameters['Light Group']
-
-        self.UBO.load_data(self.data)
+        self.texture.update(np.array([light.parameters['Light Group'] for light in scene.lights], np.int32))
 
         for material in scene.batches.keys():
             for shader in material.shader.values():
@@ -27,8 +20,7 @@ class NPR_LightsGroupsBuffer():
                     shader.uniforms['MATERIAL_LIGHT_GROUPS'].set_value(material.parameters['Light Groups.Light'])
 
     def shader_callback(self, shader):
-        if 'LIGHT_GROUPS' in shader.uniform_blocks:
-            self.UBO.bind(shader.uniform_blocks['LIGHT_GROUPS'])    
+        shader.textures['LIGHT_GROUPS'] = self.texture
 
 
 class NPR_ShadowMaps(Lighting.ShadowMaps):
@@ -39,20 +31,21 @@ class NPR_ShadowMaps(Lighting.ShadowMaps):
         self.sun_id_t = None
         self.point_id_t = None
     
+    def setup_spot_atlas(self, create_fbos=True):
+        super().setup_spot_atlas(False)
+        self.spot_id_t = TextureArray(self.spot_atlas_size, 1, 
+            GL_R16UI, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
+        if create_fbos:
+            self.spot_atlas_fbo = RenderTarget([ArrayLayerTarget(self.spot_id_t, 0)], ArrayLayerTarget(self.spot_depth_t, 0))
+    
     def setup(self, create_fbos=True):
         super().setup(False)
-        self.spot_id_t = TextureArray((self.spot_resolution, self.spot_resolution), self.max_spots, 
-            GL_R16UI, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
         self.sun_id_t = TextureArray((self.sun_resolution, self.sun_resolution), self.max_suns, 
             GL_R16UI, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
         self.point_id_t = CubeMapArray((self.point_resolution, self.point_resolution), self.max_points, 
             GL_R16UI, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
         
         if create_fbos:
-            self.spot_fbos = []
-            for i in range(self.spot_depth_t.length):
-                self.spot_fbos.append(RenderTarget([ArrayLayerTarget(self.spot_id_t, i)], ArrayLayerTarget(self.spot_depth_t, i)))
-
             self.sun_fbos = []
             for i in range(self.sun_depth_t.length):
                 self.sun_fbos.append(RenderTarget([ArrayLayerTarget(self.sun_id_t, i)], ArrayLayerTarget(self.sun_depth_t, i)))
@@ -60,14 +53,12 @@ class NPR_ShadowMaps(Lighting.ShadowMaps):
             self.point_fbos = []
             for i in range(self.point_depth_t.length*6):
                 self.point_fbos.append(RenderTarget([ArrayLayerTarget(self.point_id_t, i)], ArrayLayerTarget(self.point_depth_t, i)))
+            
+            point_layered_fbo = RenderTarget([LayeredTarget(self.point_id_t)], LayeredTarget(self.point_depth_t))
+            self.point_layers = [RenderTargetLayers(point_layered_fbo, i*6, 6) for i in range(self.point_depth_t.length)]
     
-    def clear(self, spot_count, sun_count, point_count):
-        for i in range(spot_count):
-            self.spot_fbos[i].clear([0], depth=1)
-        for i in range(sun_count):
-            self.sun_fbos[i].clear([0], depth=1)
-        for i in range(point_count*6):
-            self.point_fbos[i].clear([0], depth=1)
+    def clear_fbo(self, fbo):
+        fbo.clear([0], depth=1)
     
     def shader_callback(self, shader):
         super().shader_callback(shader)
@@ -83,18 +74,19 @@ class NPR_TransparentShadowMaps(NPR_ShadowMaps):
         self.sun_color_t = None
         self.point_color_t = None
     
+    def setup_spot_atlas(self, create_fbos=True):
+        super().setup_spot_atlas(False)
+        self.spot_color_t = TextureArray(self.spot_atlas_size, 1, GL_RGB8)
+        if create_fbos:
+            targets = [ArrayLayerTarget(self.spot_id_t, 0), ArrayLayerTarget(self.spot_color_t, 0)]
+            self.spot_atlas_fbo = RenderTarget(targets, ArrayLayerTarget(self.spot_depth_t, 0))
+    
     def setup(self, create_fbos=True):
         super().setup(False)
-        self.spot_color_t = TextureArray((self.spot_resolution, self.spot_resolution), self.max_spots, GL_RGB8)
         self.sun_color_t = TextureArray((self.sun_resolution, self.sun_resolution), self.max_suns, GL_RGB8)
         self.point_color_t = CubeMapArray((self.point_resolution, self.point_resolution), self.max_points, GL_RGB8)
         
         if create_fbos:
-            self.spot_fbos = []
-            for i in range(self.spot_depth_t.length):
-                targets = [ArrayLayerTarget(self.spot_id_t, i), ArrayLayerTarget(self.spot_color_t, i)]
-                self.spot_fbos.append(RenderTarget(targets, ArrayLayerTarget(self.spot_depth_t, i)))
-
             self.sun_fbos = []
             for i in range(self.sun_depth_t.length):
                 targets = [ArrayLayerTarget(self.sun_id_t, i), ArrayLayerTarget(self.sun_color_t, i)]
@@ -104,14 +96,13 @@ class NPR_TransparentShadowMaps(NPR_ShadowMaps):
             for i in range(self.point_depth_t.length*6):
                 targets = [ArrayLayerTarget(self.point_id_t, i), ArrayLayerTarget(self.point_color_t, i)]
                 self.point_fbos.append(RenderTarget(targets, ArrayLayerTarget(self.point_depth_t, i)))
+            
+            targets = [LayeredTarget(self.point_id_t), LayeredTarget(self.point_color_t)]
+            point_layered_fbo = RenderTarget(targets, LayeredTarget(self.point_depth_t))
+            self.point_layers = [RenderTargetLayers(point_layered_fbo, i*6, 6) for i in range(self.point_depth_t.length)]
     
-    def clear(self, spot_count, sun_count, point_count):
-        for i in range(spot_count):
-            self.spot_fbos[i].clear([0, (0,0,0,0)], depth=1)
-        for i in range(sun_count):
-            self.sun_fbos[i].clear([0, (0,0,0,0)], depth=1)
-        for i in range(point_count*6):
-            self.point_fbos[i].clear([0, (0,0,0,0)], depth=1)
+    def clear_fbo(self, fbo):
+        fbo.clear([0, (0,0,0,0)], depth=1)
 
     def shader_callback(self, shader):
         shader.textures['TRANSPARENT_SHADOWMAPS_DEPTH_SPOT'] = self.spot_depth_t
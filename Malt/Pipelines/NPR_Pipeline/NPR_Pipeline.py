@@ -66,9 +66,12 @@ class NPR_Pipeline(Pipeline):
         shader_dir = path.join(path.dirname(__file__), 'Shaders')
         if shader_dir not in self.SHADER_INCLUDE_PATHS:
             self.SHADER_INCLUDE_PATHS.append(shader_dir)
+        super().__init__(plugins)
+    
+    def setup_render_state(self):
+        super().setup_render_state()
         self.sampling_grid_size = 1
         self.samples = None
-        super().__init__(plugins)
     
     def setup_parameters(self):
         super().setup_parameters()
@@ -96,6 +99,10 @@ class NPR_Pipeline(Pipeline):
         self.parameters.light['Light Group'] = Parameter(1, Type.INT, doc=
             "Lights only affect materials with a matching *Light Group* value.")
         
+        self.parameters.light['Shadow Priority'] = Parameter(1.0, Type.FLOAT, doc="""
+            Scales the spot light shadow map resolution, which is based on the light size on screen.  
+            Increase it for lights whose shadows matter the most and lower it for background lights.""")
+        
         self.parameters.light['Shader'] = MaterialParameter('', '.light.glsl', doc=
             "When set, the *Material* with a custom *Light Shader* or *Light Node Tree* that will be used to render this light.")
         
@@ -114,6 +121,9 @@ class NPR_Pipeline(Pipeline):
             default_global_scope=_MESH_SHADER_HEADER,
             default_shader_src=_DEFAULT_SHADER_SRC,
             shaders=['PRE_PASS', 'MAIN_PASS', 'SHADOW_PASS'],
+            layered_shaders=['SHADOW_PASS'],
+            material_uniform_block=True,
+            vertex_displacement_marker='MALT_VERTEX_DISPLACEMENT',
             graph_io=[
                 GLSLGraphIO(
                     name='PRE_PASS_PIXEL_SHADER',
@@ -1,4 +1,5 @@
 from Malt.GL import GL
+from Malt import Pipeline
 from Malt.GL.Texture import Texture
 from Malt.GL.RenderTarget import RenderTarget
 from Malt.PipelineNode import PipelineNode
@@ -18,6 +19,8 @@ class RenderLayers(PipelineNode):
         self.texture_targets = {}
         self.render_target = None
         self.custom_io = []
+        #The PrePass occlusion query of the current layer (see begin_layer_conditional_draw)
+        self.layer_query = None
     
     @staticmethod
     def get_pass_type():
@@ -32,6 +35,12 @@ class RenderLayers(PipelineNode):
             Incresing this values lowers performance.
         """)
         inputs['Transparent Layers @ Preview'] = Parameter(2, Type.INT)
+        inputs['Weighted Blended OIT'] = Parameter(False, Type.BOOL, doc="""
+            Render all the transparent layers in a single layer using *Weighted Blended Order-Independent Transparency*, instead of *depth peeling*.  
+            Much faster for scenes with many overlapping transparent surfaces and *Transparent Layers* is ignored,
+            but overlapping transparent surfaces are blended by their opacity weighted average instead of by depth order.  
+            *Pre Pass* outputs and *Screen Passes* only see the front-most transparent layer.
+        """)
         return inputs
     
     @classmethod
@@ -63,6 +72,14 @@ class RenderLayers(PipelineNode):
             _BLEND_TRANSPARENCY_SHADER.textures[f'IN_FRONT[{str(i)}]'] = front_textures[i]
         self.pipeline.draw_screen_pass(_BLEND_TRANSPARENCY_SHADER, fbo)
     
+    def begin_layer_conditional_draw(self, query):
+        #Called by the PrePass of the transparent layers, after drawing its query.
+        #Until the end of the layer, draws only run if the query passed any sample.
+        #Empty layers don't change the layer inputs (the PrePass copies are skipped too), so the next layers are empty as well.
+        if self.layer_query is None:
+            self.layer_query = query
+            query.begin_conditional_draw()
+    
     def execute(self, parameters):
         inputs = parameters['IN']
         outputs = parameters['OUT']
@@ -75,29 +92,52 @@ class RenderLayers(PipelineNode):
                 self.resolution = self.pipeline.resolution
                 self.custom_io = custom_io
 
-            self.fbo_color.clear([(0,0,0,0)]*len(self.fbo_color.targets))
-            self.fbo_transparent.clear([(0,0,0,0)]*len(self.fbo_transparent.targets))
+            #Without transparent batches only the opaque layer is rendered
+            opaque_batches, transparent_batches = self.pipeline.get_scene_batches(scene)
+            has_transparency = len(transparent_batches) > 0
+            if has_transparency:
+                self.fbo_color.clear([(0,0,0,0)]*len(self.fbo_color.targets))
+                self.fbo_transparent.clear([(0,0,0,0)]*len(self.fbo_transparent.targets))
+            
+            #Weighted Blended OIT renders all the transparent layers at once (see MainPass)
+            weighted_oit = inputs['Weighted Blended OIT']
+            max_layers = 2 if weighted_oit else inputs['Transparent Layers'] + 1
             
             self.layer_index = 0
-            self.layer_count = inputs['Transparent Layers'] + 1
+            self.layer_count = max_layers if has_transparency else 1
+            Pipeline.RENDER_LAYERS_STATS['Max'] += max_layers
             graph['parameters']['__RENDER_LAYERS__'] = self
+            graph['parameters']['__WEIGHTED_OIT__'] = weighted_oit
             for i in range(self.layer_count):
                 graph['parameters']['__LAYER_INDEX__'] = self.layer_index
                 graph['parameters']['__LAYER_COUNT__'] = self.layer_count
+                self.layer_query = None
                 self.pipeline.graphs['Render Layer'].run_source(self.pipeline, graph['source'], graph['parameters'], inputs, outputs)
+                Pipeline.RENDER_LAYERS_STATS['Rendered'] += 1
                 results = []
                 for io in self.custom_io:
                     if io['io'] == 'out' and io['type'] == 'Texture':
                         results.append(outputs[io['name']])
                 if i == 0:
+                    if has_transparency == False:
+                        self.pipeline.copy_textures(self.fbo_color, results)
+                        break
                     self.pipeline.copy_textures(self.fbo_opaque, results)
                 else:
+                    #Stop peeling once the PrePass doesn't find any fragment behind the last layer.
+                    #The result is only checked if it's already available, to avoid stalling on the GPU.
+                    #Otherwise, the blending of empty layers is skipped on the GPU by the conditional draw.
+                    if self.layer_query and self.layer_query.get_result_no_wait() == 0:
+                        self.layer_query.end_conditional_draw()
+                        break
                     self.blend_transparency(results, self.fbo_transparent.targets, self.fbo_color)
                     self.pipeline.copy_textures(self.fbo_transparent, self.fbo_color.targets)
+                if self.layer_query:
+                    self.layer_query.end_conditional_draw()
                 self.layer_index += 1     
             
-            self.blend_transparency(self.fbo_opaque.targets, self.fbo_transparent.targets, self.fbo_color)
+            if has_transparency:
+                self.blend_transparency(self.fbo_opaque.targets, self.fbo_transparent.targets, self.fbo_color)
             outputs.update(self.color_targets)
 
-
 NODE = RenderLayers  
@@ -1,11 +1,18 @@
+import numpy as np
+
 from Malt.GL.GL import *
 from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
 
 from Malt.Render import Common
 from Malt.Render import Lighting
+from Malt.Render import LightClusters
+from Malt.Render.Culling import SHADOW_CASTERS_STATS
 from Malt.Pipelines.NPR_Pipeline import NPR_Lighting
 
+#Render the 6 sides of point light shadows in a single layered pass (see Common.glsl LAYERED_PASS)
+USE_LAYERED_POINT_SHADOWS = True
+
 class SceneLighting(PipelineNode):
     """
     Renders the shadow maps and attaches them along the scene lights data to the *Scene* shader resources.
@@ -18,7 +25,18 @@ class SceneLighting(PipelineNode):
         self.shadowmaps_opaque = NPR_Lighting.NPR_ShadowMaps()
         self.shadowmaps_transparent = NPR_Lighting.NPR_TransparentShadowMaps()
         self.common_buffer = Common.CommonBuffer()
+        self.layered_views_buffer = Common.LayeredViewsBuffer()
+        #The clusters are built for the scene camera, so each pipeline needs its own
+        self.light_clusters = LightClusters.LightClusters()
+        #{(light type, light index) : (inputs key, sample offset)} for the shadow maps currently stored in each slot
+        self.shadow_cache = {}
+        self.transparent_shadows_cleared = False
 
+    def setup_layered_shader(self, shaders):
+        #Layered shadow shaders are compiled the first time a point light needs them
+        if shaders and 'SHADOW_PASS' in shaders and 'SHADOW_PASS_LAYERED' not in shaders:
+            shaders['SHADOW_PASS_LAYERED'] = self.pipeline.graphs['Mesh'].get_layered_shader(shaders['SHADOW_PASS'])
+    
     @classmethod
     def reflect_inputs(cls):
         inputs = {}
@@ -27,8 +45,9 @@ class SceneLighting(PipelineNode):
             "Shadowmap resolution for point lights *(for each cubemap side)*.")
         inputs['Point Resolution @ Preview'] = Parameter(512, Type.INT)
         
-        inputs['Spot Resolution'] = Parameter(2048, Type.INT, doc=
-            "Shadowmap resolution for spot lights.")
+        inputs['Spot Resolution'] = Parameter(2048, Type.INT, doc="""
+            Maximum shadowmap resolution for spot lights.  
+            Spot lights share a shadowmap atlas, each light resolution is based on its size on screen.""")
         inputs['Spot Resolution @ Preview'] = Parameter(512, Type.INT)
         
         inputs['Sun Resolution'] = Parameter(2048, Type.INT, doc=
@@ -46,6 +65,10 @@ class SceneLighting(PipelineNode):
         inputs['Sun CSM Distribution'] = Parameter(0.9, Type.FLOAT, doc="""
             Interpolates the cascades distribution along the view distance between linear distribution *(at 0)* and logarithmic distribution *(at 1)*.  
             The appropriate value depends on camera FOV and scene characteristics.""")
+        
+        inputs['Freeze Shadows'] = Parameter(False, Type.BOOL, doc="""
+            Render the shadow maps only for the first sample and reuse them for the rest of the accumulation (and the next frames), as long as the lights and their shadow casters don't change.  
+            Faster, but shadows edges are not antialiased.""")
         return inputs
     
     @classmethod
@@ -71,50 +94,188 @@ class SceneLighting(PipelineNode):
             inputs['Sun CSM Distribution'],
             inputs['Sun Max Distance'], sample_offset)
         self.light_groups_buffer.load(scene)
+        self.light_clusters.load(scene)
+        spot_resolutions = Lighting.get_spot_shadow_resolutions(scene, inputs['Spot Resolution'], self.pipeline.resolution)
+        #Shadow maps are cleared per light view, only when they are not reused from the cache
         self.shadowmaps_opaque.load(scene,
             inputs['Spot Resolution'],
             inputs['Sun Resolution'],
             inputs['Point Resolution'],
-            inputs['Sun CSM Count'])
+            inputs['Sun CSM Count'], clear=False, spot_resolutions=spot_resolutions)
+        #Without transparent materials, the transparent shadow maps only need to be cleared once
+        has_transparency = len(transparent_batches) > 0
         self.shadowmaps_transparent.load(scene,
             inputs['Spot Resolution'],
             inputs['Sun Resolution'],
             inputs['Point Resolution'],
-            inputs['Sun CSM Count'])
+            inputs['Sun CSM Count'], clear=has_transparency == False and self.transparent_shadows_cleared == False,
+            spot_resolutions=spot_resolutions)
+        self.lights_buffer.set_spot_shadow_regions(self.shadowmaps_opaque.get_spot_regions_uv())
+        self.transparent_shadows_cleared = has_transparency == False
+        if has_transparency == False:
+            transparent_batches = {}
+        
+        freeze_shadows = inputs['Freeze Shadows']
+        light_sample_offset = sample_offset
+        #Spot lights only depend on the spot atlas textures, sun and point lights on the rest
+        shadows_generation = {
+            Lighting.LIGHT_SPOT : (self.shadowmaps_opaque.spot_generation, self.shadowmaps_transparent.spot_generation, has_transparency),
+            Lighting.LIGHT_SUN : (self.shadowmaps_opaque.generation, self.shadowmaps_transparent.generation, has_transparency),
+            Lighting.LIGHT_POINT : (self.shadowmaps_opaque.generation, self.shadowmaps_transparent.generation, has_transparency),
+        }
+        material_keys = {}
+        def get_material_key(material):
+            if material not in material_keys:
+                shader = material.shader.get('SHADOW_PASS') if material.shader else None
+                material_keys[material] = get_shader_key(shader)
+            return material_keys[material]
+        
+        def get_shadow_key(light, light_type, light_index, matrices, casters, light_batches):
+            #Everything the light shadow maps depend on. The sample offset is ignored when shadows are frozen
+            if casters is None:
+                return None
+            culling = self.pipeline.scene_culling
+            key = [light_type, light.position, light.radius, light.spot_angle, light.parameters['Light Group'],
+                shadows_generation[light_type], scene.frame, scene.time]
+            if light_type != Lighting.LIGHT_POINT:
+                #Point light views depend only on the position and the sample offset
+                key.append(tuple(tuple(camera) + tuple(projection) for camera, projection in matrices))
+            if light_type == Lighting.LIGHT_SPOT:
+                key.append(self.shadowmaps_opaque.spot_regions[light_index])
+            if freeze_shadows == False:
+                key += [light_sample_offset, self.pipeline.sample_count]
+            for batches in light_batches:
+                key.append(None)
+                for material, meshes in batches.items():
+                    for mesh, scale_groups in meshes.items():
+                        for scale_group, group_batches in scale_groups.items():
+                            for batch in group_batches:
+                                start, end = batch['instances']
+                                visible = casters[start:end]
+                                if visible.any():
+                                    key.append((get_material_key(material), get_resource_key(mesh.mesh), repr(mesh.parameters), scale_group,
+                                        culling.models[start:end][visible].tobytes(), culling.ids[start:end][visible].tobytes()))
+            return tuple(key)
         
         shader_resources = scene.shader_resources.copy()
         shader_resources['COMMON_UNIFORMS'] = self.common_buffer
         shader_resources['SCENE_LIGHTS'] = self.lights_buffer
+        shader_resources['LIGHT_CLUSTERS'] = self.light_clusters
+        layered_resources = shader_resources.copy()
+        layered_resources['LAYERED_VIEWS'] = self.layered_views_buffer
 
-        def render_shadowmaps(lights, fbos_opaque, fbos_transparent, sample_offset = sample_offset):
+        def render_shadowmaps(lights, light_type, fbos_opaque, fbos_transparent, sample_offset = sample_offset, near_plane = True, light_sphere = False,
+            layers_opaque = None, layers_transparent = None):
+            #When layers are given, all the light views are rendered in a single pass
             for light_index, light_matrices_pair in enumerate(lights.items()):
                 light, matrices = light_matrices_pair
-                for matrix_index, camera_projection_pair in enumerate(matrices): 
-                    camera, projection = camera_projection_pair
+                def get_light_group_batches(batches):
+                    result = {}
+                    for material, meshes in batches.items():
+                        if material and light.parameters['Light Group'] in material.parameters['Light Groups.Shadow']:
+                            result[material] = meshes
+                    return result
+                light_opaque_batches = get_light_group_batches(opaque_batches)
+                light_transparent_batches = get_light_group_batches(transparent_batches)
+                #Point lights only reach the casters inside their radius
+                candidates = self.pipeline.cull_sphere(light.position, light.radius) if light_sphere else None
+                views = []
+                casters = None
+                for camera, projection in matrices:
+                    #Depth clamped sun cascades keep the casters between the light and the cascade box
+                    visibility = self.pipeline.cull_view(camera, projection, near_plane, True, candidates)
+                    opaque_visible = transparent_visible = None
+                    if visibility is not None:
+                        opaque_visible = self.pipeline.get_visible_instances(light_opaque_batches, visibility)
+                        transparent_visible = self.pipeline.get_visible_instances(light_transparent_batches, visibility)
+                        view_casters = opaque_visible | transparent_visible
+                        casters = view_casters if casters is None else casters | view_casters
+                    views.append((camera, projection, visibility, opaque_visible, transparent_visible))
+                if casters is not None:
+                    SHADOW_CASTERS_STATS[light.name or 'Light {}'.format(light_index)] = int(np.count_nonzero(casters))
+                
+                slot = (light_type, light_index)
+                key = get_shadow_key(light, light_type, light_index, matrices, casters, (light_opaque_batches, light_transparent_batches))
+                cached = self.shadow_cache.get(slot)
+                if key is not None and cached is not None and cached[0] == key:
+                    #Reuse the shadow maps, shading them with the sample offset they were rendered with
+                    self.lights_buffer.set_shadow_offset(light, cached[1])
+                    Lighting.SHADOW_CACHE_STATS['Cached'] += 1
+                    continue
+                #Point lights render with no offset, but their views are rotated by the light sample offset
+                self.shadow_cache[slot] = (key, light_sample_offset)
+                Lighting.SHADOW_CACHE_STATS['Rendered'] += 1
+                
+                for matrix_index in range(len(views)):
                     i = light_index * len(matrices) + matrix_index
+                    self.shadowmaps_opaque.clear_fbo(fbos_opaque[i])
+                    if has_transparency:
+                        self.shadowmaps_transparent.clear_fbo(fbos_transparent[i])
+                
+                if layers_opaque:
+                    #Views without shadow casters are disabled in the layer mask,
+                    #and the geometry shader skips the triangles outside each view
+                    layer_mask = 0
+                    opaque_casters = transparent_casters = None
+                    for matrix_index, view in enumerate(views):
+                        camera, projection, visibility, opaque_visible, transparent_visible = view
+                        if visibility is None or (opaque_visible | transparent_visible).any():
+                            layer_mask |= 1 << matrix_index
+                        if visibility is not None:
+                            opaque_casters = opaque_visible if opaque_casters is None else opaque_casters | opaque_visible
+                            transparent_casters = transparent_visible if transparent_casters is None else transparent_casters | transparent_visible
+                    if layer_mask == 0:
+                        continue
+                    for material in list(light_opaque_batches.keys()) + list(light_transparent_batches.keys()):
+                        self.setup_layered_shader(material.shader)
+                    layers = layers_opaque[light_index]
+                    self.layered_views_buffer.load(matrices, layers.layer_offset, layer_mask)
+                    camera, projection = matrices[0]
+                    self.common_buffer.load(scene, layers.resolution, sample_offset, self.pipeline.sample_count, camera, projection)
+                    if casters is None or opaque_casters.any():
+                        self.pipeline.draw_scene_pass(layers, light_opaque_batches, 
+                            'SHADOW_PASS_LAYERED', default_layered_shader, layered_resources, visibility=opaque_casters)
+                    if has_transparency and (casters is None or transparent_casters.any()):
+                        self.pipeline.draw_scene_pass(layers_transparent[light_index], light_transparent_batches, 
+                            'SHADOW_PASS_LAYERED', default_layered_shader, layered_resources, visibility=transparent_casters)
+                    continue
+                
+                for matrix_index, view in enumerate(views):
+                    camera, projection, visibility, opaque_visible, transparent_visible = view
+                    i = light_index * len(matrices) + matrix_index
+                    #Skip the views without shadow casters
+                    if visibility is not None and (opaque_visible | transparent_visible).any() == False:
+                        continue
                     self.common_buffer.load(scene, fbos_opaque[i].resolution, sample_offset, self.pipeline.sample_count, camera, projection)
-                    def get_light_group_batches(batches):
-                        result = {}
-                        for material, meshes in batches.items():
-                            if material and light.parameters['Light Group'] in material.parameters['Light Groups.Shadow']:
-                                result[material] = meshes
-                        return result
                     #TODO: Callback
-                    self.pipeline.draw_scene_pass(fbos_opaque[i], get_light_group_batches(opaque_batches), 
-                        'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
-                    self.pipeline.draw_scene_pass(fbos_transparent[i], get_light_group_batches(transparent_batches), 
-                        'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
+                    if visibility is None or opaque_visible.any():
+                        self.pipeline.draw_scene_pass(fbos_opaque[i], light_opaque_batches, 
+                            'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources, visibility=visibility)
+                    if has_transparency and (visibility is None or transparent_visible.any()):
+                        self.pipeline.draw_scene_pass(fbos_transparent[i], light_transparent_batches, 
+                            'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources, visibility=visibility)
         
-        render_shadowmaps(self.lights_buffer.spots,
+        render_shadowmaps(self.lights_buffer.spots, Lighting.LIGHT_SPOT,
             self.shadowmaps_opaque.spot_fbos, self.shadowmaps_transparent.spot_fbos)
         
         glEnable(GL_DEPTH_CLAMP)
-        render_shadowmaps(self.lights_buffer.suns,
-            self.shadowmaps_opaque.sun_fbos, self.shadowmaps_transparent.sun_fbos)
+        render_shadowmaps(self.lights_buffer.suns, Lighting.LIGHT_SUN,
+            self.shadowmaps_opaque.sun_fbos, self.shadowmaps_transparent.sun_fbos, near_plane=False)
         glDisable(GL_DEPTH_CLAMP)
 
-        render_shadowmaps(self.lights_buffer.points,
-            self.shadowmaps_opaque.point_fbos, self.shadowmaps_transparent.point_fbos, (0,0))
+        point_layers = (None, None)
+        default_layered_shader = None
+        if USE_LAYERED_POINT_SHADOWS and len(self.lights_buffer.points) > 0:
+            self.setup_layered_shader(self.pipeline.default_shader)
+            default_layered_shader = self.pipeline.default_shader.get('SHADOW_PASS_LAYERED')
+        if default_layered_shader:
+            point_layers = (self.shadowmaps_opaque.point_layers, self.shadowmaps_transparent.point_layers)
+        render_shadowmaps(self.lights_buffer.points, Lighting.LIGHT_POINT,
+            self.shadowmaps_opaque.point_fbos, self.shadowmaps_transparent.point_fbos, (0,0), light_sphere=True,
+            layers_opaque=point_layers[0], layers_transparent=point_layers[1])
+        
+        #Upload the shadow offsets of the cached lights
+        self.lights_buffer.upload()
         
         import copy
         scene = copy.copy(scene)
@@ -122,11 +283,32 @@ class SceneLighting(PipelineNode):
 
         scene.shader_resources['SCENE_LIGHTS'] = self.lights_buffer
         scene.shader_resources['LIGHT_GROUPS'] = self.light_groups_buffer
+        scene.shader_resources['LIGHT_CLUSTERS'] = self.light_clusters
         scene.shader_resources['SHADOWMAPS'] = self.shadowmaps_opaque
         scene.shader_resources['TRANSPARENT_SHADOWMAPS'] = self.shadowmaps_transparent
 
         outputs['Scene'] = scene
 
 
+def get_shader_key(shader):
+    #Identifies a material shader and its parameters across scene updates (material shaders are copied on every update)
+    if shader is None:
+        return None
+    uniforms = tuple((name, bytes(uniform.value)) for name, uniform in shader.uniforms.items())
+    textures = tuple((name, get_resource_key(texture)) for name, texture in shader.textures.items())
+    return (shader.program, uniforms, textures)
+
+def get_resource_key(resource):
+    #Bridge meshes and textures get a new load_version on every (re)load (see Bridge.Mesh and Bridge.Texture).
+    #Names are kept across edits and ids can be reused after a free, so neither identifies the loaded data.
+    #Other resources are keyed by the object itself.
+    if resource is None:
+        return None
+    load_version = getattr(resource, 'load_version', None)
+    if load_version is not None:
+        return load_version
+    return resource
+
+
 NODE = SceneLighting
 
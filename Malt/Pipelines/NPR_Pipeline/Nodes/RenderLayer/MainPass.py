@@ -3,7 +3,18 @@ from Malt.GL.Texture import Texture
 from Malt.GL.RenderTarget import RenderTarget
 from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
-from Malt.Scene import TextureShaderResource
+from Malt.Scene import ShaderResource, TextureShaderResource
+
+_RESOLVE_WEIGHTED_OIT_SHADER = None
+
+class WeightedOITResource(ShaderResource):
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+    
+    def shader_callback(self, shader):
+        if 'WEIGHTED_OIT' in shader.uniforms:
+            shader.uniforms['WEIGHTED_OIT'].set_value(self.enabled)
 
 class MainPass(PipelineNode):
     """
@@ -16,6 +27,7 @@ class MainPass(PipelineNode):
         PipelineNode.__init__(self, pipeline)
         self.resolution = None
         self.t_depth = None
+        self.t_opaque_depth = None
     
     @staticmethod
     def get_pass_type():
@@ -41,6 +53,49 @@ class MainPass(PipelineNode):
                 self.custom_targets[io['name']] = Texture(resolution, GL.GL_RGBA16F)
         self.t_depth = t_depth
         self.fbo = RenderTarget([*self.custom_targets.values()], self.t_depth)
+        #Weighted Blended OIT targets are only created when needed
+        self.t_opaque_depth = None
+    
+    def setup_weighted_oit_targets(self, resolution, t_opaque_depth):
+        #The transparent fragments are tested against the opaque depth, without writing to it
+        self.t_opaque_depth = t_opaque_depth
+        self.accumulation_targets = [Texture(resolution, GL_RGBA16F) for t in self.custom_targets]
+        self.revealage_targets = [Texture(resolution, GL_R16F) for t in self.custom_targets]
+        self.fbo_accumulation = RenderTarget(self.accumulation_targets, t_opaque_depth)
+        self.fbo_revealage = RenderTarget(self.revealage_targets, t_opaque_depth)
+        self.fbo_resolve = RenderTarget([*self.custom_targets.values()])
+    
+    def draw_weighted_oit(self, scene, shader_resources):
+        #Renders all the transparent layers at once, blending their outputs by their opacity weighted average.
+        #The material output variables are user defined, so the accumulation and the revealage
+        #are rendered in separate passes, each one with its own blend function.
+        t_opaque_depth = shader_resources['T_OPAQUE_DEPTH'].texture
+        if t_opaque_depth != self.t_opaque_depth:
+            self.setup_weighted_oit_targets(self.pipeline.resolution, t_opaque_depth)
+        
+        shader = self.pipeline.default_shader['MAIN_PASS']
+        glBlendEquation(GL_FUNC_ADD)
+        
+        self.fbo_accumulation.clear([(0,0,0,0)] * len(self.accumulation_targets))
+        glBlendFuncSeparate(GL_SRC_ALPHA, GL_ONE, GL_ONE, GL_ONE)
+        self.pipeline.draw_scene_pass(self.fbo_accumulation, scene.batches, 'MAIN_PASS', shader, 
+            shader_resources, GL_LESS, blend=True, depth_write=False)
+        
+        self.fbo_revealage.clear([(1,1,1,1)] * len(self.revealage_targets))
+        glBlendFunc(GL_ZERO, GL_ONE_MINUS_SRC_ALPHA)
+        self.pipeline.draw_scene_pass(self.fbo_revealage, scene.batches, 'MAIN_PASS', shader, 
+            shader_resources, GL_LESS, blend=True, depth_write=False)
+        
+        glDepthMask(GL_TRUE)
+        glDisable(GL_BLEND)
+
+        global _RESOLVE_WEIGHTED_OIT_SHADER
+        if _RESOLVE_WEIGHTED_OIT_SHADER is None:
+            _RESOLVE_WEIGHTED_OIT_SHADER = self.pipeline.compile_shader_from_source('#include "Passes/ResolveWeightedOIT.glsl"')
+        for i in range(len(self.accumulation_targets)):
+            _RESOLVE_WEIGHTED_OIT_SHADER.textures[f'IN_ACCUMULATION[{str(i)}]'] = self.accumulation_targets[i]
+            _RESOLVE_WEIGHTED_OIT_SHADER.textures[f'IN_REVEALAGE[{str(i)}]'] = self.revealage_targets[i]
+        self.pipeline.draw_screen_pass(_RESOLVE_WEIGHTED_OIT_SHADER, self.fbo_resolve)
 
     def execute(self, parameters):
         inputs = parameters['IN']
@@ -72,9 +127,17 @@ class MainPass(PipelineNode):
                     glsl_name = GLSLTranspiler.custom_io_reference('IN', 'MAIN_PASS_PIXEL_SHADER', io['name'])
                     shader_resources['CUSTOM_IO'+glsl_name] = TextureShaderResource(glsl_name, inputs[io['name']])
                     
-        self.fbo.clear([(0,0,0,0)] * len(self.fbo.targets))
-        self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'MAIN_PASS', self.pipeline.default_shader['MAIN_PASS'], 
-            shader_resources, GL_EQUAL)
+        #Transparent layers can be rendered all at once (see RenderLayers)
+        layer_globals = parameters['__GLOBALS__']
+        weighted_oit = layer_globals.get('__WEIGHTED_OIT__', False) and layer_globals.get('__LAYER_INDEX__', 0) > 0
+        shader_resources['WEIGHTED_OIT'] = WeightedOITResource(weighted_oit)
+        
+        if weighted_oit:
+            self.draw_weighted_oit(scene, shader_resources)
+        else:
+            self.fbo.clear([(0,0,0,0)] * len(self.fbo.targets))
+            self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'MAIN_PASS', self.pipeline.default_shader['MAIN_PASS'], 
+                shader_resources, GL_EQUAL)
 
         outputs.update(self.custom_targets)
 
@@ -19,6 +19,8 @@ class PrePass(PipelineNode):
         self.resolution = None
         self.custom_io = []
         self.npr_light_shaders = NPR_LightShaders()
+        #Checks if the transparent layers have any fragment left to peel (see RenderLayers)
+        self.layer_query = DrawQuery()
     
     @staticmethod
     def get_pass_type():
@@ -83,7 +85,14 @@ class PrePass(PipelineNode):
         })
         self.fbo.clear([(0,0,1,1), (0,0,0,0)] + [(0,0,0,0)]*len(self.custom_targets), 1)
 
+        render_layers = parameters['__GLOBALS__'].get('__RENDER_LAYERS__')
+        if is_opaque_pass == False and render_layers:
+            self.layer_query.begin_query()
         self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'PRE_PASS', self.pipeline.default_shader['PRE_PASS'], shader_resources)
+        if is_opaque_pass == False and render_layers:
+            self.layer_query.end_query()
+            #The rest of the layer is skipped on the GPU if the PrePass didn't find any fragment to peel
+            render_layers.begin_layer_conditional_draw(self.layer_query)
 
         if is_opaque_pass:
             self.fbo_last_layer_id.clear([(0,0,0,0)])
@@ -102,6 +111,7 @@ class PrePass(PipelineNode):
             'IN_NORMAL_DEPTH': TextureShaderResource('IN_NORMAL_DEPTH', self.t_normal_depth),
             'IN_ID': TextureShaderResource('IN_ID', self.t_id),
             'T_DEPTH': TextureShaderResource('', self.t_depth), #just pass the reference
+            'T_OPAQUE_DEPTH': TextureShaderResource('', self.t_opaque_depth),
         })
 
         outputs['Scene'] = scene
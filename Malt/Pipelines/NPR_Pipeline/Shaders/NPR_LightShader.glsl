@@ -40,7 +40,7 @@ void main()
     POSITION = screen_to_camera(screen_uv(), depth);
     POSITION = transform_point(inverse(CAMERA), POSITION);
 
-    Light L = LIGHTS.lights[LIGHT_INDEX];
+    Light L = scene_light(LIGHT_INDEX);
     LitSurface LS = lit_surface(POSITION, vec3(0), L, false);
     
     vec3 light_space;
@@ -48,12 +48,12 @@ void main()
 
     if(L.type == LIGHT_SPOT)
     {
-        light_space = project_point(LIGHTS.spot_matrices[L.type_index], POSITION);        
+        light_space = project_point(spot_light_matrix(L.type_index), POSITION);        
         light_uv = light_space * 0.5 + 0.5;
     }
     if(L.type == LIGHT_SUN)
     {
-        mat4 matrix = LIGHTS.sun_matrices[L.type_index*LIGHTS.cascades_count];
+        mat4 matrix = sun_light_matrix(L.type_index*LIGHTS.cascades_count);
         matrix[3] = vec4(L.position, 1);
         light_space = project_point(matrix, POSITION);
         light_uv = light_space;
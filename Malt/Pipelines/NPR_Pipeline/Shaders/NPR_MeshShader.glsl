@@ -73,6 +73,10 @@ vec3 VERTEX_DISPLACEMENT_SHADER(){ return vec3(0); }
     #define VERTEX_DISPLACEMENT_OFFSET 0.1
 #endif
 
+#if defined(CUSTOM_VERTEX_DISPLACEMENT) || defined(CUSTOM_VERTEX_SHADER) || defined(CUSTOM_MAIN)
+//MALT_VERTEX_DISPLACEMENT (The pipeline won't cull this material by its mesh bounds)
+#endif
+
 #ifndef CUSTOM_MAIN
 void main()
 {
@@ -156,6 +160,8 @@ layout (location = 1) out uvec4 OUT_ID;
 #ifdef MAIN_PASS
 uniform sampler2D IN_NORMAL_DEPTH;
 uniform usampler2D IN_ID;
+//Shade every transparent fragment, not only the PrePass layer (see RenderLayers Weighted Blended OIT)
+uniform bool WEIGHTED_OIT = false;
 #endif //MAIN_PASS
 
 #ifndef CUSTOM_MAIN
@@ -266,8 +272,16 @@ void main()
 
     #ifdef MAIN_PASS
     {
-        NORMAL = texelFetch(IN_NORMAL_DEPTH, ivec2(gl_FragCoord.xy), 0).xyz;
-        ID = texelFetch(IN_ID, ivec2(gl_FragCoord.xy), 0);
+        if(WEIGHTED_OIT)
+        {
+            NORMAL = PPO.normal;
+            ID = PPO.id;
+        }
+        else
+        {
+            NORMAL = texelFetch(IN_NORMAL_DEPTH, ivec2(gl_FragCoord.xy), 0).xyz;
+            ID = texelFetch(IN_ID, ivec2(gl_FragCoord.xy), 0);
+        }
         MAIN_PASS_PIXEL_SHADER();
     }
     #endif
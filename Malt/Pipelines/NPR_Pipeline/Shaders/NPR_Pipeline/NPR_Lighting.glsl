@@ -19,19 +19,12 @@ uniform sampler2DArray TRANSPARENT_SHADOWMAPS_COLOR_SPOT;
 uniform sampler2DArray TRANSPARENT_SHADOWMAPS_COLOR_SUN;
 uniform samplerCubeArray TRANSPARENT_SHADOWMAPS_COLOR_POINT;
 
-layout(std140) uniform LIGHT_GROUPS
-{
-    //Use ivec4 so the ints are tightly packed
-    ivec4 LIGHT_GROUP_INDEX[MAX_LIGHTS/4+1];
-};
-#define LIGHT_GROUP_INDEX(light_index) LIGHT_GROUP_INDEX[(light_index)/4][(light_index)%4]
+//The light group and custom shading index of each scene light
+uniform isamplerBuffer LIGHT_GROUPS;
+#define LIGHT_GROUP_INDEX(light_index) texelFetch(LIGHT_GROUPS, (light_index)).x
 
-layout(std140) uniform LIGHTS_CUSTOM_SHADING
-{
-    //Use ivec4 so the ints are tightly packed
-    ivec4 CUSTOM_SHADING_INDEX[MAX_LIGHTS/4+1];
-};
-#define CUSTOM_SHADING_INDEX(light_index) CUSTOM_SHADING_INDEX[(light_index)/4][(light_index)%4];
+uniform isamplerBuffer LIGHTS_CUSTOM_SHADING;
+#define CUSTOM_SHADING_INDEX(light_index) texelFetch(LIGHTS_CUSTOM_SHADING, (light_index)).x
 
 uniform sampler2DArray IN_LIGHT_CUSTOM_SHADING;
 
@@ -74,7 +67,7 @@ LitSurface npr_lit_surface(vec3 position, vec3 normal, uint id, Light light, int
         {
             shadow = spot_shadow(position, light, SHADOWMAPS_DEPTH_SPOT, bias);
             vec2 uv = shadow.light_uv.xy;
-            int index = light.type_index;
+            int index = 0; //Spot shadow maps share a single atlas layer
 
             shadow_id = texture(SHADOWMAPS_ID_SPOT, vec3(uv, index)).x;
 
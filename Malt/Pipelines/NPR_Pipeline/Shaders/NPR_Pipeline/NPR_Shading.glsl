@@ -6,10 +6,13 @@
 
 #define _LIT_SCENE_MACRO(callback, light_group, shadows, self_shadows)\
     vec3 result = vec3(0,0,0);\
-    for (int i = 0; i < LIGHTS.lights_count; i++)\
+    /*Only the lights that reach the position cluster (see Lighting/LightClusters.glsl)*/\
+    ivec4 light_ranges = light_cluster_ranges(position);\
+    for (int n = 0; n < light_cluster_ranges_count(light_ranges); n++)\
     {\
+        int i = light_cluster_light(light_ranges, n);\
         if(LIGHT_GROUP_INDEX(i) != light_group) continue;\
-        Light L = LIGHTS.lights[i];\
+        Light L = scene_light(i);\
         LitSurface LS = npr_lit_surface(position, normal, ID.x, L, i, shadows, self_shadows);\
         result += (callback);\
     }\
@@ -39,3 +39,42 @@ class CommonBuffer():
             self.bind(shader.uniform_blocks['COMMON_UNIFORMS'])
 
 
+
+
+#See Common.glsl LAYERED_PASS
+MAX_LAYERED_VIEWS = 6
+
+class C_LayeredViewsBuffer(ctypes.Structure):
+    _fields_ = [
+        ('LAYER_CAMERA', ctypes.c_float*16*MAX_LAYERED_VIEWS),
+        ('LAYER_PROJECTION', ctypes.c_float*16*MAX_LAYERED_VIEWS),
+        ('LAYER_OFFSET', ctypes.c_int),
+        ('LAYER_MASK', ctypes.c_int),
+        ('__padding', ctypes.c_int*2),
+    ]
+
+class LayeredViewsBuffer():
+    
+    def __init__(self):
+        self.data = C_LayeredViewsBuffer()
+        self.UBO = UBO()
+    
+    def load(self, views, layer_offset, layer_mask=None):
+        #views are (camera, projection) pairs, rendered to the layers starting at layer_offset.
+        #Views not enabled in layer_mask are skipped.
+        if layer_mask is None:
+            layer_mask = (1 << len(views)) - 1
+        for i, (camera, projection) in enumerate(views):
+            self.data.LAYER_CAMERA[i] = tuple(camera)
+            self.data.LAYER_PROJECTION[i] = tuple(projection)
+        self.data.LAYER_OFFSET = layer_offset
+        self.data.LAYER_MASK = layer_mask
+
+        self.UBO.load_data(self.data)
+    
+    def bind(self, block):
+        self.UBO.bind(block)
+    
+    def shader_callback(self, shader):
+        if 'LAYERED_VIEWS' in shader.uniform_blocks:
+            self.bind(shader.uniform_blocks['LAYERED_VIEWS'])
@@ -0,0 +1,153 @@
+import numpy as np
+
+#Instances tested and culled since the last reset (see Bridge.Server)
+CULLING_STATS = {
+    'Instances' : 0,
+    'Culled' : 0,
+}
+#Shadow casters drawn for each light since the last reset
+SHADOW_CASTERS_STATS = {}
+
+def gl_matrix(flat_matrix):
+    #Malt matrices are sent as flat column-major arrays
+    return np.array(flat_matrix, np.float32).reshape(4,4).T
+
+def frustum_planes(view_projection, near=True, far=True):
+    #Returns the frustum planes as (a,b,c,d) rows, pointing inwards (Gribb & Hartmann)
+    m = np.asarray(view_projection, np.float32)
+    planes = [m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1]]
+    if near:
+        planes.append(m[3] + m[2])
+    if far:
+        planes.append(m[3] - m[2])
+    return np.array(planes, np.float32)
+
+def transform_bounds(matrices, bounds_min, bounds_max):
+    #Transforms object space AABBs by (n,4,4) matrices. Returns world space centers and extents
+    center = (bounds_min + bounds_max) * 0.5
+    extent = (bounds_max - bounds_min) * 0.5
+    rotation = matrices[:,:3,:3]
+    world_center = np.einsum('nij,nj->ni', rotation, center) + matrices[:,:3,3]
+    world_extent = np.einsum('nij,nj->ni', np.abs(rotation), extent)
+    return world_center, world_extent
+
+def classify(centers, extents, planes):
+    #Returns (outside, inside) masks of AABBs against convex volume planes
+    distance = centers @ planes[:,:3].T + planes[:,3]
+    radius = extents @ np.abs(planes[:,:3]).T
+    outside = np.any(distance < -radius, axis=1)
+    inside = np.all(distance >= radius, axis=1)
+    return outside, inside
+
+def classify_sphere(centers, extents, sphere_center, sphere_radius):
+    #Returns (outside, inside) masks of AABBs against a sphere
+    offset = np.abs(centers - np.asarray(sphere_center, np.float32))
+    nearest = np.maximum(offset - extents, 0)
+    farthest = offset + extents
+    radius_squared = sphere_radius * sphere_radius
+    outside = np.sum(nearest * nearest, axis=1) > radius_squared
+    inside = np.sum(farthest * farthest, axis=1) <= radius_squared
+    return outside, inside
+
+def planes_classifier(planes):
+    return lambda centers, extents: classify(centers, extents, planes)
+
+def sphere_classifier(center, radius):
+    return lambda centers, extents: classify_sphere(centers, extents, center, radius)
+
+
+class BVH():
+    #Bounding volume hierarchy over instance AABBs, stored as flat arrays.
+    #Each node covers a contiguous range of the sorted instances, so fully visible nodes
+    #can be accepted as a whole, while leaves that intersect the volume test their instances.
+
+    LEAF_SIZE = 64
+
+    def __init__(self, centers, extents):
+        count = len(centers)
+        self.count = count
+        order = np.arange(count)
+        node_min, node_max, node_range, node_children = [], [], [], []
+        stack = [(0, count, -1, 0)]
+        bounds_min = centers - extents
+        bounds_max = centers + extents
+        while stack:
+            start, end, parent, side = stack.pop()
+            index = len(node_range)
+            if parent >= 0:
+                node_children[parent][side] = index
+            indices = order[start:end]
+            node_min.append(bounds_min[indices].min(axis=0) if end > start else np.zeros(3))
+            node_max.append(bounds_max[indices].max(axis=0) if end > start else np.zeros(3))
+            node_range.append((start, end))
+            node_children.append([-1, -1])
+            if end - start > self.LEAF_SIZE:
+                #Median split along the largest axis of the centers
+                node_centers = centers[indices]
+                axis = np.argmax(node_centers.max(axis=0) - node_centers.min(axis=0))
+                middle = (end - start) // 2
+                order[start:end] = indices[np.argpartition(node_centers[:,axis], middle)]
+                stack.append((start + middle, end, index, 1))
+                stack.append((start, start + middle, index, 0))
+
+        self.order = order
+        node_min = np.array(node_min, np.float32).reshape(-1,3)
+        node_max = np.array(node_max, np.float32).reshape(-1,3)
+        self.node_centers = (node_min + node_max) * 0.5
+        self.node_extents = (node_max - node_min) * 0.5
+        self.node_range = np.array(node_range, np.int64).reshape(-1,2)
+        self.node_children = np.array(node_children, np.int64).reshape(-1,2)
+        self.centers = centers[order]
+        self.extents = extents[order]
+
+    def cull(self, classifier):
+        #Returns the visibility mask of the instances (in their original order).
+        #classifier(centers, extents) returns the (outside, inside) masks of the given AABBs
+        visible = np.zeros(self.count + 1, np.int32)
+        leaf_ranges = []
+        frontier = np.zeros(1, np.int64) if self.count else np.zeros(0, np.int64)
+        while len(frontier):
+            outside, inside = classifier(self.node_centers[frontier], self.node_extents[frontier])
+            accepted = frontier[inside]
+            np.add.at(visible, self.node_range[accepted,0], 1)
+            np.add.at(visible, self.node_range[accepted,1], -1)
+            partial = frontier[~outside & ~inside]
+            is_leaf = self.node_children[partial,0] < 0
+            leaf_ranges.extend(self.node_range[partial[is_leaf]].tolist())
+            frontier = self.node_children[partial[~is_leaf]].ravel()
+
+        visible = np.cumsum(visible[:-1]) > 0
+        if leaf_ranges:
+            indices = np.concatenate([np.arange(start, end) for start, end in leaf_ranges])
+            outside, inside = classifier(self.centers[indices], self.extents[indices])
+            visible[indices[~outside]] = True
+
+        result = np.empty(self.count, bool)
+        result[self.order] = visible
+        return result
+
+
+class SceneCulling():
+    #World space bounds of all the scene instances, in the same order as the instance arrays
+    #built by Pipeline.build_scene_batches
+
+    def __init__(self, matrices, bounds_min, bounds_max, has_bounds):
+        self.count = len(matrices)
+        self.centers, self.extents = transform_bounds(matrices, bounds_min, bounds_max)
+        #Instances without bounds are always visible
+        self.unbounded = ~has_bounds
+        self.bvh = BVH(self.centers, self.extents)
+
+    def cull(self, planes, candidates=None):
+        #When a candidates mask is given, only those instances are tested (without the BVH)
+        if candidates is None:
+            return self.bvh.cull(planes_classifier(planes)) | self.unbounded
+        indices = np.flatnonzero(candidates & ~self.unbounded)
+        outside, inside = classify(self.centers[indices], self.extents[indices], planes)
+        result = candidates & self.unbounded
+        result[indices[~outside]] = True
+        return result
+    
+    def cull_sphere(self, center, radius):
+        return self.bvh.cull(sphere_classifier(center, radius)) | self.unbounded
+
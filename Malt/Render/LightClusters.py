@@ -0,0 +1,187 @@
+import ctypes
+
+import numpy as np
+
+from Malt.GL.GL import *
+from Malt.GL.Shader import UBO
+from Malt.GL.Texture import TextureBuffer
+
+from Malt.Render.Culling import gl_matrix
+from Malt.Render.Lighting import LIGHT_SUN
+
+#Assign the lights to view space clusters (froxels), so shading only iterates the lights that can reach each pixel.
+#When disabled, shaders iterate all the scene lights (see Lighting/LightClusters.glsl)
+USE_LIGHT_CLUSTERS = True
+
+#Screen tiles (x, y) and depth slices
+CLUSTERS_GRID = (16, 9, 24)
+
+class C_LightClusters(ctypes.Structure):
+    _fields_ = [
+        ('view', ctypes.c_float*16),
+        ('projection', ctypes.c_float*16),
+        ('grid', ctypes.c_int*4), #(x, y, z, enabled)
+        ('depth', ctypes.c_float*4), #(near, far, slices scale, is orthographic)
+    ]
+
+
+def get_clip_range(projection):
+    #Returns (near, far, is_ortho) from a row-major projection matrix
+    is_ortho = projection[3][3] == 1.0
+    a, b = projection[2][2], projection[2][3]
+    if is_ortho:
+        return (b + 1) / a, (b - 1) / a, True
+    return b / (a - 1), b / (a + 1), False
+
+def get_depth_slices(depth, near, far, slices, is_ortho):
+    #Perspective views use exponential slices, so clusters are closer to cubes
+    depth = np.maximum(depth, near)
+    if is_ortho:
+        result = (depth - near) / (far - near) * slices
+    else:
+        result = np.log(depth / near) / np.log(far / near) * slices
+    return np.clip(np.floor(result), 0, slices - 1).astype(np.int64)
+
+def get_slice_depths(slices, near, far, is_ortho):
+    #Returns the depth at the start of each slice, plus the far depth
+    t = np.arange(slices + 1, dtype=np.float64) / slices
+    if is_ortho:
+        return near + (far - near) * t
+    return near * np.power(far / near, t)
+
+
+def build_light_clusters(camera, projection, positions, radii, grid=CLUSTERS_GRID):
+    #camera and projection are row-major view matrices. positions (n,3) and radii (n) are the lights bounding spheres.
+    #Returns the (offset, count) of each cluster light list, and the light indices of all the lists.
+    #Clusters are ordered by (slice, y, x)
+    grid_x, grid_y, grid_z = grid
+    cluster_count = grid_x * grid_y * grid_z
+    near, far, is_ortho = get_clip_range(projection)
+
+    positions = np.asarray(positions, np.float64).reshape(-1,3)
+    radii = np.asarray(radii, np.float64).reshape(-1)
+    centers = positions @ camera[:3,:3].T + camera[:3,3]
+    #View depth is positive in front of the camera
+    depths = -centers[:,2]
+
+    visible = (depths + radii > near) & (depths - radii < far)
+    lights = np.flatnonzero(visible)
+    centers = centers[lights]
+    depths = depths[lights]
+    radii = radii[lights]
+
+    slice_start = get_depth_slices(depths - radii, near, far, grid_z, is_ortho)
+    slice_end = get_depth_slices(depths + radii, near, far, grid_z, is_ortho)
+
+    #Screen tiles covered by the projected view space AABB of the spheres
+    corners = np.array([(x, y, z) for x in (-1,1) for y in (-1,1) for z in (-1,1)], np.float64)
+    points = centers[:,None,:] + corners[None,:,:] * radii[:,None,None]
+    clip = points @ projection[:3,:3].T + projection[:3,3]
+    w = points @ projection[3,:3] + projection[3,3]
+    #Spheres crossing the near plane can cover any tile
+    crosses_near = np.any(w <= 1e-6, axis=1)
+    w = np.maximum(w, 1e-6)
+    ndc_min = (clip[:,:,:2] / w[:,:,None]).min(axis=1)
+    ndc_max = (clip[:,:,:2] / w[:,:,None]).max(axis=1)
+    ndc_min[crosses_near] = -1
+    ndc_max[crosses_near] = 1
+    tiles = np.array([grid_x, grid_y])
+    tile_start = np.clip(np.floor((ndc_min * 0.5 + 0.5) * tiles), 0, tiles - 1).astype(np.int64)
+    tile_end = np.clip(np.floor((ndc_max * 0.5 + 0.5) * tiles), 0, tiles - 1).astype(np.int64)
+    on_screen = np.all(ndc_max >= -1, axis=1) & np.all(ndc_min <= 1, axis=1)
+
+    #Expand the (light, cluster) pairs of each light box
+    size_x = (tile_end[:,0] - tile_start[:,0] + 1) * on_screen
+    size_y = tile_end[:,1] - tile_start[:,1] + 1
+    size_z = slice_end - slice_start + 1
+    counts = size_x * size_y * size_z
+    pair_light = np.repeat(np.arange(len(lights)), counts)
+    local = np.arange(len(pair_light)) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = tile_start[pair_light,0] + local % size_x[pair_light]
+    local //= size_x[pair_light]
+    y = tile_start[pair_light,1] + local % size_y[pair_light]
+    z = slice_start[pair_light] + local // size_y[pair_light]
+
+    #Refine with the sphere against the cluster view space bounds
+    slice_depths = get_slice_depths(grid_z, near, far, is_ortho)
+    d0 = slice_depths[z]
+    d1 = slice_depths[z + 1]
+    def axis_bounds(tile, tiles_count, axis):
+        n0 = tile / tiles_count * 2 - 1
+        n1 = (tile + 1) / tiles_count * 2 - 1
+        scale = projection[axis][axis]
+        if is_ortho:
+            offset = projection[axis][3]
+            return (n0 - offset) / scale, (n1 - offset) / scale
+        offset = projection[axis][2]
+        values = np.stack([d0 * (n0 + offset), d0 * (n1 + offset), d1 * (n0 + offset), d1 * (n1 + offset)]) / scale
+        return values.min(axis=0), values.max(axis=0)
+    x0, x1 = axis_bounds(x, grid_x, 0)
+    y0, y1 = axis_bounds(y, grid_y, 1)
+    center = centers[pair_light]
+    nearest = np.stack([
+        np.clip(center[:,0], x0, x1),
+        np.clip(center[:,1], y0, y1),
+        np.clip(depths[pair_light], d0, d1)], axis=1)
+    offset = nearest - np.stack([center[:,0], center[:,1], depths[pair_light]], axis=1)
+    touches = np.sum(offset * offset, axis=1) <= radii[pair_light] ** 2
+
+    clusters = ((z * grid_y + y) * grid_x + x)[touches]
+    pair_light = pair_light[touches]
+    #Keep the lights sorted inside each cluster, so results match the unclustered loop
+    order = np.lexsort((pair_light, clusters))
+    indices = lights[pair_light[order]].astype(np.uint32)
+    cluster_counts = np.bincount(clusters, minlength=cluster_count)
+    cluster_offsets = np.cumsum(cluster_counts) - cluster_counts
+    ranges = np.stack([cluster_offsets, cluster_counts], axis=1).astype(np.uint32)
+    return ranges, indices
+
+
+class LightClusters():
+    #The clusters light lists for a view. The last grid entry holds the lights that reach every cluster (suns).
+
+    def __init__(self):
+        self.data = C_LightClusters()
+        self.UBO = UBO()
+        self.grid = TextureBuffer(GL_RG32UI)
+        self.indices = TextureBuffer(GL_R32UI)
+        self.key = None
+
+    def load(self, scene):
+        lights = scene.lights
+        key = (USE_LIGHT_CLUSTERS, tuple(scene.camera.camera_matrix), tuple(scene.camera.projection_matrix),
+            tuple((l.type, tuple(l.position), l.radius) for l in lights))
+        if key == self.key:
+            return
+        self.key = key
+
+        self.data.view = tuple(scene.camera.camera_matrix)
+        self.data.projection = tuple(scene.camera.projection_matrix)
+        self.data.grid = (*CLUSTERS_GRID, int(USE_LIGHT_CLUSTERS))
+        camera = gl_matrix(scene.camera.camera_matrix).astype(np.float64)
+        projection = gl_matrix(scene.camera.projection_matrix).astype(np.float64)
+        near, far, is_ortho = get_clip_range(projection)
+        slices = CLUSTERS_GRID[2]
+        scale = slices / (far - near) if is_ortho else slices / np.log(far / near)
+        self.data.depth = (near, far, scale, float(is_ortho))
+        self.UBO.load_data(self.data)
+
+        if USE_LIGHT_CLUSTERS == False:
+            return
+
+        types = np.array([l.type for l in lights], np.int32)
+        positions = np.array([l.position for l in lights], np.float64).reshape(-1,3)
+        radii = np.array([l.radius for l in lights], np.float64)
+        bounded = np.flatnonzero(types != LIGHT_SUN)
+        ranges, indices = build_light_clusters(camera, projection, positions[bounded], radii[bounded])
+        indices = bounded[indices].astype(np.uint32)
+        suns = np.flatnonzero(types == LIGHT_SUN).astype(np.uint32)
+        ranges = np.concatenate([ranges, [(len(indices), len(suns))]]).astype(np.uint32)
+        self.grid.load(ranges)
+        self.indices.load(np.concatenate([indices, suns]).astype(np.uint32))
+
+    def shader_callback(self, shader):
+        if 'LIGHT_CLUSTERS' in shader.uniform_blocks:
+            self.UBO.bind(shader.uniform_blocks['LIGHT_CLUSTERS'])
+            shader.textures['LIGHT_CLUSTERS_GRID'] = self.grid
+            shader.textures['LIGHT_CLUSTERS_INDICES'] = self.indices
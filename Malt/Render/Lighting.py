@@ -2,11 +2,12 @@ import math
 import ctypes
 
 import pyrr
+import numpy as np
 
 from Malt.GL.GL import *
 from Malt.GL.Shader import UBO
-from Malt.GL.Texture import TextureArray, CubeMapArray
-from Malt.GL.RenderTarget import ArrayLayerTarget, RenderTarget
+from Malt.GL.Texture import TextureArray, CubeMapArray, TextureBuffer
+from Malt.GL.RenderTarget import ArrayLayerTarget, LayeredTarget, RenderTarget, RenderTargetLayers, RenderTargetRegion
 
 from Malt import Pipeline
 
@@ -28,6 +29,7 @@ LIGHT_SUN = 1
 LIGHT_POINT = 2
 LIGHT_SPOT = 3
 
+#The lights are stored in a texture buffer with no size limit, 4 RGBA32UI texels per light (see Lighting.glsl scene_light)
 class C_Light(ctypes.Structure):
     _fields_ = [
         ('color', ctypes.c_float*3),
@@ -38,34 +40,117 @@ class C_Light(ctypes.Structure):
         ('spot_angle', ctypes.c_float),
         ('spot_blend', ctypes.c_float),
         ('type_index', ctypes.c_int32),
-        ('__padding', ctypes.c_int32*2),
+        #The sample offset the light shadow maps were rendered with (see LightsBuffer.set_shadow_offset)
+        ('shadow_offset', ctypes.c_float*2),
     ]
 
-MAX_SPOTS = 64
-MAX_SUNS = 64
-MAX_POINTS = 64
-
-MAX_LIGHTS = 128
+#Lights with shadow maps rendered or reused from the cache since the last reset (see Bridge.Server)
+SHADOW_CACHE_STATS = {
+    'Rendered' : 0,
+    'Cached' : 0,
+}
 
 class C_LightsBuffer(ctypes.Structure):
-    
+    #The light matrices and the spot shadow regions share a texture buffer, the offsets are in texels
     _fields_ = [
-        ('lights', C_Light*MAX_LIGHTS),
         ('lights_count', ctypes.c_int),
         ('cascades_count', ctypes.c_int),
+        ('spot_matrices_offset', ctypes.c_int),
+        ('sun_matrices_offset', ctypes.c_int),
+        ('point_matrices_offset', ctypes.c_int),
+        #The spot shadow maps atlas regions (see ShadowMaps.get_spot_regions_uv)
+        ('spot_shadow_regions_offset', ctypes.c_int),
         ('__padding', ctypes.c_int32*2),
-        ('spot_matrices', ctypes.c_float*16*MAX_SPOTS),
-        ('sun_matrices', ctypes.c_float*16*MAX_SUNS),
-        ('point_matrices', ctypes.c_float*16*MAX_POINTS),
     ]
 
+#Spot light shadow maps are packed in a shared atlas, with a region size based on the light screen coverage
+MIN_SPOT_SHADOW_RESOLUTION = 128
+MAX_SHADOW_ATLAS_SIZE = 8192
+#The atlas is re-created smaller only when the packed regions use less than 1/SPOT_ATLAS_SHRINK_RATIO of its area
+SPOT_ATLAS_SHRINK_RATIO = 4
+
+def next_power_of_two(value):
+    return 1 << max(0, math.ceil(math.log2(max(1, value))))
+
+def get_spot_shadow_resolutions(scene, max_resolution, view_resolution):
+    #Returns the shadow map resolution of each spot light, from the size of the light volume on screen
+    #scaled by the light importance (its 'Shadow Priority' parameter, if any).
+    #Lights outside the view only affect off-screen surfaces, so they get the minimum resolution.
+    from Malt.Render.Culling import gl_matrix, frustum_planes
+    max_resolution = next_power_of_two(max_resolution)
+    min_resolution = min(MIN_SPOT_SHADOW_RESOLUTION, max_resolution)
+    camera = gl_matrix(scene.camera.camera_matrix)
+    projection = gl_matrix(scene.camera.projection_matrix)
+    planes = frustum_planes(projection @ camera)
+    is_ortho = projection[3][3] == 1.0
+    resolutions = []
+    for light in scene.lights:
+        if light.type != LIGHT_SPOT:
+            continue
+        position = np.array([*light.position, 1.0], np.float32)
+        distances = planes[:,:3] @ position[:3] + planes[:,3]
+        distances /= np.linalg.norm(planes[:,:3], axis=1)
+        if np.any(distances < -light.radius):
+            resolutions.append(min_resolution)
+            continue
+        depth = -(camera @ position)[2]
+        if is_ortho:
+            screen_radius = light.radius * projection[1][1]
+        elif depth > light.radius:
+            screen_radius = light.radius / depth * projection[1][1]
+        else:
+            #The camera is inside the light volume
+            screen_radius = 1.0
+        pixels = screen_radius * view_resolution[1] * light.parameters.get('Shadow Priority', 1.0)
+        resolutions.append(min(max_resolution, max(min_resolution, next_power_of_two(pixels))))
+    return resolutions
+
+def pack_shadow_atlas(resolutions, max_size=MAX_SHADOW_ATLAS_SIZE):
+    #Packs power of two squares into an atlas up to max_size. When they don't fit, the largest squares are halved,
+    #down to MIN_SPOT_SHADOW_RESOLUTION. If they still don't fit, the atlas is larger than max_size.
+    #Returns ((width, height), resolutions, [(x, y), ...]) in the same order as the input resolutions.
+    #Squares are placed in Z-order by decreasing size, so each one starts at a multiple of its own area
+    #and the packing has no gaps.
+    resolutions = list(resolutions)
+    while True:
+        area = sum(r*r for r in resolutions)
+        largest = max(resolutions, default=1)
+        width = max(largest, next_power_of_two(math.sqrt(area)))
+        if width <= max_size or largest <= max(1, MIN_SPOT_SHADOW_RESOLUTION):
+            break
+        resolutions = [max(r // 2, MIN_SPOT_SHADOW_RESOLUTION) if r == largest else r for r in resolutions]
+    
+    def deinterleave(value):
+        result = 0
+        bit = 0
+        while value:
+            result |= (value & 1) << bit
+            value >>= 2
+            bit += 1
+        return result
+    
+    offsets = [None] * len(resolutions)
+    area = 0
+    for i in sorted(range(len(resolutions)), key=lambda i: -resolutions[i]):
+        r = resolutions[i]
+        index = area // (r*r)
+        offsets[i] = (deinterleave(index) * r, deinterleave(index >> 1) * r)
+        area += r*r
+    #Trim the atlas to the used area
+    width = max([x + r for (x, y), r in zip(offsets, resolutions)], default=largest)
+    height = max([y + r for (x, y), r in zip(offsets, resolutions)], default=largest)
+    return (width, height), resolutions, offsets
+
+
 class ShadowMaps():
 
     def __init__(self):
-        self.max_spots = 1
         self.spot_resolution = 2048
+        self.spot_atlas_size = None
+        self.spot_regions = []
 
         self.spot_depth_t = None
+        self.spot_atlas_fbo = None
         self.spot_fbos = []
 
         self.max_suns = 1
@@ -79,52 +164,94 @@ class ShadowMaps():
 
         self.point_depth_t = None
         self.point_fbos = []
+        #The 6 sides of each point light, to render them in a single layered pass
+        self.point_layers = []
 
         self.initialized = False
+        #Increased each time the textures are re-created, so cached shadow maps can be invalidated.
+        #The spot atlas is re-created separately, since its size follows the camera (see get_spot_shadow_resolutions)
+        self.generation = 0
+        self.spot_generation = 0
 
-    def load(self, scene, spot_resolution, sun_resolution, point_resolution, sun_cascades):
+    def load(self, scene, spot_resolution, sun_resolution, point_resolution, sun_cascades, clear=True, spot_resolutions=None):
+        #spot_resolutions is the resolution of each spot light (see get_spot_shadow_resolutions), spot_resolution by default
         needs_setup = self.initialized is False
+        needs_spot_setup = self.initialized is False
         self.initialized = True
         
-        new_settings = (spot_resolution, sun_resolution, point_resolution)
-        current_settings = (self.spot_resolution, self.sun_resolution, self.point_resolution)
-        if new_settings != current_settings:
+        if spot_resolution != self.spot_resolution:
             self.spot_resolution = spot_resolution
+            needs_spot_setup = True
+        if (sun_resolution, point_resolution) != (self.sun_resolution, self.point_resolution):
             self.sun_resolution = sun_resolution
             self.point_resolution = point_resolution
             needs_setup = True
         
         spot_count = len([l for l in scene.lights if l.type == LIGHT_SPOT])
-        if spot_count > self.max_spots:
-            self.max_spots = spot_count
-            needs_setup = True
+        if spot_resolutions is None:
+            spot_resolutions = [next_power_of_two(spot_resolution)] * spot_count
+        atlas_size, resolutions, offsets = pack_shadow_atlas(spot_resolutions)
+        #The atlas grows as soon as the regions don't fit,
+        #but only shrinks when they use less than a quarter of it, so zooming and panning don't re-create it every frame
+        if self.spot_atlas_size is None:
+            needs_spot_setup = True
+        else:
+            current_w, current_h = self.spot_atlas_size
+            w, h = atlas_size
+            if w > current_w or h > current_h or w * h * SPOT_ATLAS_SHRINK_RATIO < current_w * current_h:
+                needs_spot_setup = True
+            elif needs_spot_setup == False:
+                atlas_size = self.spot_atlas_size
+        self.spot_atlas_size = atlas_size
+        spot_regions = [(x, y, r) for (x, y), r in zip(offsets, resolutions)]
+        #Keep the same region targets while the packing doesn't change (draw_scene_pass keys its culled batches by render target)
+        needs_regions = needs_spot_setup or spot_regions != self.spot_regions
+        self.spot_regions = spot_regions
         
+        #Arrays grow to fit the lights, and shrink when less than half of the layers are used
         sun_count = len([l for l in scene.lights if l.type == LIGHT_SUN])
         sun_count  = sun_count * sun_cascades
-        if sun_count > self.max_suns:
-            self.max_suns = sun_count
+        if sun_count > self.max_suns or sun_count < self.max_suns // 2:
+            self.max_suns = max(1, sun_count)
             needs_setup = True 
 
         point_count = len([l for l in scene.lights if l.type == LIGHT_POINT])
-        if point_count > self.max_points:
-            self.max_points = point_count
+        if point_count > self.max_points or point_count < self.max_points // 2:
+            self.max_points = max(1, point_count)
             needs_setup = True
         
         if needs_setup:
             self.setup()
+        if needs_spot_setup:
+            self.setup_spot_atlas()
         
-        self.clear(spot_count, sun_count, point_count)
+        if needs_regions:
+            self.spot_fbos = [RenderTargetRegion(self.spot_atlas_fbo, (x, y), (r, r)) for x, y, r in self.spot_regions]
+        
+        #New textures must always be cleared
+        if clear:
+            self.clear(spot_count, sun_count, point_count)
+        else:
+            self.clear(spot_count if needs_spot_setup else 0, sun_count if needs_setup else 0, point_count if needs_setup else 0)
+    
+    def get_spot_regions_uv(self):
+        #Returns the spot regions as (x, y, width, height) in atlas UV space
+        w, h = self.spot_atlas_size
+        return [(x / w, y / h, r / w, r / h) for x, y, r in self.spot_regions]
+    
+    def setup_spot_atlas(self, create_fbos=True):
+        self.spot_generation += 1
+        self.spot_depth_t = TextureArray(self.spot_atlas_size, 1, GL_DEPTH_COMPONENT32F)
+        if create_fbos:
+            self.spot_atlas_fbo = RenderTarget([], ArrayLayerTarget(self.spot_depth_t, 0))
     
     def setup(self, create_fbos=True):
-        self.spot_depth_t = TextureArray((self.spot_resolution, self.spot_resolution), self.max_spots, GL_DEPTH_COMPONENT32F)
+        #Sun and point light shadow maps
+        self.generation += 1
         self.sun_depth_t = TextureArray((self.sun_resolution, self.sun_resolution), self.max_suns, GL_DEPTH_COMPONENT32F)
         self.point_depth_t = CubeMapArray((self.point_resolution, self.point_resolution), self.max_points, GL_DEPTH_COMPONENT32F)
 
         if create_fbos:
-            self.spot_fbos = []
-            for i in range(self.spot_depth_t.length):
-                self.spot_fbos.append(RenderTarget([], ArrayLayerTarget(self.spot_depth_t, i)))
-            
             self.sun_fbos = []
             for i in range(self.sun_depth_t.length):
                 self.sun_fbos.append(RenderTarget([], ArrayLayerTarget(self.sun_depth_t, i)))
@@ -132,14 +259,20 @@ class ShadowMaps():
             self.point_fbos = []
             for i in range(self.point_depth_t.length*6):
                 self.point_fbos.append(RenderTarget([], ArrayLayerTarget(self.point_depth_t, i)))
+            
+            point_layered_fbo = RenderTarget([], LayeredTarget(self.point_depth_t))
+            self.point_layers = [RenderTargetLayers(point_layered_fbo, i*6, 6) for i in range(self.point_depth_t.length)]
         
     def clear(self, spot_count, sun_count, point_count):
         for i in range(spot_count):
-            self.spot_fbos[i].clear(depth=1)
+            self.clear_fbo(self.spot_fbos[i])
         for i in range(sun_count):
-            self.sun_fbos[i].clear(depth=1)
+            self.clear_fbo(self.sun_fbos[i])
         for i in range(point_count*6):
-            self.point_fbos[i].clear(depth=1)
+            self.clear_fbo(self.point_fbos[i])
+    
+    def clear_fbo(self, fbo):
+        fbo.clear(depth=1)
     
     def shader_callback(self, shader):
         shader.textures['SHADOWMAPS_DEPTH_SPOT'] = self.spot_depth_t
@@ -152,99 +285,125 @@ class LightsBuffer():
     def __init__(self):
         self.data = C_LightsBuffer()
         self.UBO = UBO()
+        #C_Light records
+        self.lights = np.zeros(0, C_Light)
+        self.lights_texture = TextureBuffer(GL_RGBA32UI)
+        #RGBA32F texels, 4 per matrix
+        self.matrices = np.zeros((0,4), np.float32)
+        self.matrices_texture = TextureBuffer(GL_RGBA32F)
         self.spots = None
         self.suns = None
         self.points = None
+        self.light_indices = {}
     
     def load(self, scene, cascades_count, cascades_distribution_scalar, cascades_max_distance=1.0, sample_offset=(0,0)):
+        self.pack(scene, cascades_count, cascades_distribution_scalar, cascades_max_distance, sample_offset)
+        self.upload()
+    
+    def pack(self, scene, cascades_count, cascades_distribution_scalar, cascades_max_distance=1.0, sample_offset=(0,0)):
+        #Packs the lights data and matrices for all the lights at once, without uploading them
         #TODO: Automatic distribution exponent basedd on FOV
 
-        spot_count=0
-        sun_count=0
-        point_count=0
-
         from collections import OrderedDict
 
         self.spots = OrderedDict()
         self.suns = OrderedDict()
         self.points = OrderedDict()
-
-        for i, light in enumerate(scene.lights):
-            self.data.lights[i].color = light.color
-            self.data.lights[i].type = light.type
-            self.data.lights[i].position = light.position
-            self.data.lights[i].radius = light.radius
-            self.data.lights[i].direction = light.direction
-            self.data.lights[i].spot_angle = light.spot_angle
-            self.data.lights[i].spot_blend = light.spot_blend
-
-            if light.type == LIGHT_SPOT:
-                self.data.lights[i].type_index = spot_count
-
-                projection_matrix = make_projection_matrix(light.spot_angle,1,0.01,light.radius)
-                spot_matrix = projection_matrix * pyrr.Matrix44(light.matrix)
-                
-                self.data.spot_matrices[spot_count] = flatten_matrix(spot_matrix)
-
-                self.spots[light] = [(light.matrix, flatten_matrix(projection_matrix))]
-
-                spot_count+=1
-            
-            if light.type == LIGHT_SUN:
-                self.data.lights[i].type_index = sun_count
-
-                sun_matrix = pyrr.Matrix44(light.matrix)
-                projection_matrix = pyrr.Matrix44(scene.camera.projection_matrix)
-                view_matrix = projection_matrix * pyrr.Matrix44(scene.camera.camera_matrix)
-
-                max_distance = cascades_max_distance
-                if light.sun_max_distance != 0:
-                    max_distance = light.sun_max_distance
-                
-                cascades_matrices = get_sun_cascades(sun_matrix, projection_matrix, view_matrix, cascades_count, cascades_distribution_scalar, max_distance)
-                
-                self.suns[light] = []
-                for i, cascade in enumerate(cascades_matrices):
-                    cascade = flatten_matrix(cascade)
-                    self.data.sun_matrices[sun_count * cascades_count + i] = cascade
-                    
-                    self.suns[light].append((cascade, flatten_matrix(pyrr.Matrix44.identity())))
-
-                sun_count+=1
-            
-            if light.type == LIGHT_POINT:
-                self.data.lights[i].type_index = point_count
-
-                cube_map_axes = [
-                    (( 1, 0, 0),( 0,-1, 0)),
-                    ((-1, 0, 0),( 0,-1, 0)),
-                    (( 0, 1, 0),( 0, 0, 1)),
-                    (( 0,-1, 0),( 0, 0,-1)),
-                    (( 0, 0, 1),( 0,-1, 0)),
-                    (( 0, 0,-1),( 0,-1, 0))
-                ]
-                matrices = []
-                position = pyrr.Vector3(light.position)
-                offset_matrix = pyrr.Matrix44.from_translation(position)
-                rotation_matrix = pyrr.Matrix44.from_eulers((sample_offset[0], sample_offset[1], 0.0))
-                for axes in cube_map_axes:
-                    front = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[0])
-                    up = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[1])
-                    matrices.append(pyrr.Matrix44.look_at(position, position + front, up))
-                self.data.point_matrices[point_count] = flatten_matrix((offset_matrix * rotation_matrix).inverse)
-
-                projection_matrix = make_projection_matrix(math.pi / 2.0, 1.0, 0.01, light.radius)
-
-                self.points[light] = []
-                for i in range(6):
-                    self.points[light].append((flatten_matrix(matrices[i]), flatten_matrix(projection_matrix)))
-                
-                point_count+=1
-            
-        self.data.lights_count = len(scene.lights)
+        self.light_indices = {light : i for i, light in enumerate(scene.lights)}
+
+        lights = np.array([(*l.color, l.type, *l.position, l.radius, *l.direction, l.spot_angle, l.spot_blend)
+            for l in scene.lights], np.float64).reshape(-1, 13)
+        types = lights[:,3].astype(np.int32)
+        positions = lights[:,4:7]
+        radii = lights[:,7]
+        spot_angles = lights[:,11]
+        #The index of each light among the lights of the same type
+        type_index = np.zeros(len(types), np.int32)
+        type_counts = {}
+        for light_type in (LIGHT_SPOT, LIGHT_SUN, LIGHT_POINT):
+            is_type = types == light_type
+            type_counts[light_type] = int(np.count_nonzero(is_type))
+            type_index[is_type] = np.arange(type_counts[light_type])
+        spot_count = type_counts[LIGHT_SPOT]
+        sun_count = type_counts[LIGHT_SUN]
+        point_count = type_counts[LIGHT_POINT]
+
+        self.lights = np.zeros(len(types), C_Light)
+        self.lights['color'] = lights[:,0:3]
+        self.lights['type'] = types
+        self.lights['position'] = positions
+        self.lights['radius'] = radii
+        self.lights['direction'] = lights[:,8:11]
+        self.lights['spot_angle'] = spot_angles
+        self.lights['spot_blend'] = lights[:,12]
+        self.lights['type_index'] = type_index
+        self.lights['shadow_offset'] = sample_offset
+
+        self.data.lights_count = len(types)
         self.data.cascades_count = cascades_count
+        self.data.spot_matrices_offset = 0
+        self.data.sun_matrices_offset = spot_count * 4
+        self.data.point_matrices_offset = self.data.sun_matrices_offset + sun_count * cascades_count * 4
+        self.data.spot_shadow_regions_offset = self.data.point_matrices_offset + point_count * 4
+        self.matrices = np.zeros((self.data.spot_shadow_regions_offset + spot_count, 4), np.float32)
+        self.set_spot_shadow_regions([(0, 0, 1, 1)] * spot_count)
+
+        #The matrices are computed as (n, 4, 4) column-vector matrices, and written to the matrices buffer as column texels
+        if spot_count > 0:
+            spots = [l for l in scene.lights if l.type == LIGHT_SPOT]
+            is_spot = types == LIGHT_SPOT
+            light_matrices = gl_matrices([l.matrix for l in spots])
+            projections = make_projection_matrices(spot_angles[is_spot], 1, 0.01, radii[is_spot])
+            self.set_matrices(self.data.spot_matrices_offset, projections @ light_matrices)
+            for light, projection in zip(spots, flat_matrices(projections).tolist()):
+                self.spots[light] = [(light.matrix, tuple(projection))]
+        
+        if sun_count > 0:
+            suns = [l for l in scene.lights if l.type == LIGHT_SUN]
+            projection = gl_matrices(scene.camera.projection_matrix)[0]
+            view = projection @ gl_matrices(scene.camera.camera_matrix)[0]
+            max_distances = [l.sun_max_distance if l.sun_max_distance != 0 else cascades_max_distance for l in suns]
+            cascades = get_sun_cascades(gl_matrices([l.matrix for l in suns]), projection, view,
+                cascades_count, cascades_distribution_scalar, max_distances)
+            self.set_matrices(self.data.sun_matrices_offset, cascades)
+            identity = tuple(flat_matrices(np.identity(4)).tolist())
+            for light, light_cascades in zip(suns, flat_matrices(cascades).tolist()):
+                self.suns[light] = [(tuple(cascade), identity) for cascade in light_cascades]
         
+        if point_count > 0:
+            points = [l for l in scene.lights if l.type == LIGHT_POINT]
+            is_point = types == LIGHT_POINT
+            views, point_matrices = get_point_light_matrices(positions[is_point], radii[is_point], sample_offset)
+            self.set_matrices(self.data.point_matrices_offset, point_matrices)
+            for light, light_views in zip(points, views):
+                self.points[light] = light_views
+    
+    def set_matrices(self, offset, matrices):
+        #matrices are (..., 4, 4) column-vector matrices, stored as 4 column texels each
+        matrices = np.swapaxes(matrices, -1, -2).reshape(-1, 4)
+        self.matrices[offset:offset+len(matrices)] = matrices
+    
+    def set_shadow_offset(self, light, sample_offset):
+        #Shade the light with shadow maps rendered with a different sample offset (ie. cached from a previous sample).
+        #Call upload after changing the offsets.
+        index = self.light_indices[light]
+        self.lights['shadow_offset'][index] = sample_offset
+        if light.type == LIGHT_POINT:
+            views, point_matrices = get_point_light_matrices([light.position], [light.radius], sample_offset)
+            self.set_matrices(self.data.point_matrices_offset + int(self.lights['type_index'][index]) * 4, point_matrices)
+            self.points[light] = views[0]
+    
+    def set_spot_shadow_regions(self, regions):
+        #See ShadowMaps.get_spot_regions_uv. Call upload after changing the regions.
+        if len(regions):
+            offset = self.data.spot_shadow_regions_offset
+            self.matrices[offset:offset+len(regions)] = regions
+    
+    def upload(self):
+        #Only the lights and matrices that changed since the last upload are sent to the GPU
         self.UBO.load_data(self.data)
+        self.lights_texture.update(self.lights.view(np.uint32).reshape(-1, ctypes.sizeof(C_Light) // 4))
+        self.matrices_texture.update(self.matrices)
     
     def bind(self, block):
         self.UBO.bind(block)
@@ -252,111 +411,155 @@ class LightsBuffer():
     def shader_callback(self, shader):
         if 'SCENE_LIGHTS' in shader.uniform_blocks:
             self.bind(shader.uniform_blocks['SCENE_LIGHTS'])
+            shader.textures['LIGHTS_DATA'] = self.lights_texture
+            shader.textures['LIGHTS_MATRICES'] = self.matrices_texture
+
+
+#The light matrices are computed in batches of (..., 4, 4) column-vector matrices.
+#Scene matrices are flat column-major (OpenGL) matrices.
+
+def gl_matrices(flat_matrices):
+    #Flat column-major matrices to (n, 4, 4) matrices
+    return np.swapaxes(np.asarray(flat_matrices, np.float64).reshape(-1, 4, 4), -1, -2)
+
+def flat_matrices(matrices):
+    #(..., 4, 4) matrices to flat column-major (..., 16) matrices
+    return np.swapaxes(matrices, -1, -2).reshape(*matrices.shape[:-2], 16)
+
+def translation_matrices(translations):
+    translations = np.asarray(translations, np.float64)
+    result = np.zeros(translations.shape[:-1] + (4,4))
+    result[...] = np.identity(4)
+    result[...,:3,3] = translations
+    return result
+
+
+#(front, up) of each cubemap side
+CUBE_MAP_AXES = np.array([
+    (( 1, 0, 0),( 0,-1, 0)),
+    ((-1, 0, 0),( 0,-1, 0)),
+    (( 0, 1, 0),( 0, 0, 1)),
+    (( 0,-1, 0),( 0, 0,-1)),
+    (( 0, 0, 1),( 0,-1, 0)),
+    (( 0, 0,-1),( 0,-1, 0))
+], np.float64)
+
+def get_point_light_matrices(positions, radii, sample_offset):
+    #Returns the (camera, projection) pairs for each cubemap side of each light, and the (n, 4, 4) world to light matrices.
+    #The cubemaps are rotated by the sample offset to antialias the shadows.
+    positions = np.asarray(positions, np.float64).reshape(-1, 3)
+    rotation = np.array(pyrr.Matrix44.from_eulers((sample_offset[0], sample_offset[1], 0.0))).T[:3,:3]
+    #The cubemap sides rotation is the same for all the lights (see pyrr.Matrix44.look_at)
+    fronts = CUBE_MAP_AXES[:,0] @ rotation.T
+    ups = CUBE_MAP_AXES[:,1] @ rotation.T
+    fronts /= np.linalg.norm(fronts, axis=1)[:,None]
+    sides = np.cross(fronts, ups)
+    sides /= np.linalg.norm(sides, axis=1)[:,None]
+    ups = np.cross(sides, fronts)
+    ups /= np.linalg.norm(ups, axis=1)[:,None]
+    sides_rotation = np.stack([sides, ups, -fronts], axis=1)
+
+    cameras = np.zeros((len(positions), 6, 4, 4))
+    cameras[:,:,:3,:3] = sides_rotation
+    cameras[:,:,:3,3] = -np.einsum('sij,nj->nsi', sides_rotation, positions)
+    cameras[:,:,3,3] = 1
+    
+    point_matrices = np.zeros((len(positions), 4, 4))
+    point_matrices[:,:3,:3] = rotation.T
+    point_matrices[:,:3,3] = -positions @ rotation
+    point_matrices[:,3,3] = 1
 
+    projections = flat_matrices(make_projection_matrices(math.pi / 2.0, 1.0, 0.01, radii)).tolist()
+    views = []
+    for light_cameras, projection in zip(flat_matrices(cameras).tolist(), projections):
+        projection = tuple(projection)
+        views.append([(tuple(camera), projection) for camera in light_cameras])
 
-def flatten_matrix(matrix):
-    return (ctypes.c_float * 16)(*[e for v in matrix for e in v])
+    return views, point_matrices
 
 
 #TODO: Hard-coded for Blender conventions for now
-def make_projection_matrix(fov, aspect_ratio, near, far):
-    x_scale = 1.0 / math.tan(fov / 2.0)
+def make_projection_matrices(fov, aspect_ratio, near, far):
+    #Returns a projection matrix for each (fov, near, far), the parameters can be arrays or scalars
+    fov, near, far = np.broadcast_arrays(*[np.asarray(v, np.float64) for v in (fov, near, far)])
+    x_scale = 1.0 / np.tan(fov / 2.0)
     y_scale = x_scale * aspect_ratio
-    return pyrr.Matrix44([
-        x_scale, 0, 0, 0,
-        0, y_scale, 0, 0,
-        0, 0, (-(far + near)) / (far - near), -1,
-        0, 0, (-2.0 * far * near) / (far - near), 0
-    ])
+    result = np.zeros(fov.shape + (4,4))
+    result[...,0,0] = x_scale
+    result[...,1,1] = y_scale
+    result[...,2,2] = (-(far + near)) / (far - near)
+    result[...,2,3] = (-2.0 * far * near) / (far - near)
+    result[...,3,2] = -1
+    return result
 
 
-def get_sun_cascades(sun_from_world_matrix, projection_matrix, view_from_world_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distance):
-    cascades = []
-    splits = []
+def get_sun_cascades(sun_from_world_matrices, projection_matrix, view_from_world_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distances):
+    #Returns the (n, cascades_count, 4, 4) cascade matrices of n sun lights
+    max_distances = np.asarray(cascades_max_distances, np.float64).reshape(-1)
 
-    n,f = 0,0    
     if projection_matrix[3][3] == 1.0:
         # ortho
-        n = cascades_max_distance / 2
-        f = -cascades_max_distance / 2
+        n = max_distances / 2
+        f = -max_distances / 2
     else:
         # perspective
-        clip_start = projection_matrix.inverse * pyrr.Vector4([0,0,-1,1])
-        clip_start /= clip_start.w
-        n = clip_start.z
-        f = -cascades_max_distance
-
-    def lerp(a,b,f):
-        f = max(0,min(f,1))
-        return a * (1.0 - f) + b * f
-
-    for i in range(cascades_count+1):
-        split_log = n * pow(f/n, i/cascades_count)
-        split_uniform = n + (f-n) * (i/cascades_count)
-        split = lerp(split_uniform, split_log, cascades_distribution_scalar)
-
-        projected = projection_matrix * pyrr.Vector4([0,0,split,1])
-        projected = (projected / projected.w) * (1.0 if projected.w >= 0 else -1.0)
-        splits.append(projected.z)
-        
-    for i in range(1, len(splits)):
-        near = splits[i-1]
-        far = splits[i]
-        cascades.append(sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far))
+        clip_start = np.linalg.inv(projection_matrix) @ (0,0,-1,1)
+        n = np.full(len(max_distances), clip_start[2] / clip_start[3])
+        f = -max_distances
+    n = n[:,None]
+    f = f[:,None]
+
+    t = np.arange(cascades_count+1) / cascades_count
+    #near and far have opposite signs in ortho views, the logarithmic split keeps the real part of the complex power
+    split_log = (n * np.power((f/n).astype(complex), t)).real
+    split_uniform = n + (f-n) * t
+    factor = max(0, min(cascades_distribution_scalar, 1))
+    splits = split_uniform * (1.0 - factor) + split_log * factor
+
+    z = projection_matrix[2][2] * splits + projection_matrix[2][3]
+    w = projection_matrix[3][2] * splits + projection_matrix[3][3]
+    splits = (z / w) * np.where(w >= 0, 1.0, -1.0)
     
-    return cascades
+    return sun_shadowmap_matrix(sun_from_world_matrices, view_from_world_matrix, splits[:,:-1], splits[:,1:])
 
 
 def frustum_corners(view_from_world_matrix, near, far):
-    m = view_from_world_matrix.inverse
-    corners = []
-
+    #Returns the (..., 8, 4) world space corners for each near and far NDC depth
+    near, far = np.broadcast_arrays(np.asarray(near, np.float64), np.asarray(far, np.float64))
+    corners = np.ones(near.shape + (8, 4))
+    i = 0
     for x in (-1, 1):
         for y in (-1, 1):
             for z in (near, far):
-                v = pyrr.Vector4([x, y, z, 1])
-                v = m * v
-                v /= v.w
-                corners.append(v)
-    
-    return corners
-
-
-def sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far):
-    INFINITY = float('inf')
-    aabb = {
-        'min': pyrr.Vector3([ INFINITY,  INFINITY,  INFINITY]),
-        'max': pyrr.Vector3([-INFINITY, -INFINITY, -INFINITY])
-    }
-    
-    for corner in frustum_corners(view_from_world_matrix, near, far):
-        corner = sun_from_world_matrix * corner
-        aabb['min'].x = min(aabb['min'].x, corner.x)
-        aabb['min'].y = min(aabb['min'].y, corner.y)
-        aabb['min'].z = min(aabb['min'].z, corner.z)
-        aabb['max'].x = max(aabb['max'].x, corner.x)
-        aabb['max'].y = max(aabb['max'].y, corner.y)
-        aabb['max'].z = max(aabb['max'].z, corner.z)
-
-    world_from_light_space = sun_from_world_matrix.inverse
-
-    size = aabb['max'] - aabb['min']
-    aabb['min'] = world_from_light_space * pyrr.Vector4([*aabb['min'].tolist(), 1.0])
-    aabb['max'] = world_from_light_space * pyrr.Vector4([*aabb['max'].tolist(), 1.0])
-    center = (aabb['min'] + aabb['max']) / 2.0
-    center = pyrr.Vector3(center.tolist()[:3])
-
-    scale = pyrr.Matrix44.from_scale(size)
-    translate = pyrr.Matrix44.from_translation(center)
+                corners[...,i,0] = x
+                corners[...,i,1] = y
+                corners[...,i,2] = z
+                i += 1
+    corners = corners @ np.linalg.inv(view_from_world_matrix).T
+    return corners / corners[...,3:]
+
+
+def sun_shadowmap_matrix(sun_from_world_matrices, view_from_world_matrix, near, far):
+    #sun_from_world_matrices is (n, 4, 4), near and far are the (n, cascades) NDC depths of each cascade.
+    #Returns the (n, cascades, 4, 4) matrices
+    corners = frustum_corners(view_from_world_matrix, near, far)
+    corners = np.einsum('nij,ncpj->ncpi', sun_from_world_matrices, corners)
+    aabb_min = corners[...,:3].min(axis=-2)
+    aabb_max = corners[...,:3].max(axis=-2)
+
+    world_from_light_space = np.linalg.inv(sun_from_world_matrices)[:,None]
+
+    size = aabb_max - aabb_min
+    center = (np.einsum('ncij,ncj->nci', world_from_light_space[...,:3,:3], (aabb_min + aabb_max) / 2.0)
+        + world_from_light_space[...,:3,3])
     
-    matrix = translate * world_from_light_space * scale
+    scale = np.zeros(size.shape[:-1] + (4,4))
+    scale[...,[0,1,2],[0,1,2]] = size
+    scale[...,3,3] = 1
+    translate = translation_matrices(center)
 
-    screen = pyrr.Matrix44([
-        1, 0, 0, 0,
-        0, 1, 0, 0,
-        0, 0,-1, 0,
-        0, 0, 0, 1
-    ])
+    matrix = translate @ world_from_light_space @ scale
 
-    return screen * matrix.inverse
+    screen = np.diag((1.0, 1.0, -1.0, 1.0))
 
+    return screen @ np.linalg.inv(matrix)
@@ -29,6 +29,7 @@ class Object():
 class Light():
 
     def __init__(self):
+        self.name = ''
         self.type = 0
         self.color = (0,0,0)
         self.parameters = {}
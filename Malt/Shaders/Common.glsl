@@ -1,12 +1,6 @@
 #ifndef COMMON_GLSL
 #define COMMON_GLSL
 
-#ifdef VERTEX_SHADER
-#define vertex_out out
-#else
-#define vertex_out in
-#endif
-
 vec3 POSITION;
 vec3 NORMAL;
 vec3 TANGENT;
@@ -15,8 +9,6 @@ vec2 UV[4];
 vec4 COLOR[4];
 uvec4 ID;
 
-vertex_out mat4 MODEL;
-
 layout(std140) uniform COMMON_UNIFORMS
 {
     uniform mat4 CAMERA;
@@ -28,6 +20,37 @@ layout(std140) uniform COMMON_UNIFORMS
     uniform float TIME;
 };
 
+#ifdef LAYERED_PASS
+    // Layered passes render every view in a single draw (ie. the 6 sides of a point light cubemap).
+    // The geometry shader routes each triangle to the layers (LAYER_OFFSET + view index) enabled in LAYER_MASK,
+    // and CAMERA and PROJECTION become the matrices of the view being rendered.
+    #define MAX_LAYERED_VIEWS 6
+
+    layout(std140) uniform LAYERED_VIEWS
+    {
+        uniform mat4 LAYER_CAMERA[MAX_LAYERED_VIEWS];
+        uniform mat4 LAYER_PROJECTION[MAX_LAYERED_VIEWS];
+        uniform int LAYER_OFFSET;
+        uniform int LAYER_MASK;
+    };
+
+    #if defined(VERTEX_SHADER)
+        // Vertices are shared by all the views, the geometry shader does the actual projection
+        #define LAYER_VIEW 0
+    #elif defined(GEOMETRY_SHADER)
+        #define LAYER_VIEW gl_InvocationID
+    #else
+        #define LAYER_VIEW IO_LAYER_VIEW
+    #endif
+
+    #define CAMERA LAYER_CAMERA[LAYER_VIEW]
+    #define PROJECTION LAYER_PROJECTION[LAYER_VIEW]
+
+    #define LAYERED_VIEW_OUTPUT flat int IO_LAYER_VIEW;
+#else
+    #define LAYERED_VIEW_OUTPUT
+#endif //LAYERED_PASS
+
 uniform bool MIRROR_SCALE = false;
 uniform bool PRECOMPUTED_TANGENTS = false;
 
@@ -47,13 +70,26 @@ layout(std140) uniform BATCH_IDS
 };
 #define BATCH_ID(index) BATCH_ID[(index)/4][(index)%4]
 
-vertex_out vec3 IO_POSITION;
-vertex_out vec3 IO_NORMAL;
-vertex_out vec3 IO_TANGENT;
-vertex_out vec3 IO_BITANGENT;
-vertex_out vec2 IO_UV[4];
-vertex_out vec4 IO_COLOR[4];
-flat vertex_out uvec4 IO_ID;
+#define COMMON_VERTEX_OUTPUT_MEMBERS \
+    mat4 MODEL; \
+    vec3 IO_POSITION; \
+    vec3 IO_NORMAL; \
+    vec3 IO_TANGENT; \
+    vec3 IO_BITANGENT; \
+    vec2 IO_UV[4]; \
+    vec4 IO_COLOR[4]; \
+    flat uvec4 IO_ID; \
+    LAYERED_VIEW_OUTPUT
+
+#if defined(VERTEX_SHADER)
+out COMMON_VERTEX_OUTPUT { COMMON_VERTEX_OUTPUT_MEMBERS };
+#elif defined(GEOMETRY_SHADER)
+in COMMON_VERTEX_OUTPUT { COMMON_VERTEX_OUTPUT_MEMBERS } IN[];
+out COMMON_VERTEX_OUTPUT { COMMON_VERTEX_OUTPUT_MEMBERS } OUT;
+mat4 MODEL;
+#else
+in COMMON_VERTEX_OUTPUT { COMMON_VERTEX_OUTPUT_MEMBERS };
+#endif
 
 #include "Common/Color.glsl"
 #include "Common/Hash.glsl"
@@ -130,6 +166,58 @@ void DEFAULT_SCREEN_VERTEX_SHADER()
 
 #endif //VERTEX_SHADER
 
+#if defined(GEOMETRY_SHADER) && defined(LAYERED_PASS)
+
+layout(triangles, invocations = MAX_LAYERED_VIEWS) in;
+layout(triangle_strip, max_vertices = 3) out;
+
+void LAYERED_GEOMETRY_SHADER()
+{
+    if((LAYER_MASK & (1 << gl_InvocationID)) == 0)
+    {
+        return;
+    }
+
+    vec4 positions[3];
+    for(int i = 0; i < 3; i++)
+    {
+        positions[i] = PROJECTION * CAMERA * vec4(IN[i].IO_POSITION, 1);
+        positions[i].xy += (SAMPLE_OFFSET / vec2(RESOLUTION)) * positions[i].w;
+    }
+
+    //Skip the triangles outside the view
+    for(int axis = 0; axis < 3; axis++)
+    {
+        bvec3 below = lessThan(vec3(positions[0][axis], positions[1][axis], positions[2][axis]),
+            -vec3(positions[0].w, positions[1].w, positions[2].w));
+        bvec3 above = greaterThan(vec3(positions[0][axis], positions[1][axis], positions[2][axis]),
+            vec3(positions[0].w, positions[1].w, positions[2].w));
+        if(all(below) || all(above))
+        {
+            return;
+        }
+    }
+
+    for(int i = 0; i < 3; i++)
+    {
+        gl_Position = positions[i];
+        gl_Layer = LAYER_OFFSET + gl_InvocationID;
+        OUT.MODEL = IN[i].MODEL;
+        OUT.IO_POSITION = IN[i].IO_POSITION;
+        OUT.IO_NORMAL = IN[i].IO_NORMAL;
+        OUT.IO_TANGENT = IN[i].IO_TANGENT;
+        OUT.IO_BITANGENT = IN[i].IO_BITANGENT;
+        OUT.IO_UV = IN[i].IO_UV;
+        OUT.IO_COLOR = IN[i].IO_COLOR;
+        OUT.IO_ID = IN[i].IO_ID;
+        OUT.IO_LAYER_VIEW = gl_InvocationID;
+        EmitVertex();
+    }
+    EndPrimitive();
+}
+
+#endif //GEOMETRY_SHADER && LAYERED_PASS
+
 #ifdef PIXEL_SHADER
 
 void PIXEL_SETUP_INPUT()
@@ -222,5 +222,139 @@ LineExpandOutput line_expand(vec2 uv, int max_width,
     return LineExpandOutput(line_color, line_depth);
 }
 
-#endif //LINE_GLSL
+/*  Jump flood line expansion.
+    Seeds store (pixel.x, pixel.y, line width, line depth). Pixels without a line store (-1, -1, 0, 0).
+    The flood passes propagate the seed line_expand would pick for each pixel, so the expansion cost
+    depends on log2(max_width) instead of max_width^2.
+*/
+
+/* META @meta: internal=true; */
+vec4 line_jump_flood_seed(ivec2 pixel, int max_width, sampler2D line_width_texture, int line_width_channel, float line_width_scale,
+                          sampler2D depth_texture, int depth_channel)
+{
+    float width = texelFetch(line_width_texture, pixel, 0)[line_width_channel] * line_width_scale;
+    width = min(width, float(max_width));
+
+    if(width <= 0)
+    {
+        return vec4(-1, -1, 0, 0);
+    }
+
+    float depth = texelFetch(depth_texture, pixel, 0)[depth_channel];
+    return vec4(vec2(pixel), width, depth);
+}
+
+//Returns the seed line alpha at pixel, or 0 if the line doesn't reach it or is hidden by the pixel surface
+/* META @meta: internal=true; */
+float line_jump_flood_alpha(ivec2 pixel, vec4 seed, float depth, uint id, usampler2D id_texture, int id_channel)
+{
+    if(seed.x < 0)
+    {
+        return 0.0;
+    }
+
+    float offset_length = distance(vec2(pixel), seed.xy);
+    if(offset_length > seed.z / 2.0)
+    {
+        return 0.0;
+    }
+
+    uint seed_id = texelFetch(id_texture, ivec2(seed.xy), 0)[id_channel];
+    if(seed_id != id && depth < seed.w)
+    {
+        return 0.0;
+    }
+
+    return clamp(seed.z / 2.0 - offset_length, 0.0, 1.0);
+}
+
+/* META @meta: internal=true; */
+vec4 line_jump_flood(ivec2 pixel, int step_width, sampler2D jump_flood_texture, sampler2D line_color_texture,
+                     sampler2D depth_texture, int depth_channel, usampler2D id_texture, int id_channel)
+{
+    ivec2 resolution = textureSize(jump_flood_texture, 0);
+
+    float depth = texelFetch(depth_texture, pixel, 0)[depth_channel];
+    uint id = texelFetch(id_texture, pixel, 0)[id_channel];
+
+    vec4 result = vec4(-1, -1, 0, 0);
+    //Seeds that reach the pixel are picked with the same priority rules as line_expand
+    bool result_reaches = false;
+    float result_alpha = 0.0;
+    //Otherwise keep the closest line edge, so it can keep propagating
+    float result_distance = 0.0;
+
+    for(int x = -1; x <= 1; x++)
+    {
+        for(int y = -1; y <= 1; y++)
+        {
+            ivec2 offset_pixel = pixel + ivec2(x,y) * step_width;
+            if(any(lessThan(offset_pixel, ivec2(0))) || any(greaterThanEqual(offset_pixel, resolution)))
+            {
+                continue;
+            }
+
+            vec4 seed = texelFetch(jump_flood_texture, offset_pixel, 0);
+            if(seed.x < 0)
+            {
+                continue;
+            }
+
+            float alpha = line_jump_flood_alpha(pixel, seed, depth, id, id_texture, id_channel);
+
+            if(alpha > 0)
+            {
+                bool override = !result_reaches;
+
+                if (alpha == 1.0 && seed.w < result.w)
+                {
+                    override = true;
+                }
+                else if(alpha > result_alpha)
+                {
+                    override = true;
+                }
 
+                if(override)
+                {
+                    result = seed;
+                    result_reaches = true;
+                    result_alpha = texelFetch(line_color_texture, ivec2(seed.xy), 0).a * alpha;
+                }
+            }
+            else if(!result_reaches)
+            {
+                float edge_distance = distance(vec2(pixel), seed.xy) - seed.z / 2.0;
+                if(result.x < 0 || edge_distance < result_distance)
+                {
+                    result = seed;
+                    result_distance = edge_distance;
+                }
+            }
+        }
+    }
+
+    return result;
+}
+
+/* META @meta: internal=true; */
+LineExpandOutput line_jump_flood_expand(ivec2 pixel, sampler2D jump_flood_texture, sampler2D line_color_texture,
+                                        sampler2D depth_texture, int depth_channel, usampler2D id_texture, int id_channel)
+{
+    float depth = texelFetch(depth_texture, pixel, 0)[depth_channel];
+    uint id = texelFetch(id_texture, pixel, 0)[id_channel];
+
+    vec4 seed = texelFetch(jump_flood_texture, pixel, 0);
+    float alpha = line_jump_flood_alpha(pixel, seed, depth, id, id_texture, id_channel);
+
+    if(alpha <= 0)
+    {
+        return LineExpandOutput(vec4(0), 1.0);
+    }
+
+    vec4 line_color = texelFetch(line_color_texture, ivec2(seed.xy), 0);
+    line_color.a *= alpha;
+    return LineExpandOutput(line_color, seed.w);
+}
+
+#endif //LINE_GLSL
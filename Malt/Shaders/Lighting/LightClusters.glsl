@@ -0,0 +1,70 @@
+#ifndef LIGHT_CLUSTERS_GLSL
+#define LIGHT_CLUSTERS_GLSL
+
+// Lights assigned to view space clusters (froxels), see Malt/Render/LightClusters.py
+// Requires SCENE_LIGHTS (see Lighting.glsl)
+
+layout(std140) uniform LIGHT_CLUSTERS
+{
+    mat4 LIGHT_CLUSTERS_VIEW;
+    mat4 LIGHT_CLUSTERS_PROJECTION;
+    ivec4 LIGHT_CLUSTERS_GRID_SIZE; //(x, y, z, enabled)
+    vec4 LIGHT_CLUSTERS_DEPTH; //(near, far, slices scale, is orthographic)
+};
+
+// (offset, count) of each cluster lights list. The last one holds the lights that reach every cluster
+uniform usamplerBuffer LIGHT_CLUSTERS_GRID;
+uniform usamplerBuffer LIGHT_CLUSTERS_INDICES;
+
+// Returns the (offset, count) of the global and the cluster light lists at position.
+// When position is outside the clusters, x is -1 and y is the scene lights count.
+/* META @meta: internal=true; */
+ivec4 light_cluster_ranges(vec3 position)
+{
+    ivec4 all_lights = ivec4(-1, LIGHTS.lights_count, 0, 0);
+    if(LIGHT_CLUSTERS_GRID_SIZE.w == 0)
+    {
+        return all_lights;
+    }
+
+    vec4 view_position = LIGHT_CLUSTERS_VIEW * vec4(position, 1);
+    vec4 clip_position = LIGHT_CLUSTERS_PROJECTION * view_position;
+    float depth = -view_position.z;
+    float near = LIGHT_CLUSTERS_DEPTH.x;
+    float far = LIGHT_CLUSTERS_DEPTH.y;
+    vec2 ndc = clip_position.xy / clip_position.w;
+    if(clip_position.w <= 0 || depth < near || depth > far || any(greaterThan(abs(ndc), vec2(1))))
+    {
+        return all_lights;
+    }
+    
+    ivec3 grid = LIGHT_CLUSTERS_GRID_SIZE.xyz;
+    ivec2 tile = clamp(ivec2(floor((ndc * 0.5 + 0.5) * vec2(grid.xy))), ivec2(0), grid.xy - 1);
+    float slice_depth = LIGHT_CLUSTERS_DEPTH.w > 0 ? depth - near : log(depth / near);
+    int slice = clamp(int(floor(slice_depth * LIGHT_CLUSTERS_DEPTH.z)), 0, grid.z - 1);
+    int cluster = (slice * grid.y + tile.y) * grid.x + tile.x;
+
+    uvec2 global_range = texelFetch(LIGHT_CLUSTERS_GRID, grid.x * grid.y * grid.z).xy;
+    uvec2 cluster_range = texelFetch(LIGHT_CLUSTERS_GRID, cluster).xy;
+    return ivec4(global_range, cluster_range);
+}
+
+/* META @meta: internal=true; */
+int light_cluster_ranges_count(ivec4 ranges)
+{
+    return ranges.y + ranges.w;
+}
+
+// Returns the scene light index of the nth light in the ranges
+/* META @meta: internal=true; */
+int light_cluster_light(ivec4 ranges, int n)
+{
+    if(ranges.x < 0)
+    {
+        return n;
+    }
+    int offset = n < ranges.y ? ranges.x + n : ranges.z + n - ranges.y;
+    return int(texelFetch(LIGHT_CLUSTERS_INDICES, offset).x);
+}
+
+#endif //LIGHT_CLUSTERS_GLSL
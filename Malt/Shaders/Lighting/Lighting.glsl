@@ -3,10 +3,6 @@
 
 #include "Common.glsl"
 
-#ifndef MAX_LIGHTS
-    #define MAX_LIGHTS 128
-#endif
-
 #define LIGHT_SUN 1
 #define LIGHT_POINT 2
 #define LIGHT_SPOT 3
@@ -22,21 +18,19 @@ struct Light
     float spot_angle;
     float spot_blend;
     int type_index;
+    vec2 shadow_offset; //The sample offset the shadow maps were rendered with
 };
 
-#define MAX_SPOTS 64
-#define MAX_SUNS 64
-#define MAX_POINTS 64
-
 /* META @meta: internal=true; */
 struct SceneLights
 {
-    Light lights[MAX_LIGHTS];
     int lights_count;
     int cascades_count;
-    mat4 spot_matrices[MAX_SPOTS];
-    mat4 sun_matrices[MAX_SUNS];
-    mat4 point_matrices[MAX_POINTS];
+    //Offsets in LIGHTS_MATRICES texels
+    int spot_matrices_offset;
+    int sun_matrices_offset;
+    int point_matrices_offset;
+    int spot_shadow_regions_offset; //(x, y, width, height) of each spot shadow map in the atlas
 };
 
 layout(std140) uniform SCENE_LIGHTS
@@ -44,6 +38,69 @@ layout(std140) uniform SCENE_LIGHTS
     SceneLights LIGHTS;
 };
 
+// The lights have no size limit, they're stored in texture buffers (see Malt/Render/Lighting.py LightsBuffer)
+uniform usamplerBuffer LIGHTS_DATA; //4 texels per light
+uniform samplerBuffer LIGHTS_MATRICES; //4 texels per matrix
+
+/* META @meta: internal=true; */
+Light scene_light(int index)
+{
+    uvec4 a = texelFetch(LIGHTS_DATA, index * 4 + 0);
+    uvec4 b = texelFetch(LIGHTS_DATA, index * 4 + 1);
+    uvec4 c = texelFetch(LIGHTS_DATA, index * 4 + 2);
+    uvec4 d = texelFetch(LIGHTS_DATA, index * 4 + 3);
+
+    Light L;
+    L.color = uintBitsToFloat(a.xyz);
+    L.type = int(a.w);
+    L.position = uintBitsToFloat(b.xyz);
+    L.radius = uintBitsToFloat(b.w);
+    L.direction = uintBitsToFloat(c.xyz);
+    L.spot_angle = uintBitsToFloat(c.w);
+    L.spot_blend = uintBitsToFloat(d.x);
+    L.type_index = int(d.y);
+    L.shadow_offset = uintBitsToFloat(d.zw);
+    return L;
+}
+
+/* META @meta: internal=true; */
+mat4 light_matrix(int offset)
+{
+    return mat4(
+        texelFetch(LIGHTS_MATRICES, offset + 0),
+        texelFetch(LIGHTS_MATRICES, offset + 1),
+        texelFetch(LIGHTS_MATRICES, offset + 2),
+        texelFetch(LIGHTS_MATRICES, offset + 3)
+    );
+}
+
+/* META @meta: internal=true; */
+mat4 spot_light_matrix(int type_index)
+{
+    return light_matrix(LIGHTS.spot_matrices_offset + type_index * 4);
+}
+
+// index is type_index * LIGHTS.cascades_count + cascade
+/* META @meta: internal=true; */
+mat4 sun_light_matrix(int index)
+{
+    return light_matrix(LIGHTS.sun_matrices_offset + index * 4);
+}
+
+/* META @meta: internal=true; */
+mat4 point_light_matrix(int type_index)
+{
+    return light_matrix(LIGHTS.point_matrices_offset + type_index * 4);
+}
+
+/* META @meta: internal=true; */
+vec4 spot_shadow_region(int type_index)
+{
+    return texelFetch(LIGHTS_MATRICES, LIGHTS.spot_shadow_regions_offset + type_index);
+}
+
+#include "Lighting/LightClusters.glsl"
+
 uniform sampler2DArray SHADOWMAPS_DEPTH_SPOT;
 uniform sampler2DArray SHADOWMAPS_DEPTH_SUN;
 uniform samplerCubeArray SHADOWMAPS_DEPTH_POINT;
@@ -161,16 +218,22 @@ LitSurface lit_surface(vec3 position, vec3 normal, Light light, bool shadows)
 /* META @meta: internal=true; */
 ShadowData spot_shadow(vec3 position, Light light, sampler2DArray shadowmap, float bias)
 {
-    vec2 shadowmap_size = vec2(textureSize(shadowmap, 0));
+    //Spot shadow maps are packed in a single layer atlas, light_uv is returned in atlas space
+    vec4 region = spot_shadow_region(light.type_index);
+    vec2 shadowmap_size = vec2(textureSize(shadowmap, 0).xy) * region.zw;
     
     ShadowData S;
-    S.light_space = project_point(LIGHTS.spot_matrices[light.type_index], position);
-    S.light_space.xy += (SAMPLE_OFFSET / shadowmap_size);    
+    S.light_space = project_point(spot_light_matrix(light.type_index), position);
+    S.light_space.xy += (light.shadow_offset / shadowmap_size);    
     
     S.light_uv = S.light_space * 0.5 + 0.5;
-    S.depth = texture(shadowmap, vec3(S.light_uv.xy, light.type_index)).x;
+    bool in_bounds = S.light_uv == clamp(S.light_uv, vec3(0), vec3(1));
+    //Don't filter across regions
+    vec2 half_texel = 0.5 / shadowmap_size;
+    S.light_uv.xy = region.xy + clamp(S.light_uv.xy, half_texel, 1.0 - half_texel) * region.zw;
+    S.depth = texture(shadowmap, vec3(S.light_uv.xy, 0)).x;
 
-    S.shadow = S.depth < S.light_uv.z - bias && S.light_uv == clamp(S.light_uv, vec3(0), vec3(1));
+    S.shadow = S.depth < S.light_uv.z - bias && in_bounds;
     //if(!S.shadow) S.depth = 0;
 
     return S;
@@ -188,8 +251,8 @@ ShadowData sun_shadow(vec3 position, Light light, sampler2DArray shadowmap, floa
     {
         int index = light.type_index * LIGHTS.cascades_count + c;
         
-        S.light_space = project_point(LIGHTS.sun_matrices[index], position);
-        S.light_space.xy += (SAMPLE_OFFSET / shadowmap_size);
+        S.light_space = project_point(sun_light_matrix(index), position);
+        S.light_space.xy += (light.shadow_offset / shadowmap_size);
         
         S.light_uv = S.light_space * 0.5 + 0.5;
 
@@ -212,7 +275,7 @@ ShadowData point_shadow(vec3 position, Light light, samplerCubeArray shadowmap,
     vec2 shadowmap_size = vec2(textureSize(shadowmap, 0));
     
     ShadowData S;
-    S.light_space = transform_point(LIGHTS.point_matrices[light.type_index], position);
+    S.light_space = transform_point(point_light_matrix(light.type_index), position);
     S.light_uv = normalize(S.light_space);
     
     float cubemap_side_depth = max(abs(S.light_space.x), max(abs(S.light_space.y), abs(S.light_space.z)));
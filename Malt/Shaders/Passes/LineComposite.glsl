@@ -29,16 +29,30 @@ uniform float line_width_scale = 1.0;
 
 uniform int brute_force_range = 10;
 
+uniform bool jump_flood = false;
+uniform sampler2D jump_flood_texture;
+
 void main()
 {
     PIXEL_SETUP_INPUT();
 
     vec2 uv = UV[0];
-    vec4 line_color = line_expand(
-        uv, brute_force_range,
-        line_color_texture, line_width_texture, line_width_channel, line_width_scale,
-        depth_texture, depth_channel, id_texture, id_channel
-    ).color;
+    vec4 line_color;
+    if(jump_flood)
+    {
+        line_color = line_jump_flood_expand(
+            screen_pixel(), jump_flood_texture, line_color_texture,
+            depth_texture, depth_channel, id_texture, id_channel
+        ).color;
+    }
+    else
+    {
+        line_color = line_expand(
+            uv, brute_force_range,
+            line_color_texture, line_width_texture, line_width_channel, line_width_scale,
+            depth_texture, depth_channel, id_texture, id_channel
+        ).color;
+    }
 
     vec4 color = texture(color_texture, uv);
     
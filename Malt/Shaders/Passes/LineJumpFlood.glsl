@@ -0,0 +1,56 @@
+#include "Common.glsl"
+
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_SCREEN_VERTEX_SHADER();
+}
+#endif
+
+#ifdef PIXEL_SHADER
+
+#include "Filters/Line.glsl"
+
+layout (location = 0) out vec4 OUT_RESULT;
+
+uniform sampler2D depth_texture;
+uniform int depth_channel;
+
+uniform usampler2D id_texture;
+uniform int id_channel;
+
+uniform sampler2D line_color_texture;
+
+uniform sampler2D line_width_texture;
+uniform int line_width_channel;
+uniform float line_width_scale = 1.0;
+
+uniform int max_width = 10;
+
+uniform sampler2D jump_flood_texture;
+//0 renders the seeds
+uniform int step_width = 0;
+
+void main()
+{
+    PIXEL_SETUP_INPUT();
+
+    ivec2 pixel = screen_pixel();
+
+    if(step_width == 0)
+    {
+        OUT_RESULT = line_jump_flood_seed(
+            pixel, max_width, line_width_texture, line_width_channel, line_width_scale,
+            depth_texture, depth_channel
+        );
+    }
+    else
+    {
+        OUT_RESULT = line_jump_flood(
+            pixel, step_width, jump_flood_texture, line_color_texture,
+            depth_texture, depth_channel, id_texture, id_channel
+        );
+    }
+}
+
+#endif //PIXEL_SHADER
@@ -0,0 +1,52 @@
+#include "Common.glsl"
+
+// Weighted Blended Order-Independent Transparency resolve (see NPR_Pipeline RenderLayer/MainPass.py)
+// IN_ACCUMULATION is the sum of (color.rgb * color.a, color.a), IN_REVEALAGE is the product of (1 - color.a)
+
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_SCREEN_VERTEX_SHADER();
+}
+#endif
+
+#ifdef PIXEL_SHADER
+
+uniform sampler2D IN_ACCUMULATION[8];
+uniform sampler2D IN_REVEALAGE[8];
+
+layout (location = 0) out vec4 OUT_RESULT_0;
+layout (location = 1) out vec4 OUT_RESULT_1;
+layout (location = 2) out vec4 OUT_RESULT_2;
+layout (location = 3) out vec4 OUT_RESULT_3;
+layout (location = 4) out vec4 OUT_RESULT_4;
+layout (location = 5) out vec4 OUT_RESULT_5;
+layout (location = 6) out vec4 OUT_RESULT_6;
+layout (location = 7) out vec4 OUT_RESULT_7;
+
+vec4 resolve(vec4 accumulation, float revealage)
+{
+    if(accumulation.a <= 0)
+    {
+        return vec4(0);
+    }
+    return vec4(accumulation.rgb / accumulation.a, 1.0 - revealage);
+}
+
+void main()
+{
+    PIXEL_SETUP_INPUT();
+
+    ivec2 uv = ivec2(gl_FragCoord.xy);
+
+    OUT_RESULT_0 = resolve(texelFetch(IN_ACCUMULATION[0], uv, 0), texelFetch(IN_REVEALAGE[0], uv, 0).r);
+    OUT_RESULT_1 = resolve(texelFetch(IN_ACCUMULATION[1], uv, 0), texelFetch(IN_REVEALAGE[1], uv, 0).r);
+    OUT_RESULT_2 = resolve(texelFetch(IN_ACCUMULATION[2], uv, 0), texelFetch(IN_REVEALAGE[2], uv, 0).r);
+    OUT_RESULT_3 = resolve(texelFetch(IN_ACCUMULATION[3], uv, 0), texelFetch(IN_REVEALAGE[3], uv, 0).r);
+    OUT_RESULT_4 = resolve(texelFetch(IN_ACCUMULATION[4], uv, 0), texelFetch(IN_REVEALAGE[4], uv, 0).r);
+    OUT_RESULT_5 = resolve(texelFetch(IN_ACCUMULATION[5], uv, 0), texelFetch(IN_REVEALAGE[5], uv, 0).r);
+    OUT_RESULT_6 = resolve(texelFetch(IN_ACCUMULATION[6], uv, 0), texelFetch(IN_REVEALAGE[6], uv, 0).r);
+    OUT_RESULT_7 = resolve(texelFetch(IN_ACCUMULATION[7], uv, 0), texelFetch(IN_REVEALAGE[7], uv, 0).r);
+}
+
+#endif //PIXEL_SHADER
@@ -0,0 +1,65 @@
+#Measures the time LightsBuffer spends packing the lights data and the spot, sun cascade and point light matrices,
+#for scenes with an even mix of light types.
+#Usage: python benchmark_light_matrices.py [iterations]
+
+import os, sys, time
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+malt_path = os.path.join(current_dir, '..')
+py_version = str(sys.version_info[0])+str(sys.version_info[1])
+sys.path.append(malt_path)
+sys.path.append(os.path.join(malt_path, 'Malt', '.Dependencies-{}'.format(py_version)))
+
+import numpy as np
+
+from Malt.Scene import Scene, Camera, Light
+from Malt.Render import Lighting
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+def look_at_matrix(position, target):
+    #World to light flat column-major matrix, looking down -Z
+    front = np.asarray(target, np.float64) - position
+    front /= np.linalg.norm(front)
+    side = np.cross(front, (0, 0, 1))
+    side /= np.linalg.norm(side)
+    up = np.cross(side, front)
+    matrix = np.identity(4)
+    matrix[:3,:3] = (side, up, -front)
+    matrix[:3,3] = -matrix[:3,:3] @ position
+    return tuple(matrix.T.flatten())
+
+def random_scene(lights_count):
+    rng = np.random.default_rng(0)
+    scene = Scene()
+    camera = look_at_matrix(np.array((0.0, -20.0, 5.0)), (0, 0, 0))
+    projection = Lighting.flat_matrices(Lighting.make_projection_matrices(1.0, 16/9, 0.1, 100))
+    scene.camera = Camera(camera, tuple(projection.tolist()))
+    for i in range(lights_count):
+        light = Light()
+        light.type = (Lighting.LIGHT_SPOT, Lighting.LIGHT_SUN, Lighting.LIGHT_POINT)[i % 3]
+        light.color = tuple(rng.random(3))
+        light.position = tuple(rng.uniform(-50, 50, 3))
+        light.direction = (0, 0, -1)
+        light.radius = float(rng.uniform(1, 10))
+        light.spot_angle = float(rng.uniform(0.2, 2.0))
+        light.matrix = look_at_matrix(np.array(light.position), rng.uniform(-10, 10, 3))
+        scene.lights.append(light)
+    return scene
+
+#pack doesn't need a GL context
+lights_buffer = Lighting.LightsBuffer.__new__(Lighting.LightsBuffer)
+lights_buffer.data = Lighting.C_LightsBuffer()
+
+for lights_count in (1, 64, 1024):
+    scene = random_scene(lights_count)
+    times = []
+    for i in range(iterations):
+        #The sample offset changes every accumulation sample
+        sample_offset = (i * 0.1, -i * 0.1)
+        start = time.perf_counter()
+        lights_buffer.pack(scene, 4, 0.9, 50, sample_offset)
+        times.append(time.perf_counter() - start)
+    print(f'{lights_count} Lights')
+    print(f'    Matrices : {len(lights_buffer.matrices) // 4}')
+    print(f'    Pack Time : {np.median(times)*1000:.2f} ms (median of {iterations})')
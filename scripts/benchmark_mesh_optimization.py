@@ -0,0 +1,53 @@
+#Measures Bridge.Mesh vertex welding and vertex cache reordering on per-loop grid meshes, like the ones sent by BlenderMalt.
+#Usage: python benchmark_mesh_optimization.py [grid_size]
+
+import os, sys, time
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+malt_path = os.path.join(current_dir, '..')
+py_version = str(sys.version_info[0])+str(sys.version_info[1])
+sys.path.append(malt_path)
+sys.path.append(os.path.join(malt_path, 'Malt', '.Dependencies-{}'.format(py_version)))
+
+import numpy as np
+
+from Bridge.Mesh import optimize_mesh_arrays, average_cache_miss_ratio
+
+grid_size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+
+def grid_mesh(size, shuffle=False):
+    #One loop per quad corner, smooth shaded, triangulated per quad
+    x, y = np.meshgrid(np.arange(size), np.arange(size))
+    corners = np.stack((x.ravel(), y.ravel()), axis=1)
+    quads = np.concatenate([corners + offset for offset in ((0,0),(1,0),(1,1),(0,1))], axis=1).reshape(-1, 4, 2)
+    if shuffle:
+        np.random.default_rng(0).shuffle(quads)
+    loops = quads.reshape(-1, 2).astype(np.float32)
+    positions = np.zeros((len(loops), 3), np.float32)
+    positions[:,:2] = loops
+    normals = np.zeros((len(loops), 3), np.float32)
+    normals[:,2] = 1
+    uvs = loops / size
+    quad_loops = np.arange(len(loops), dtype=np.uint32).reshape(-1, 4)
+    indices = quad_loops[:,[0,1,2,0,2,3]].ravel()
+    return {
+        'positions' : positions,
+        'normals' : normals,
+        'tangents' : None,
+        'uvs' : [uvs],
+        'colors' : [None]*4,
+        'indices' : [indices],
+    }
+
+for name, shuffle in (('Grid', False), ('Shuffled Grid', True)):
+    arrays = grid_mesh(grid_size, shuffle)
+    start = time.perf_counter()
+    optimized = optimize_mesh_arrays(arrays)
+    elapsed = time.perf_counter() - start
+    print(f'{name} ({len(arrays["indices"][0]) // 3} triangles)')
+    print(f'    Vertices : {len(arrays["positions"])} -> {len(optimized["positions"])}')
+    for cache_size in (16, 32):
+        before = average_cache_miss_ratio(arrays['indices'][0], cache_size)
+        after = average_cache_miss_ratio(optimized['indices'][0], cache_size)
+        print(f'    ACMR (FIFO {cache_size}) : {before:.3f} -> {after:.3f}')
+    print(f'    Optimization Time : {elapsed*1000:.2f} ms')
@@ -0,0 +1,71 @@
+#Compares the in-process GLSL preprocessor against mcpp on the NPR_Pipeline shader library.
+#Usage: python benchmark_shader_preprocessor.py [iterations]
+
+import os, sys, time
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+malt_path = os.path.join(current_dir, '..')
+py_version = str(sys.version_info[0])+str(sys.version_info[1])
+sys.path.append(malt_path)
+sys.path.append(os.path.join(malt_path, 'Malt', '.Dependencies-{}'.format(py_version)))
+
+from Malt.GL.Shader import mcpp_preprocessor
+from Malt.GL.GLSLPreprocessor import preprocess, split_comments, tokenize
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+shaders_dir = os.path.join(malt_path, 'Malt', 'Shaders')
+npr_dir = os.path.join(malt_path, 'Malt', 'Pipelines', 'NPR_Pipeline', 'Shaders')
+include_paths = [shaders_dir, npr_dir]
+
+cases = []
+for header, define in (('NPR_MeshShader.glsl', 'IS_MESH_SHADER'), ('NPR_ScreenShader.glsl', 'IS_SCREEN_SHADER'), ('NPR_LightShader.glsl', 'IS_LIGHT_SHADER')):
+    source = f'#include "{header}"\n#include "Node Utils/node_utils.glsl"\n'
+    passes = ['PRE_PASS', 'MAIN_PASS', 'SHADOW_PASS'] if define == 'IS_MESH_SHADER' else ['SHADER']
+    for shader_pass in passes:
+        for stage in ('VERTEX_SHADER', 'PIXEL_SHADER'):
+            cases.append((source, [define, shader_pass, stage]))
+
+for library_dir in (shaders_dir, npr_dir):
+    for root, dirs, files in os.walk(library_dir):
+        for file in files:
+            if file.endswith('.glsl'):
+                path = os.path.join(root, file)
+                cases.append((f'#include "{path}"\n', ['VERTEX_SHADER', 'PIXEL_SHADER', 'REFLECTION']))
+
+def normalize(source):
+    #Compare token streams, ignoring whitespace and #line directives
+    code, comments = [], []
+    in_comment = False
+    for line in source.splitlines():
+        if line.startswith('#line'):
+            continue
+        segments, in_comment = split_comments(line, in_comment)
+        for is_comment, text in segments:
+            if is_comment:
+                comments.append(text)
+            else:
+                code.extend(t.text for t in tokenize(text) if t.kind != 'space')
+    return code, ' '.join(' '.join(comments).split())
+
+def run(function):
+    results = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        results = [function(source, include_paths, definitions) for source, definitions in cases]
+    return (time.perf_counter() - start) / iterations, results
+
+mcpp_time, mcpp_results = run(mcpp_preprocessor)
+malt_time, malt_results = run(lambda *args: preprocess(args[0] + '\n', *args[1:]))
+
+mismatches = 0
+for case, a, b in zip(cases, mcpp_results, malt_results):
+    if normalize(a) != normalize(b):
+        mismatches += 1
+        print('MISMATCH :', case)
+
+print(f'Shader sources : {len(cases)}')
+print(f'mcpp : {mcpp_time*1000:.2f} ms ({mcpp_time*1000/len(cases):.2f} ms per source)')
+print(f'GLSLPreprocessor : {malt_time*1000:.2f} ms ({malt_time*1000/len(cases):.2f} ms per source)')
+print(f'Speedup : {mcpp_time/malt_time:.2f}x')
+print(f'Mismatches : {mismatches}')
@@ -0,0 +1,46 @@
+#Checks that NPR mesh materials with vertex displacement are flagged, so the pipeline doesn't cull them by their mesh bounds.
+#Materials are compiled from their file path, so the displacement defines are only visible after include resolution.
+#Usage: python check_vertex_displacement.py
+
+import os, sys, tempfile
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+malt_path = os.path.join(current_dir, '..')
+py_version = str(sys.version_info[0])+str(sys.version_info[1])
+sys.path.append(malt_path)
+sys.path.append(os.path.join(malt_path, 'Malt', '.Dependencies-{}'.format(py_version)))
+
+from Malt.PipelineGraph import GLSLPipelineGraph
+
+shaders_dir = os.path.join(malt_path, 'Malt', 'Shaders')
+npr_dir = os.path.join(malt_path, 'Malt', 'Pipelines', 'NPR_Pipeline', 'Shaders')
+
+#Same settings as the NPR_Pipeline Mesh graph
+graph = GLSLPipelineGraph('Mesh', GLSLPipelineGraph.SCENE_GRAPH, '', '', shaders=['PRE_PASS', 'MAIN_PASS', 'SHADOW_PASS'],
+    vertex_displacement_marker='MALT_VERTEX_DISPLACEMENT')
+graph.include_paths = [shaders_dir, npr_dir]
+
+materials = {
+    'plain.mesh.glsl' : (False, '#include "NPR_MeshShader.glsl"\n'),
+    'displacement.mesh.glsl' : (True, '#define CUSTOM_VERTEX_DISPLACEMENT\n#include "NPR_MeshShader.glsl"\n'
+        'vec3 VERTEX_DISPLACEMENT_SHADER(){ return NORMAL; }\n'),
+    'vertex_shader.mesh.glsl' : (True, '#define CUSTOM_VERTEX_SHADER\n#include "NPR_MeshShader.glsl"\n'
+        'void COMMON_VERTEX_SHADER(inout Vertex V){ V.position += V.normal; }\n'),
+}
+
+failures = 0
+with tempfile.TemporaryDirectory() as material_dir:
+    for name, (expected, code) in materials.items():
+        with open(os.path.join(material_dir, name), 'w') as f:
+            f.write(code)
+        #The same source Pipeline.compile_material builds for file materials
+        source = '#include "{}"'.format(name)
+        for shader in graph.shaders:
+            vertex_source = graph.preprocess_shader_from_source(source, [material_dir], [shader, 'VERTEX_SHADER'])
+            result = graph.displaces_vertices(vertex_source)
+            if result != expected:
+                failures += 1
+                print(f'FAIL : {name} {shader} displaces_vertices={result}, expected {expected}')
+
+print(f'Failures : {failures}')
+sys.exit(1 if failures else 0)
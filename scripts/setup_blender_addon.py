@@ -25,6 +25,7 @@ build_lib(os.path.join(blender_malt_folder, 'CBlenderMalt'))
 build_lib(os.path.join(malt_folder, 'GL', 'GLSLParser'))
 build_lib(os.path.join(bridge_folder, 'ipc'))
 build_lib(os.path.join(bridge_folder, 'renderdoc'))
+build_lib(os.path.join(bridge_folder, 'mesh_optimizer'))
 
 subprocess.check_call([sys.executable, os.path.join(current_dir, 'install_dependencies.py')])
 